@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Finds the data section size above which parallel CBC decryption wins.
+
+Random ciphertexts of doubling sizes are decrypted with
+``TwofishBackend.cbc_decrypt`` and ``cbc_decrypt_parallel`` by every
+registered cipher backend. The worker pool is started and the key schedule
+run before timing, as both are kept across calls in real use. The smallest
+size from which the parallel path stays faster is reported as the crossover,
+to be compared with the ``parallel_threshold`` estimated by
+``TwofishBackend.calibrate``:
+
+    {"meta": {...}, "results": {"python": {"crossover": ..., "sizes": [...]}}}
+
+"""
+# builtin
+import os
+import json
+import time
+import argparse
+
+# internal
+import pwsr.cipher as cipher
+
+import run
+
+
+DEFAULT_MIN_SIZE = 4 * 1024
+DEFAULT_MAX_SIZE = {
+    'python': 1024 * 1024,
+    'mcrypt': 64 * 1024 * 1024,
+}
+
+KEY = "\x00" * 32
+IV = "\x00" * cipher.BLOCK_SIZE
+
+
+def best_of(repeat, func, *args):
+    """Returns the duration of the fastest of `repeat` calls of `func`.
+    Unlike ``run.best_of``, cipher contexts are kept between calls.
+
+    """
+    best = None
+
+    for _ in xrange(repeat):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def crossover(sizes):
+    """Returns the smallest size from which every parallel run was faster,
+    or None.
+
+    """
+    result = None
+
+    for size in reversed(sizes):
+        if size['parallel'] >= size['serial']:
+            break
+        result = size['size']
+
+    return result
+
+
+def benchmark(backend, min_size, max_size, processes, repeat):
+    sizes = []
+    size = min_size
+
+    # Warm up the pool and the key schedule outside of the measurements.
+    backend.cbc_decrypt(KEY, IV, os.urandom(min_size))
+    backend.cbc_decrypt_parallel(KEY, IV, os.urandom(min_size), processes)
+
+    while size <= max_size:
+        data = os.urandom(size)
+
+        serial = best_of(repeat, backend.cbc_decrypt, KEY, IV, data)
+        parallel = best_of(repeat, backend.cbc_decrypt_parallel,
+                           KEY, IV, data, processes)
+
+        sizes.append({
+            'size': size,
+            'serial': serial,
+            'parallel': parallel,
+            'speedup': serial / parallel,
+        })
+
+        size *= 2
+
+    return {
+        'processes': processes,
+        'threshold': backend.calibrate(processes),
+        'crossover': crossover(sizes),
+        'sizes': sizes,
+    }
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks serial against parallel CBC decryption"
+    )
+
+    parser.add_argument(
+        "--backend",
+        dest="backends",
+        default=None,
+        action="append",
+        help="Cipher backend to benchmark. Repeatable (default: all)"
+    )
+
+    parser.add_argument(
+        "--min-size",
+        dest="min_size",
+        default=DEFAULT_MIN_SIZE,
+        type=int,
+        help="Smallest ciphertext in bytes (default: %d)" % DEFAULT_MIN_SIZE
+    )
+
+    parser.add_argument(
+        "--max-size",
+        dest="max_size",
+        default=None,
+        type=int,
+        help="Largest ciphertext in bytes (default: 1 MiB for the python "
+             "backend, 64 MiB otherwise)"
+    )
+
+    parser.add_argument(
+        "--processes",
+        dest="processes",
+        default=cipher.cpu_count(),
+        type=int,
+        help="Worker processes (default: number of CPUs)"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        default=run.DEFAULT_REPEAT,
+        type=int,
+        help="Runs per measurement; the fastest is reported"
+    )
+
+    parser.add_argument(
+        "--output",
+        dest="output",
+        default=None,
+        help="Write the JSON results to this file instead of stdout"
+    )
+
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    results = {}
+
+    for name in args.backends or cipher.backends():
+        max_size = args.max_size or DEFAULT_MAX_SIZE.get(
+            name, DEFAULT_MAX_SIZE['mcrypt']
+        )
+        results[name] = benchmark(
+            cipher.get_backend(name), args.min_size, max_size,
+            args.processes, args.repeat
+        )
+
+    meta = run.meta()
+    meta['cpus'] = cipher.cpu_count()
+
+    output = json.dumps({'meta': meta, 'results': results}, indent=2,
+                        sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print output
+
+if __name__ == "__main__":
+    main()
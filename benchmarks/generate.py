@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Generates synthetic Password Safe v3 vaults for benchmarking.
+
+Record contents are drawn from a seeded PRNG, so the same arguments always
+produce vaults with the same records, field sizes and file size. (Salts,
+keys, IVs and field padding still come from ``os.urandom``.)
+
+"""
+# builtin
+import sys
+import struct
+import random
+import argparse
+
+# internal
+import pwsr.db as db
+from pwsr.db import PwSafeV3Field, PWSafeV3Header, PWSafeV3Record
+
+
+DEFAULT_PASSWORD = "benchmark"
+DEFAULT_FIELD_SIZE = 16
+DEFAULT_GROUP_DEPTH = 2
+DEFAULT_SEED = 0
+
+GROUP_FANOUT = 8  # subgroups per group
+MTIME_BASE = 1400000000
+
+_ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+def _text(rng, size):
+    return "".join(rng.choice(_ALPHABET) for _ in xrange(size))
+
+
+def _group(rng, depth):
+    return ".".join(
+        "group%d-%d" % (level, rng.randrange(GROUP_FANOUT))
+        for level in xrange(depth)
+    )
+
+
+def make_record(rng, i, field_size=DEFAULT_FIELD_SIZE,
+                group_depth=DEFAULT_GROUP_DEPTH):
+    """Returns record number `i` of a synthetic vault."""
+    record = PWSafeV3Record()
+    mtime = struct.pack("<L", MTIME_BASE + rng.randrange(10 ** 8))
+
+    fields = [
+        (PWSafeV3Record.TYPE_UUID, "".join(
+            chr(rng.randrange(256)) for _ in xrange(16))
+        ),
+        (PWSafeV3Record.TYPE_GROUP, _group(rng, group_depth)),
+        (PWSafeV3Record.TYPE_TITLE, "entry%d-%s" % (i, _text(rng, 8))),
+        (PWSafeV3Record.TYPE_USERNAME, "user%d@example.com" % i),
+        (PWSafeV3Record.TYPE_PASSWORD, _text(rng, field_size)),
+        (PWSafeV3Record.TYPE_URL, "https://%s.example.com/" % _text(rng, 8)),
+        (PWSafeV3Record.TYPE_NOTES, _text(rng, field_size * 4)),
+        (PWSafeV3Record.TYPE_CTIME, mtime),
+        (PWSafeV3Record.TYPE_MTIME, mtime),
+        (db.TYPE_END, ""),
+    ]
+
+    if not group_depth:
+        del fields[1]
+
+    for ftype, value in fields:
+        record[ftype] = PwSafeV3Field(ftype, value)
+
+    return record
+
+
+def generate(fn, records, password=DEFAULT_PASSWORD,
+             iterations=db.PWSafeDB.MIN_ITER, field_size=DEFAULT_FIELD_SIZE,
+             group_depth=DEFAULT_GROUP_DEPTH, seed=DEFAULT_SEED):
+    """Writes a vault with `records` synthetic records to `fn` and returns
+    the unlocked ``PWSafeDB``.
+
+    """
+    rng = random.Random(seed)
+    pwsafe = db.PWSafeDB()
+    pwsafe.create(password, iterations)
+
+    empty = PwSafeV3Field(PWSafeV3Header.TYPE_EMPTY_GROUPS, "empty.group")
+    pwsafe.header.add(empty)
+
+    for i in xrange(records):
+        pwsafe.add_record(make_record(rng, i, field_size, group_depth))
+
+    pwsafe.save(fn)
+    return pwsafe
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Generates a synthetic Password Safe v3 vault"
+    )
+
+    parser.add_argument("output", help="Path of the vault to write")
+
+    parser.add_argument(
+        "--records",
+        dest="records",
+        default=1000,
+        type=int,
+        help="Number of records (default: 1000)"
+    )
+
+    parser.add_argument(
+        "--password",
+        dest="password",
+        default=DEFAULT_PASSWORD,
+        help="Vault password (default: %s)" % DEFAULT_PASSWORD
+    )
+
+    parser.add_argument(
+        "--iter",
+        dest="iter",
+        default=db.PWSafeDB.MIN_ITER,
+        type=int,
+        help="Key stretching iterations (default: %d)" % db.PWSafeDB.MIN_ITER
+    )
+
+    parser.add_argument(
+        "--field-size",
+        dest="field_size",
+        default=DEFAULT_FIELD_SIZE,
+        type=int,
+        help="Password length; notes are four times as long "
+             "(default: %d)" % DEFAULT_FIELD_SIZE
+    )
+
+    parser.add_argument(
+        "--group-depth",
+        dest="group_depth",
+        default=DEFAULT_GROUP_DEPTH,
+        type=int,
+        help="Number of levels in each record's group path "
+             "(default: %d)" % DEFAULT_GROUP_DEPTH
+    )
+
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        default=DEFAULT_SEED,
+        type=int,
+        help="PRNG seed for the record contents (default: %d)" % DEFAULT_SEED
+    )
+
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+
+    generate(
+        args.output, args.records, args.password, args.iter,
+        args.field_size, args.group_depth, args.seed
+    )
+
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""Times each phase of opening and querying a Password Safe v3 vault.
+
+Vaults are built by ``generate.py`` (and reused from `--vault-dir` when they
+already exist there), and every measurement is the best of `--repeat` runs.
+Cipher contexts are cleared before each run so key schedules are not
+cached across runs. Results are written as JSON so they can be compared
+across commits:
+
+    {"meta": {...}, "results": [{"records": ..., "timings": {...}}, ...]}
+
+"""
+# builtin
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+# internal
+import pwsr
+import pwsr.db as db
+import pwsr.utils as utils
+import pwsr.cipher as cipher
+import pwsr.stretch as stretch
+from pwsr.db import PwSafeV3FieldReader, PWSafeV3Header, PWSafeV3RecordStore
+
+import generate
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_SCRIPT = os.path.join(BASE_DIR, "pwsr", "scripts", "pwsr-get.py")
+
+DEFAULT_RECORDS = [1000, 10000]
+DEFAULT_REPEAT = 3
+LOOKUPS = 1000  # titles looked up by the __getitem__ benchmark
+SEARCH_KEY = "entry1"
+
+
+def best_of(repeat, func, *args):
+    """Returns ``(seconds, result)`` for the fastest of `repeat` calls of
+    `func`.
+
+    """
+    best, result = None, None
+
+    for _ in xrange(repeat):
+        cipher.clear()
+
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, result
+
+
+def time_parse(fn, password, repeat):
+    """Times the phases of ``PWSafeDB.parse`` separately, the way it runs
+    them.
+
+    """
+    pwsafe = db.PWSafeDB()
+    timings = {}
+
+    def phase(name, func, *args):
+        timings[name], result = best_of(repeat, func, *args)
+        return result
+
+    with open(fn, 'rb') as f:
+        ph = phase('preheader', pwsafe._read_preheader, f)
+
+    pp = phase('stretch', pwsafe._stretch_key, password, ph.salt, ph.iter)
+    keys = phase('keys_decrypt', pwsafe._decrypt,
+                 ph.b1 + ph.b2 + ph.b3 + ph.b4, pp)
+    k, l = keys[:32], keys[32:]
+
+    with open(fn, 'rb') as f:
+        with utils.mapped(f) as data:
+            udata = phase('data_decrypt', pwsafe._decrypt_data_section,
+                          data, ph.iv, k)
+
+    def parse_header():
+        reader = PwSafeV3FieldReader(udata, mac=pwsafe._new_mac(l))
+        PWSafeV3Header.parse(reader)
+        return reader
+
+    reader = phase('header_parse', parse_header)
+
+    def parse_records():
+        records = PwSafeV3FieldReader(udata, reader.offset, reader.mac.copy())
+        return PWSafeV3RecordStore.parse(records).records()
+
+    phase('record_parse', parse_records)
+    phase('parse', db.parse, fn, password)
+
+    return timings
+
+
+def time_queries(fn, password, repeat, seed):
+    """Times the in-memory query paths of a parsed vault."""
+    pwsafe = db.parse(fn, password)
+    timings = {}
+
+    rng = random.Random(seed)
+    titles = [x.title.value for x in pwsafe.records]
+    titles = [rng.choice(titles) for _ in xrange(LOOKUPS)]
+
+    def search_cold():
+        pwsafe._search_indexes.clear()
+        return pwsafe.search(SEARCH_KEY)
+
+    def lookups():
+        for title in titles:
+            pwsafe[title]
+
+    timings['search_index'], _ = best_of(repeat, search_cold)
+    timings['search'], _ = best_of(repeat, pwsafe.search, SEARCH_KEY)
+    timings['groupby'], _ = best_of(repeat, pwsafe.groupby)
+    timings['grouped'], _ = best_of(repeat, lambda: list(pwsafe.grouped()))
+    timings['getitem_x%d' % LOOKUPS], _ = best_of(repeat, lookups)
+
+    return timings
+
+
+def time_cli(fn, password, repeat):
+    """Times ``pwsr-get.py --list`` as a separate process, interpreter
+    startup included. Returns ``(seconds, error)``.
+
+    """
+    home = tempfile.mkdtemp(prefix="pwsr-bench-")
+    env = dict(os.environ)
+    env['HOME'] = home  # no configuration file
+    env['PWSR_AGENT_SOCK'] = os.path.join(home, "agent.sock")  # no agent
+    env['PYTHONPATH'] = os.pathsep.join(
+        x for x in (BASE_DIR, env.get('PYTHONPATH')) if x
+    )
+
+    args = [sys.executable, CLI_SCRIPT, "--db", fn, "--dbpw", password,
+            "--list", "--hide"]
+
+    def run():
+        proc = subprocess.Popen(args, env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        return err if proc.returncode else None
+
+    try:
+        return best_of(repeat, run)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def vault_fn(dirname, records, args):
+    name = "vault-{0}-f{1}-i{2}-g{3}-s{4}.psafe3".format(
+        records, args.field_size, args.iter, args.group_depth, args.seed
+    )
+    return os.path.join(dirname, name)
+
+
+def benchmark(records, dirname, args):
+    fn = vault_fn(dirname, records, args)
+
+    if not os.path.exists(fn):
+        start = time.time()
+        generate.generate(fn, records, args.password, args.iter,
+                          args.field_size, args.group_depth, args.seed)
+        generated = time.time() - start
+    else:
+        generated = None
+
+    timings = time_parse(fn, args.password, args.repeat)
+    timings.update(time_queries(fn, args.password, args.repeat, args.seed))
+    result = {
+        'records': records,
+        'field_size': args.field_size,
+        'iter': args.iter,
+        'group_depth': args.group_depth,
+        'seed': args.seed,
+        'file_size': os.path.getsize(fn),
+        'generate': generated,
+        'timings': timings,
+    }
+
+    if args.cli:
+        timings['cli_list'], error = time_cli(fn, args.password, args.repeat)
+
+        if error:
+            timings['cli_list'] = None
+            result['cli_error'] = error.strip().splitlines()[-1]
+
+    return result
+
+
+def git_revision():
+    with utils.ignored(OSError, subprocess.CalledProcessError):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=BASE_DIR, stderr=devnull
+            ).strip()
+
+    return None
+
+
+def meta():
+    return {
+        'pwsr': pwsr.__version__,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cipher_backend': cipher.get_backend().name,
+        'stretch_backends': stretch.backends(),
+        'time': int(time.time()),
+    }
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks parsing and querying Password Safe vaults"
+    )
+
+    parser.add_argument(
+        "--records",
+        dest="records",
+        default=None,
+        type=int,
+        action="append",
+        help="Vault size to benchmark. Repeatable (default: %s)" %
+             ", ".join(str(x) for x in DEFAULT_RECORDS)
+    )
+
+    parser.add_argument(
+        "--field-size",
+        dest="field_size",
+        default=generate.DEFAULT_FIELD_SIZE,
+        type=int,
+        help="Password length; notes are four times as long"
+    )
+
+    parser.add_argument(
+        "--iter",
+        dest="iter",
+        default=db.PWSafeDB.MIN_ITER,
+        type=int,
+        help="Key stretching iterations"
+    )
+
+    parser.add_argument(
+        "--group-depth",
+        dest="group_depth",
+        default=generate.DEFAULT_GROUP_DEPTH,
+        type=int,
+        help="Number of levels in each record's group path"
+    )
+
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        default=generate.DEFAULT_SEED,
+        type=int,
+        help="PRNG seed for the record contents"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        default=DEFAULT_REPEAT,
+        type=int,
+        help="Runs per measurement; the fastest is reported"
+    )
+
+    parser.add_argument(
+        "--vault-dir",
+        dest="vault_dir",
+        default=None,
+        help="Keep generated vaults in this directory and reuse them"
+    )
+
+    parser.add_argument(
+        "--no-cli",
+        dest="cli",
+        default=True,
+        action="store_false",
+        help="Skip the command line --list benchmark"
+    )
+
+    parser.add_argument(
+        "--output",
+        dest="output",
+        default=None,
+        help="Write the JSON results to this file instead of stdout"
+    )
+
+    parser.set_defaults(password=generate.DEFAULT_PASSWORD)
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    dirname = args.vault_dir or tempfile.mkdtemp(prefix="pwsr-vaults-")
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    try:
+        results = [
+            benchmark(records, dirname, args)
+            for records in args.records or DEFAULT_RECORDS
+        ]
+    finally:
+        if not args.vault_dir:
+            shutil.rmtree(dirname, ignore_errors=True)
+
+    output = json.dumps({'meta': meta(), 'results': results}, indent=2,
+                        sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print output
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,695 @@
+"""A resident agent which keeps an unlocked Password Safe database in memory
+and answers lookups over a Unix-domain socket.
+
+Messages in both directions are framed as a 4 byte big-endian length followed
+by a UTF-8 JSON object. Requests have the form ``{"cmd": ..., "db": ...}``
+plus command-specific arguments. Responses always contain an ``ok`` member and
+either the result of the command or an ``error`` message.
+
+Every lookup must carry the database password as ``dbpw``. The agent only
+keeps a keyed hash of the password it was unlocked with, and refuses lookups
+whose password does not match it. Before answering, it checks whether the
+database file changed on disk, and reloads it with the password of the
+request, or locks itself if that fails.
+
+A key cache agent (:class:`KeyCacheServer`) speaks the same protocol on its
+own socket. It holds no database, only stretched keys (P') for a limited time,
+which :class:`AgentKeyCache` makes available to ``PWSafeDB`` through
+:mod:`pwsr.keycache`.
+
+"""
+# builtin
+import os
+import hmac
+import json
+import time
+import socket
+import struct
+import hashlib
+import binascii
+import resource
+import threading
+import SocketServer
+
+# internal
+from . import db, errors, keycache, utils
+from .db import PWSafeV3Record
+
+
+DEFAULT_SOCKET_FN = utils.abspath("~/.pwsr/agent.sock")
+DEFAULT_KEYCACHE_SOCKET_FN = utils.abspath("~/.pwsr/keys.sock")
+DEFAULT_IDLE_TIMEOUT = 15 * 60  # seconds
+CLIENT_TIMEOUT = 5  # seconds
+POLL_INTERVAL = 0.5  # seconds between checks for a lock while serving
+
+_FRAME_HEADER = struct.Struct(">L")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+def socket_path(fn=None):
+    """Returns the agent socket path. This is `fn` if given, otherwise the
+    ``PWSR_AGENT_SOCK`` environment variable or ``~/.pwsr/agent.sock``.
+
+    """
+    fn = fn or os.environ.get("PWSR_AGENT_SOCK") or DEFAULT_SOCKET_FN
+    return utils.abspath(fn)
+
+
+def keycache_socket_path(fn=None):
+    """Returns the key cache agent socket path. This is `fn` if given,
+    otherwise the ``PWSR_KEYCACHE_SOCK`` environment variable or
+    ``~/.pwsr/keys.sock``.
+
+    """
+    fn = fn or os.environ.get("PWSR_KEYCACHE_SOCK") or \
+        DEFAULT_KEYCACHE_SOCKET_FN
+    return utils.abspath(fn)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return "".join(chunks)
+
+
+def send_message(sock, message):
+    """Writes `message` to `sock` as a single length-prefixed JSON frame."""
+    payload = json.dumps(message)
+    sock.sendall(_FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def recv_message(sock):
+    """Reads a single frame from `sock`.
+
+    Returns:
+        The decoded JSON object or ``None`` if the peer closed the connection.
+
+    Raises:
+        .AgentError: If the frame is malformed.
+
+    """
+    header = _recv_exact(sock, _FRAME_HEADER.size)
+    if header is None:
+        return None
+
+    size = _FRAME_HEADER.unpack(header)[0]
+    if size > MAX_FRAME_SIZE:
+        raise errors.AgentError("Agent frame too large: %d bytes" % size)
+
+    payload = _recv_exact(sock, size)
+    if payload is None:
+        raise errors.AgentError("Agent connection closed mid-frame")
+
+    try:
+        return json.loads(payload)
+    except ValueError as ex:
+        raise errors.AgentError("Invalid agent frame: {0}".format(ex))
+
+
+def _text(field):
+    if field is None:
+        return None
+    return field.value.decode('utf-8', 'replace')
+
+
+def record_to_dict(record):
+    """Returns a JSON serializable dictionary for `record`."""
+    return {
+        'title': _text(record[PWSafeV3Record.TYPE_TITLE]),
+        'group': _text(record[PWSafeV3Record.TYPE_GROUP]),
+        'username': _text(record[PWSafeV3Record.TYPE_USERNAME]),
+        'password': _text(record[PWSafeV3Record.TYPE_PASSWORD]),
+    }
+
+
+class AgentRecord(object):
+    """A read-only record returned by the agent. It exposes the same
+    ``title``, ``group``, ``username`` and ``password`` properties as
+    :class:`.PWSafeV3Record`, as UTF-8 encoded strings.
+
+    """
+    __slots__ = ('title', 'group', 'username', 'password')
+
+    def __init__(self, title=None, group=None, username=None, password=None):
+        self.title = _encode(title)
+        self.group = _encode(group)
+        self.username = _encode(username)
+        self.password = _encode(password)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def __str__(self):
+        return "[{}] g: {} u: {} p: {}".format(
+            self.title,
+            self.group,
+            self.username,
+            self.password
+        )
+
+
+def _encode(value):
+    if value is None:
+        return None
+    return value.encode('utf-8')
+
+
+class _AgentHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        # Don't let an idle client hold its connection open past the idle
+        # timeout. Other clients are served on their own threads meanwhile.
+        self.request.settimeout(self.server.idle_timeout)
+
+        try:
+            while True:
+                try:
+                    request = recv_message(self.request)
+                except socket.timeout:
+                    return
+                except errors.AgentError as ex:
+                    response = {'ok': False, 'error': str(ex)}
+                    send_message(self.request, response)
+                    return
+
+                if request is None:
+                    return
+
+                response = self.server.handle_message(request)
+                send_message(self.request, response)
+
+                if self.server.locked:
+                    return
+        except socket.error:
+            # The client went away mid-request.
+            return
+
+
+class _LockingServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    """Binds an owner-only Unix-domain socket at `path` and handles requests
+    until :meth:`lock` is called or no request arrives for `idle_timeout`
+    seconds. Subclasses implement ``locked``, ``lock()`` and ``dispatch()``.
+
+    Every connection is served on its own thread, so a client which keeps
+    its connection open does not hold up the others. Requests are
+    dispatched one at a time.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.last_used = time.time()
+        self.path = path
+        self._dispatch_lock = threading.Lock()
+
+        _prepare_socket_path(path)
+
+        umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, _AgentHandler)
+        finally:
+            os.umask(umask)
+
+    def handle_message(self, request):
+        """Dispatches `request` unless the agent has been locked, and
+        returns the response.
+
+        """
+        with self._dispatch_lock:
+            if self.locked:
+                return {'ok': False, 'error': "Agent is locked"}
+
+            self.last_used = time.time()
+            return self.dispatch(request)
+
+    def handle_timeout(self):
+        with self._dispatch_lock:
+            if time.time() - self.last_used >= self.idle_timeout:
+                self.lock()
+
+    def serve_until_locked(self):
+        """Disables core dumps, handles requests until the agent is locked,
+        then removes the socket.
+
+        """
+        disable_core_dumps()
+
+        try:
+            while not self.locked:
+                # Requests over open connections, including 'lock', are
+                # handled on other threads, so wake up regularly to see
+                # whether the agent was locked or has become idle.
+                idle = time.time() - self.last_used
+                self.timeout = min(max(self.idle_timeout - idle, 0),
+                                   POLL_INTERVAL)
+                self.handle_request()
+        finally:
+            self.server_close()
+            with utils.ignored(OSError):
+                os.unlink(self.path)
+
+
+class AgentServer(_LockingServer):
+    """Serves lookups against an unlocked ``PWSafeDB`` over a Unix-domain
+    socket until it is locked or has been idle for `idle_timeout` seconds.
+
+    Args:
+        path: The socket path.
+        pwsafe: An unlocked ``PWSafeDB`` instance.
+        dbfn: The path of the database file `pwsafe` was parsed from. Clients
+            asking about a different file are told to parse it themselves.
+        dbpw: The password `pwsafe` was unlocked with. Only a hash of it,
+            keyed with a random per-agent key, is kept.
+        idle_timeout: Seconds without a request before the agent locks.
+
+    """
+    def __init__(self, path, pwsafe, dbfn, dbpw,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.pwsafe = pwsafe
+        self.dbfn = utils.abspath(dbfn)
+        self.signature = utils.file_signature(self.dbfn)
+        self._secret = os.urandom(32)
+        self._proof = self._password_proof(dbpw)
+        _LockingServer.__init__(self, path, idle_timeout)
+
+    @property
+    def locked(self):
+        return self.pwsafe is None
+
+    def lock(self):
+        """Drops the unlocked database."""
+        self.pwsafe = None
+        self._proof = None
+
+    def _password_proof(self, dbpw):
+        if isinstance(dbpw, unicode):
+            dbpw = dbpw.encode('utf-8')
+        return hmac.new(self._secret, dbpw, hashlib.sha256).digest()
+
+    def _check_password(self, dbpw):
+        """Returns True if `dbpw` is the password the database was unlocked
+        with.
+
+        """
+        if not dbpw or self._proof is None:
+            return False
+        return hmac.compare_digest(self._password_proof(dbpw), self._proof)
+
+    def _reload(self, dbpw):
+        """Parses the database file again with `dbpw` if it changed on disk
+        since it was loaded. Locks the agent if it can no longer be read.
+
+        Returns:
+            None if the loaded database is current, or an error response.
+
+        """
+        if utils.file_signature(self.dbfn) == self.signature:
+            return None
+
+        pwsafe = db.PWSafeDB()
+
+        try:
+            with open(self.dbfn, 'rb') as f:
+                pwsafe.parse(f, dbpw)
+                signature = utils.file_signature(f)
+        except (EnvironmentError, errors.InvalidDatabaseError,
+                errors.InvalidPasswordError, errors.IntegrityError) as ex:
+            self.lock()
+            error = "Database changed and could not be reloaded: {0}"
+            return {'ok': False, 'error': error.format(ex)}
+
+        self.pwsafe = pwsafe
+        self.signature = signature
+        return None
+
+    def dispatch(self, request):
+        cmd = request.get('cmd')
+        handler = getattr(self, "_cmd_%s" % cmd, None)
+
+        if handler is None:
+            return {'ok': False, 'error': "Unknown command '%s'" % cmd}
+
+        if cmd not in ('ping', 'lock'):
+            dbfn = request.get('db')
+            if dbfn and utils.abspath(dbfn) != self.dbfn:
+                return {'ok': False, 'error': "Database not loaded"}
+
+            dbpw = _encode(request.get('dbpw'))
+            if not self._check_password(dbpw):
+                return {'ok': False, 'error': "Incorrect database password"}
+
+            error = self._reload(dbpw)
+            if error is not None:
+                return error
+
+        try:
+            return handler(request)
+        except errors.KeyLookupError as ex:
+            return {'ok': False, 'error': str(ex), 'key': ex.key}
+        except errors.QueryError as ex:
+            return {'ok': False, 'error': str(ex)}
+
+    def _cmd_ping(self, request):
+        return {'ok': True, 'db': self.dbfn}
+
+    def _cmd_lock(self, request):
+        self.lock()
+        return {'ok': True}
+
+    def _cmd_get(self, request):
+        key = _encode(request.get('key'))
+        record = utils.find_record(self.pwsafe, key)
+        return {'ok': True, 'records': [record_to_dict(record)]}
+
+    def _cmd_search(self, request):
+        key = _encode(request.get('key'))
+        fields = request.get('fields')
+        records = utils.find_record(self.pwsafe, key, True, fields)
+        return {'ok': True, 'records': [record_to_dict(x) for x in records]}
+
+    def _cmd_query(self, request):
+        where = request.get('where') or []
+        key = _encode(request.get('key'))
+        fields = request.get('fields')
+        records = utils.query_records(self.pwsafe, where, key, fields)
+        return {'ok': True, 'records': [record_to_dict(x) for x in records]}
+
+    def _cmd_list(self, request):
+        records = [record_to_dict(x) for x in self.pwsafe.grouped()]
+        return {'ok': True, 'records': records}
+
+
+class KeyCacheServer(_LockingServer):
+    """Holds stretched keys in memory and serves them over a Unix-domain
+    socket until it is locked or has been idle for `idle_timeout` seconds.
+
+    Keys are only ever kept in memory, and core dumps of the process are
+    disabled by :meth:`serve_until_locked`.
+
+    Args:
+        path: The socket path.
+        ttl: Seconds a key stays cached after it was stored.
+        idle_timeout: Seconds without a request before the agent locks.
+
+    """
+    def __init__(self, path, ttl=keycache.DEFAULT_TTL,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.cache = keycache.MemoryKeyCache(ttl)
+        _LockingServer.__init__(self, path, idle_timeout)
+
+    @property
+    def locked(self):
+        return self.cache is None
+
+    def lock(self):
+        """Drops every cached key."""
+        if self.cache is not None:
+            self.cache.clear()
+        self.cache = None
+
+    def dispatch(self, request):
+        cmd = request.get('cmd')
+        handler = getattr(self, "_cmd_%s" % cmd, None)
+
+        if handler is None:
+            return {'ok': False, 'error': "Unknown command '%s'" % cmd}
+
+        return handler(request)
+
+    def _cmd_ping(self, request):
+        return {'ok': True, 'db': None}
+
+    def _cmd_lock(self, request):
+        self.lock()
+        return {'ok': True}
+
+    def _cmd_key_get(self, request):
+        pp = self.cache.get_id(request.get('id'))
+        if pp is not None:
+            pp = binascii.hexlify(pp)
+        return {'ok': True, 'key': pp}
+
+    def _cmd_key_put(self, request):
+        pp = binascii.unhexlify(request.get('key'))
+        self.cache.put_id(request.get('id'), pp)
+        return {'ok': True}
+
+    def _cmd_key_forget(self, request):
+        self.cache.forget_id(request.get('id'))
+        return {'ok': True}
+
+    def _cmd_key_clear(self, request):
+        self.cache.clear()
+        return {'ok': True}
+
+
+def _prepare_socket_path(path):
+    """Creates the socket directory and removes a stale socket file left
+    behind by an agent which is no longer running.
+
+    """
+    dirname = os.path.dirname(path)
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+
+    if not os.path.exists(path):
+        return
+
+    if AgentClient.ping_path(path):
+        error = "An agent is already listening on {0}".format(path)
+        raise errors.AgentError(error)
+
+    os.unlink(path)
+
+
+class AgentClient(object):
+    """A client for a running :class:`AgentServer`.
+
+    Args:
+        path: The agent socket path. See :func:`socket_path`.
+        dbfn: The database file lookups should be answered from.
+        dbpw: The database password, which the agent requires with every
+            lookup.
+
+    """
+    def __init__(self, path=None, dbfn=None, dbpw=None,
+                 timeout=CLIENT_TIMEOUT):
+        self.path = socket_path(path)
+        self.dbfn = utils.abspath(dbfn) if dbfn else None
+        self.dbpw = dbpw
+        self.timeout = timeout
+        self._sock = None
+
+    def _connect(self):
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._sock = sock
+        return self._sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def request(self, cmd, **kwargs):
+        """Sends `cmd` to the agent and returns the decoded response.
+
+        Raises:
+            .AgentError: If the agent cannot be reached or reports an error.
+            .KeyLookupError: If a lookup did not match any records.
+
+        """
+        kwargs['cmd'] = cmd
+        if self.dbfn:
+            kwargs['db'] = self.dbfn
+        if self.dbpw and cmd not in ('ping', 'lock'):
+            kwargs['dbpw'] = self.dbpw
+
+        try:
+            sock = self._connect()
+            send_message(sock, kwargs)
+            response = recv_message(sock)
+        except socket.error as ex:
+            self.close()
+            raise errors.AgentError("Agent unavailable: {0}".format(ex))
+
+        if response is None:
+            self.close()
+            raise errors.AgentError("Agent closed the connection")
+
+        if not response.get('ok'):
+            if 'key' in response:
+                raise errors.KeyLookupError(response['error'], response['key'])
+            raise errors.AgentError(response.get('error'))
+
+        return response
+
+    def _records(self, cmd, **kwargs):
+        response = self.request(cmd, **kwargs)
+        return [AgentRecord.from_dict(x) for x in response['records']]
+
+    def get(self, key):
+        """Returns the record matching `key`. See :func:`.find_record`."""
+        return self._records('get', key=key)[0]
+
+    def search(self, key, fields=None):
+        """Returns the records matching `key`. See :func:`.find_record`."""
+        return self._records('search', key=key, fields=fields)
+
+    def query(self, where, key=None, fields=None):
+        """Returns the records matching the predicates `where`, and `key` if
+        given. See :func:`.query_records`.
+
+        """
+        return self._records('query', where=where, key=key, fields=fields)
+
+    def list(self):
+        """Returns every record in the database."""
+        return self._records('list')
+
+    def lock(self):
+        """Tells the agent to drop the unlocked database and exit."""
+        self.request('lock')
+        self.close()
+
+    def ping(self):
+        """Returns True if the agent is running and serving ``self.dbfn``."""
+        try:
+            response = self.request('ping')
+        except errors.AgentError:
+            return False
+
+        return self.dbfn is None or response.get('db') == self.dbfn
+
+    @staticmethod
+    def ping_path(path):
+        client = AgentClient(path)
+        try:
+            return client.ping()
+        finally:
+            client.close()
+
+
+class AgentKeyCache(keycache.KeyCache):
+    """A :class:`.keycache.KeyCache` which keeps keys in a running
+    :class:`KeyCacheServer`. If the agent stops responding, keys are no
+    longer looked up or cached and are stretched as if there were no cache.
+
+    Args:
+        path: The key cache agent socket path. See
+            :func:`keycache_socket_path`.
+
+    """
+    def __init__(self, path=None):
+        self.client = AgentClient(keycache_socket_path(path))
+
+    def _request(self, cmd, **kwargs):
+        if self.client is None:
+            return None
+
+        try:
+            return self.client.request(cmd, **kwargs)
+        except errors.AgentError:
+            self.client.close()
+            self.client = None
+            return None
+
+    def get(self, salt, iterations, key):
+        ident = keycache.cache_id(salt, iterations, key)
+        response = self._request('key_get', id=ident)
+
+        if not (response and response.get('key')):
+            return None
+
+        return binascii.unhexlify(response['key'])
+
+    def put(self, salt, iterations, key, pp):
+        ident = keycache.cache_id(salt, iterations, key)
+        self._request('key_put', id=ident, key=binascii.hexlify(pp))
+
+    def forget(self, salt, iterations, key):
+        ident = keycache.cache_id(salt, iterations, key)
+        self._request('key_forget', id=ident)
+
+    def clear(self):
+        self._request('key_clear')
+
+    def lock(self):
+        """Tells the agent to drop every cached key and exit."""
+        self._request('lock')
+        self.close()
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+
+def connect(dbfn=None, path=None, dbpw=None):
+    """Returns an :class:`AgentClient` connected to a running agent serving
+    `dbfn`, or ``None`` if there is no such agent. Lookups are made with the
+    password `dbpw`.
+
+    """
+    path = socket_path(path)
+
+    if not os.path.exists(path):
+        return None
+
+    client = AgentClient(path, dbfn, dbpw)
+    if client.ping():
+        return client
+
+    client.close()
+    return None
+
+
+def serve(pwsafe, dbfn, dbpw, path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Serves `pwsafe`, unlocked with `dbpw`, on the agent socket until it is
+    locked or idle.
+
+    """
+    server = AgentServer(socket_path(path), pwsafe, dbfn, dbpw, idle_timeout)
+    server.serve_until_locked()
+
+
+def disable_core_dumps():
+    """Keeps the memory of this process, and the keys in it, out of core
+    files.
+
+    """
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+def connect_key_cache(path=None):
+    """Returns an :class:`AgentKeyCache` connected to a running key cache
+    agent, or ``None`` if there is none.
+
+    """
+    path = keycache_socket_path(path)
+
+    if not (os.path.exists(path) and AgentClient.ping_path(path)):
+        return None
+
+    return AgentKeyCache(path)
+
+
+def serve_key_cache(path=None, ttl=keycache.DEFAULT_TTL,
+                    idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Serves a key cache on the key cache socket until it is locked or
+    idle.
+
+    """
+    server = KeyCacheServer(keycache_socket_path(path), ttl, idle_timeout)
+    server.serve_until_locked()
@@ -0,0 +1,456 @@
+"""Audits the passwords of a database for reuse, age and policy violations in
+a single pass over its records.
+
+Reuse is found by bucketing a keyed hash of every current password (0x06)
+and every password in the password histories (0x0f), so the cost is linear in
+the number of passwords rather than quadratic in the number of records. The
+hash key is random and lives only as long as the :class:`Auditor`, and
+passwords are hashed in batches which are discarded as soon as they have been
+hashed; only the hashes are kept until the end of the pass.
+
+Findings are dictionaries which can be written out as JSON:
+
+* ``{"type": "stale", "record": ..., "modified": ..., "age_days": ...}``
+* ``{"type": "policy", "record": ..., "policy": ..., "violations": [...]}``
+* ``{"type": "reuse", "records": [{..., "field": "password"}, ...]}``
+* ``{"type": "summary", "records": ..., "stale": ..., "policy": ...,
+  "reuse": ...}``
+
+Example:
+    >>> for finding in audit.audit_file(dbfn, dbpw):
+    ...     print json.dumps(finding)
+
+"""
+# builtin
+import os
+import hmac
+import time
+import hashlib
+import binascii
+import collections
+
+# internal
+from . import db, instrument, query
+from .db import PWSafeV3Header, PWSafeV3Record
+
+
+DEFAULT_MAX_AGE = 365  # days
+BATCH_SIZE = 512  # passwords hashed at a time
+DIGEST_SIZE = 16  # bytes of each keyed hash kept for bucketing
+
+# Password policy flags
+USE_LOWERCASE = 0x8000
+USE_UPPERCASE = 0x4000
+USE_DIGITS = 0x2000
+USE_SYMBOLS = 0x1000
+USE_HEX_DIGITS = 0x0800
+
+HEX_DIGITS = frozenset(u"0123456789abcdefABCDEF")
+
+
+def _text(value):
+    if value is None:
+        return None
+    return value.decode('utf-8', 'replace')
+
+
+def _field_text(record, ftype):
+    field = record[ftype]
+    return None if field is None else _text(field.value)
+
+
+class Policy(object):
+    """A Password Safe password policy.
+
+    Attributes:
+        name: The policy name, or None for a record's own policy.
+        flags: The ``USE_*`` flags.
+        length: The password length.
+        lowercase: The minimum number of lowercase letters.
+        uppercase: The minimum number of uppercase letters.
+        digits: The minimum number of digits.
+        symbols: The minimum number of symbols.
+        allowed_symbols: The symbols allowed in passwords, or None for any.
+
+    """
+    __slots__ = (
+        'name', 'flags', 'length', 'lowercase', 'uppercase', 'digits',
+        'symbols', 'allowed_symbols'
+    )
+
+    # Size of the "ffffnnnllluuudddsss" policy string.
+    SIZE = 19
+
+    def __init__(self, flags, length, lowercase=0, uppercase=0, digits=0,
+                 symbols=0, allowed_symbols=None, name=None):
+        self.name = name
+        self.flags = flags
+        self.length = length
+        self.lowercase = lowercase
+        self.uppercase = uppercase
+        self.digits = digits
+        self.symbols = symbols
+        self.allowed_symbols = allowed_symbols
+
+    @classmethod
+    def parse(cls, text, allowed_symbols=None, name=None):
+        """Parses a ``ffffnnnllluuudddsss`` policy string.
+
+        Raises:
+            ValueError: If `text` is not a policy.
+
+        """
+        if len(text) < cls.SIZE:
+            raise ValueError("Truncated password policy")
+
+        values = [int(text[0:4], 16)]
+        values.extend(int(text[i:i + 3], 16) for i in xrange(4, cls.SIZE, 3))
+
+        return cls(*values, allowed_symbols=allowed_symbols or None,
+                   name=name)
+
+    def violations(self, password):
+        """Returns a list describing each way in which the unicode string
+        `password` violates the policy.
+
+        """
+        flags = self.flags
+        found = []
+
+        if len(password) < self.length:
+            found.append("shorter than %d characters" % self.length)
+
+        if flags & USE_HEX_DIGITS:
+            if any(c not in HEX_DIGITS for c in password):
+                found.append("contains non-hexadecimal characters")
+            return found
+
+        counts = collections.Counter()
+        other = set()
+
+        for c in password:
+            if c.islower():
+                counts['lowercase'] += 1
+            elif c.isupper():
+                counts['uppercase'] += 1
+            elif c.isdigit():
+                counts['digits'] += 1
+            else:
+                counts['symbols'] += 1
+                other.add(c)
+
+        classes = (
+            ('lowercase', USE_LOWERCASE, self.lowercase),
+            ('uppercase', USE_UPPERCASE, self.uppercase),
+            ('digits', USE_DIGITS, self.digits),
+            ('symbols', USE_SYMBOLS, self.symbols),
+        )
+
+        for name, flag, minimum in classes:
+            if not flags & flag:
+                if counts[name]:
+                    found.append("contains %s" % name)
+            elif counts[name] < minimum:
+                found.append("fewer than %d %s" % (minimum, name))
+
+        allowed = self.allowed_symbols
+        if allowed is not None and flags & USE_SYMBOLS:
+            if other - set(allowed):
+                found.append("contains symbols outside the allowed set")
+
+        return found
+
+
+def parse_named_policies(text):
+    """Parses the Named Password Policies header field (0x10) and returns a
+    dictionary of :class:`Policy` instances keyed by name.
+
+    Malformed fields yield the policies parsed before the error.
+
+    """
+    policies = {}
+
+    try:
+        count, pos = int(text[0:2], 16), 2
+
+        for _ in xrange(count):
+            size = int(text[pos:pos + 2], 16)
+            name = text[pos + 2:pos + 2 + size]
+            pos += 2 + size
+
+            policy = text[pos:pos + Policy.SIZE]
+            pos += Policy.SIZE
+
+            size = int(text[pos:pos + 2], 16)
+            symbols = text[pos + 2:pos + 2 + size]
+            pos += 2 + size
+
+            policies[name] = Policy.parse(policy, symbols, name)
+    except ValueError:
+        pass
+
+    return policies
+
+
+def parse_history(text):
+    """Parses a password history field (0x0f) and returns its passwords as
+    unicode strings, oldest first. Malformed fields yield the passwords
+    parsed before the error.
+
+    """
+    passwords = []
+
+    try:
+        count, pos = int(text[3:5], 16), 5
+
+        for _ in xrange(count):
+            # 8 hex digit time_t, then a 4 hex digit length in characters.
+            size = int(text[pos + 8:pos + 12], 16)
+            password = text[pos + 12:pos + 12 + size]
+            pos += 12 + size
+
+            if len(password) != size:
+                break
+            passwords.append(password)
+    except ValueError:
+        pass
+
+    return passwords
+
+
+def header_policies(header):
+    """Returns the named password policies of the database `header`."""
+    if header is None:
+        return {}
+
+    field = header[PWSafeV3Header.TYPE_NAMED_PASSWORD_POLICIES]
+
+    if field is None:
+        return {}
+
+    return parse_named_policies(_text(field.value))
+
+
+def record_ref(record):
+    """Returns a JSON serializable dictionary identifying `record`."""
+    uuid = record[PWSafeV3Record.TYPE_UUID]
+
+    return {
+        'title': _field_text(record, PWSafeV3Record.TYPE_TITLE),
+        'group': _field_text(record, PWSafeV3Record.TYPE_GROUP),
+        'uuid': binascii.hexlify(uuid.value) if uuid is not None else None,
+    }
+
+
+class Auditor(object):
+    """Audits records one at a time. Call :meth:`check` with every record
+    and then :meth:`finish` once.
+
+    Args:
+        policies: The named password policies of the database. See
+            :func:`header_policies`.
+        max_age: Passwords last changed more than this many days ago are
+            reported as stale. None disables the check.
+        now: The time ages are measured at. Defaults to the current time.
+        history: False to ignore password histories when looking for reuse.
+        batch_size: The number of passwords hashed at a time.
+
+    """
+    def __init__(self, policies=None, max_age=DEFAULT_MAX_AGE, now=None,
+                 history=True, batch_size=BATCH_SIZE):
+        self.policies = policies or {}
+        self.max_age = max_age
+        self.now = int(time.time() if now is None else now)
+        self.history = history
+        self.batch_size = batch_size
+        self.counts = collections.Counter()
+        self._mac = hmac.new(os.urandom(32), digestmod=hashlib.sha256)
+        self._batch = []  # (ref, field, password) waiting to be hashed
+        self._refs = []  # record number -> record_ref()
+        self._buckets = collections.defaultdict(list)  # digest -> [(ref, field)]
+
+    def _queue(self, ref, field, password):
+        if not password:
+            return
+
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+
+        self._batch.append((ref, field, password))
+
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        mac, buckets = self._mac, self._buckets
+
+        for ref, field, password in self._batch:
+            h = mac.copy()
+            h.update(password)
+            buckets[h.digest()[:DIGEST_SIZE]].append((ref, field))
+
+        instrument.get().count('passwords_hashed', len(self._batch))
+        del self._batch[:]
+
+    def _policy(self, record):
+        name = _field_text(record, PWSafeV3Record.TYPE_POLICY_NAME)
+
+        if name is not None:
+            return name, self.policies.get(name)
+
+        field = record[PWSafeV3Record.TYPE_PASSWORD_POLICY]
+
+        if field is None:
+            return None, None
+
+        symbols = _field_text(record, PWSafeV3Record.TYPE_OWN_SYMBOLS)
+
+        try:
+            return None, Policy.parse(_text(field.value), symbols)
+        except ValueError:
+            return None, None
+
+    def _check_age(self, record, ref):
+        for ftype in (PWSafeV3Record.TYPE_PMTIME, PWSafeV3Record.TYPE_CTIME):
+            field = record[ftype]
+            if field is not None:
+                break
+        else:
+            return None
+
+        modified = query.decode(query.KIND_TIME, field.value)
+
+        if modified is None:
+            return None
+
+        age = (self.now - modified) // 86400
+
+        if age <= self.max_age:
+            return None
+
+        self.counts['stale'] += 1
+        return {'type': 'stale', 'record': ref, 'modified': modified,
+                'age_days': age}
+
+    def _check_policy(self, record, ref, password):
+        name, policy = self._policy(record)
+
+        if name is not None and policy is None:
+            violations = ["unknown policy"]
+        elif policy is None:
+            return None
+        else:
+            violations = policy.violations(_text(password))
+
+        if not violations:
+            return None
+
+        self.counts['policy'] += 1
+        return {'type': 'policy', 'record': ref, 'policy': name,
+                'violations': violations}
+
+    def check(self, record):
+        """Audits `record` and returns a list of its stale and policy
+        findings. Its passwords are hashed for :meth:`finish`.
+
+        """
+        ref = record_ref(record)
+        number = len(self._refs)
+        findings = []
+
+        self._refs.append(ref)
+        self.counts['records'] += 1
+
+        if self.max_age is not None:
+            findings.append(self._check_age(record, ref))
+
+        field = record[PWSafeV3Record.TYPE_PASSWORD]
+
+        if field is not None:
+            findings.append(self._check_policy(record, ref, field.value))
+            self._queue(number, 'password', field.value)
+
+        history = _field_text(record, PWSafeV3Record.TYPE_PASSWORD_HISTORY)
+
+        if self.history and history is not None:
+            for password in parse_history(history):
+                self._queue(number, 'history', password)
+
+        return [x for x in findings if x is not None]
+
+    def finish(self):
+        """Hashes the remaining passwords and yields a finding for every
+        password used by more than one record, or used again by the record
+        which had it before, followed by the summary.
+
+        """
+        self._flush()
+        refs = self._refs
+
+        for entries in self._buckets.itervalues():
+            if len(entries) < 2:
+                continue
+
+            entries = sorted(set(entries))
+            if len(set(x[0] for x in entries)) < 2:
+                # One record: only reuse if its current password is in its
+                # own history.
+                if len(set(x[1] for x in entries)) < 2:
+                    continue
+
+            self.counts['reuse'] += 1
+            yield {
+                'type': 'reuse',
+                'records': [dict(refs[i], field=f) for i, f in entries],
+            }
+
+        self._buckets.clear()
+
+        yield {
+            'type': 'summary',
+            'records': self.counts['records'],
+            'stale': self.counts['stale'],
+            'policy': self.counts['policy'],
+            'reuse': self.counts['reuse'],
+        }
+
+
+def audit(pwsafe, **kwargs):
+    """Yields the findings for the records of the parsed database `pwsafe`.
+    Keyword arguments are passed to :class:`Auditor`.
+
+    """
+    auditor = Auditor(header_policies(pwsafe.header), **kwargs)
+
+    for record in pwsafe.records:
+        for finding in auditor.check(record):
+            yield finding
+
+    for finding in auditor.finish():
+        yield finding
+
+
+def audit_file(dbfn, dbpw, **kwargs):
+    """Yields the findings for the database file `dbfn` while its records
+    are decrypted, so that only one chunk of records is in memory at a time.
+    See :meth:`.PWSafeDB.iter_parse`. Keyword arguments are passed to
+    :class:`Auditor`.
+
+    """
+    pwsafe = db.PWSafeDB()
+    auditor = None
+
+    with open(dbfn, 'rb') as database:
+        for record in pwsafe.iter_parse(database, dbpw):
+            if auditor is None:
+                policies = header_policies(pwsafe.header)
+                auditor = Auditor(policies, **kwargs)
+
+            for finding in auditor.check(record):
+                yield finding
+
+    if auditor is None:
+        auditor = Auditor(header_policies(pwsafe.header), **kwargs)
+
+    for finding in auditor.finish():
+        yield finding
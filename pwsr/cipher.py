@@ -0,0 +1,485 @@
+"""Twofish cipher backends.
+
+A backend performs bulk ECB and CBC encryption and decryption over buffers
+and caches initialized cipher contexts per ``(key, mode)``, so repeated
+operations with the same key (such as decrypting B1..B4 with P') only run
+the Twofish key schedule once.
+
+CBC decryption can also be spread over a pool of worker processes (see
+:meth:`TwofishBackend.cbc_decrypt_parallel`): each plaintext block depends
+only on its own ciphertext block and the one before it, so the ciphertext can
+be split on block boundaries and each chunk decrypted with the last block of
+the preceding chunk as its IV. Whether that pays off depends on the
+machine, so each backend measures its own crossover once per process (see
+:meth:`TwofishBackend.calibrate`).
+
+"""
+# builtin
+import os
+import time
+import atexit
+import struct
+import binascii
+import collections
+import multiprocessing
+
+# internal
+from . import errors, twofish
+
+
+BLOCK_SIZE = 16   # 16 Byte blocks for Twofish
+MODE_CBC = 'cbc'  # Cipher Block Chaining
+MODE_ECB = 'ecb'  # Electronic Code Book
+
+CACHE_SIZE = 8  # initialized contexts kept per backend
+
+CALIBRATION_REPEAT = 2  # timed runs per path; the fastest is kept
+
+# Known-answer vector from the Twofish paper: a 256 bit zero key encrypting a
+# zero block.
+_CHECK_KEY = "\x00" * 32
+_CHECK_PLAINTEXT = "\x00" * BLOCK_SIZE
+_CHECK_CIPHERTEXT = binascii.unhexlify("57ff739d4dc92c1bd7fc01700cc8216f")
+
+_backends = collections.OrderedDict()
+_default = None
+
+_pool = None  # worker processes for cbc_decrypt_parallel()
+_pool_size = 0
+
+
+def xor(a, b):
+    """Returns the bytewise XOR of the equal length strings `a` and `b`."""
+    if not a:
+        return ""
+
+    x = int(binascii.hexlify(a), 16) ^ int(binascii.hexlify(b), 16)
+    return binascii.unhexlify("%0*x" % (2 * len(a), x))
+
+
+def _check_length(data):
+    if len(data) % BLOCK_SIZE:
+        error = "Data must be a multiple of %d bytes" % BLOCK_SIZE
+        raise ValueError(error)
+
+
+def cpu_count():
+    """Returns the number of CPUs, or 1 if it cannot be determined."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _get_pool(processes):
+    global _pool, _pool_size
+
+    if _pool is None or _pool_size != processes:
+        close_pool()
+        _pool = multiprocessing.Pool(processes)
+        _pool_size = processes
+
+    return _pool
+
+
+def close_pool():
+    """Stops the worker processes used for parallel decryption, if any."""
+    global _pool, _pool_size
+
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+
+    _pool, _pool_size = None, 0
+
+
+atexit.register(close_pool)
+
+
+def _fastest(func, *args):
+    best = None
+
+    for _ in xrange(CALIBRATION_REPEAT):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def _cbc_decrypt_chunk(args):
+    name, key, iv, data = args
+    return get_backend(name).cbc_decrypt(key, iv, data)
+
+
+class TwofishBackend(object):
+    """Base class for Twofish backends.
+
+    Subclasses implement :meth:`_new_context` and the four bulk operations.
+    Contexts are looked up through :meth:`context`, which keeps the most
+    recently used ones in a small LRU cache.
+
+    Attributes:
+        calibration_size: The ciphertext size, in bytes, timed by
+            :meth:`calibrate`. Smaller ciphertexts are always decrypted
+            serially, so that small databases never start the worker pool.
+        parallel_threshold: The smallest CBC ciphertext, in bytes, which
+            :meth:`use_parallel` decrypts in parallel. None until
+            :meth:`calibrate` measures it, which :meth:`use_parallel` does
+            on first need. Set it to skip the measurement; parallel
+            decryption can also be forced either way per database with
+            ``PWSafeDB.parallel_decrypt``.
+
+    """
+    name = None
+    calibration_size = 64 * 1024
+    parallel_threshold = None
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self._contexts = collections.OrderedDict()
+
+    def _new_context(self, key, mode):
+        raise NotImplementedError()
+
+    def context(self, key, mode):
+        """Returns the cached context for `key` and `mode`, creating it (and
+        running the key schedule) on first use.
+
+        """
+        cachekey = (key, mode)
+
+        try:
+            ctx = self._contexts.pop(cachekey)
+        except KeyError:
+            ctx = self._new_context(key, mode)
+
+            if len(self._contexts) >= self.cache_size:
+                self._contexts.popitem(last=False)
+
+        self._contexts[cachekey] = ctx
+        return ctx
+
+    def clear(self):
+        """Drops every cached context and the keys they hold."""
+        self._contexts.clear()
+
+    def ecb_encrypt(self, key, data):
+        raise NotImplementedError()
+
+    def ecb_decrypt(self, key, data):
+        raise NotImplementedError()
+
+    def cbc_encrypt(self, key, iv, data):
+        raise NotImplementedError()
+
+    def cbc_decrypt(self, key, iv, data):
+        raise NotImplementedError()
+
+    def encrypt(self, data, key, iv=None, mode=MODE_ECB):
+        """Encrypts `data` with `key` in `mode`. `iv` is required for
+        ``MODE_CBC``.
+
+        """
+        if mode == MODE_CBC:
+            return self.cbc_encrypt(key, iv, data)
+        return self.ecb_encrypt(key, data)
+
+    def decrypt(self, data, key, iv=None, mode=MODE_ECB):
+        """Decrypts `data` with `key` in `mode`. `iv` is required for
+        ``MODE_CBC``.
+
+        """
+        if mode == MODE_CBC:
+            return self.cbc_decrypt(key, iv, data)
+        return self.ecb_decrypt(key, data)
+
+    def use_parallel(self, size):
+        """Returns True if a CBC ciphertext of `size` bytes should be
+        decrypted with :meth:`cbc_decrypt_parallel`. The backend is
+        calibrated the first time a ciphertext of at least
+        ``calibration_size`` bytes is seen on a machine with several CPUs.
+
+        """
+        if size < self.calibration_size or cpu_count() < 2 or \
+                multiprocessing.current_process().daemon:
+            return False
+
+        threshold = self.parallel_threshold
+        if threshold is None:
+            threshold = self.calibrate()
+
+        return size >= threshold
+
+    def calibrate(self, processes=None):
+        """Times :meth:`cbc_decrypt` against :meth:`cbc_decrypt_parallel` on
+        ``calibration_size`` bytes and sets ``parallel_threshold`` to the
+        size from which the parallel path is expected to be faster.
+
+        Serial decryption is taken to be linear in the size, and parallel
+        decryption to cost a fixed overhead (dispatching the chunks and
+        collecting the results) plus the serial time divided among the
+        workers. The worker pool is started, and the key schedule run in
+        each worker, before timing, as both are kept across calls.
+
+        Args:
+            processes: The number of worker processes. Defaults to the
+                number of CPUs.
+
+        Returns:
+            The new ``parallel_threshold``.
+
+        """
+        processes = processes or cpu_count()
+        data = os.urandom(self.calibration_size)
+        key, iv = os.urandom(32), data[:BLOCK_SIZE]
+
+        self.cbc_decrypt(key, iv, data[:BLOCK_SIZE])
+        self.cbc_decrypt_parallel(key, iv, data[:processes * BLOCK_SIZE],
+                                  processes)
+
+        serial = _fastest(self.cbc_decrypt, key, iv, data)
+        parallel = _fastest(self.cbc_decrypt_parallel, key, iv, data,
+                            processes)
+
+        # parallel = overhead + serial / processes, and the parallel path
+        # wins once the time saved on the data exceeds the overhead.
+        overhead = parallel - serial / processes
+        saved = serial * (1 - 1.0 / max(processes, 2)) / len(data)
+
+        if overhead <= 0:
+            threshold = len(data)
+        else:
+            threshold = max(len(data), int(overhead / saved))
+            threshold += -threshold % BLOCK_SIZE
+
+        self.parallel_threshold = threshold
+        return threshold
+
+    def cbc_decrypt_parallel(self, key, iv, data, processes=None):
+        """Like :meth:`cbc_decrypt`, but splits `data` into one chunk per
+        worker process and decrypts the chunks concurrently.
+
+        The worker pool is started on first use and kept until
+        :func:`close_pool` is called or the interpreter exits. Data is
+        decrypted in this process when there is a single CPU, or when this
+        process is itself a pool worker and cannot start one.
+
+        Args:
+            key: The key.
+            iv: The IV of the first block.
+            data: The ciphertext: a string, or a ``buffer`` over a
+                memory-mapped file so that it is not copied before being
+                split.
+            processes: The number of worker processes. Defaults to the
+                number of CPUs.
+
+        """
+        _check_length(data)
+
+        processes = processes or cpu_count()
+        blocks = len(data) // BLOCK_SIZE
+        size = max(1, -(-blocks // processes)) * BLOCK_SIZE
+
+        if processes < 2 or blocks < 2 or \
+                multiprocessing.current_process().daemon:
+            return self.cbc_decrypt(key, iv, data[:])
+
+        tasks = []
+
+        for offset in xrange(0, len(data), size):
+            if offset:
+                iv = data[offset - BLOCK_SIZE:offset]
+            tasks.append((self.name, key, iv, data[offset:offset + size]))
+
+        # Chunks come back in order and are joined with a single copy.
+        chunks = _get_pool(processes).map(_cbc_decrypt_chunk, tasks, 1)
+        return "".join(chunks)
+
+
+class MCryptBackend(TwofishBackend):
+    """Twofish through libmcrypt.
+
+    libmcrypt can only set a CBC IV by re-initializing the context, so CBC
+    contexts are cached to avoid reopening the mcrypt module but are
+    re-initialized with the IV of each call.
+
+    """
+    name = 'mcrypt'
+    calibration_size = 4 * 1024 * 1024
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        super(MCryptBackend, self).__init__(cache_size)
+
+        try:
+            import mcrypt
+        except ImportError:
+            raise
+        except Exception as ex:
+            # A binding which is present but broken, such as one built
+            # against another libmcrypt.
+            error = "Cipher backend 'mcrypt' failed: {0}".format(ex)
+            raise errors.CipherBackendError(error)
+
+        self._mcrypt = mcrypt
+
+    def _new_context(self, key, mode):
+        ctx = self._mcrypt.MCRYPT('twofish', mode)
+
+        if mode == MODE_ECB:
+            ctx.init(key)
+
+        return ctx
+
+    def ecb_encrypt(self, key, data):
+        return self.context(key, MODE_ECB).encrypt(data)
+
+    def ecb_decrypt(self, key, data):
+        return self.context(key, MODE_ECB).decrypt(data)
+
+    def cbc_encrypt(self, key, iv, data):
+        ctx = self.context(key, MODE_CBC)
+        ctx.init(key, iv)
+        return ctx.encrypt(data)
+
+    def cbc_decrypt(self, key, iv, data):
+        ctx = self.context(key, MODE_CBC)
+        ctx.init(key, iv)
+        return ctx.decrypt(data)
+
+
+class PythonBackend(TwofishBackend):
+    """Twofish implemented in pure Python by :mod:`pwsr.twofish`.
+
+    A single context per key serves both modes: CBC decryption is an ECB
+    decryption of the whole buffer XORed with the buffer shifted by one
+    block, and CBC encryption chains the block function directly.
+
+    """
+    name = 'python'
+    def _new_context(self, key, mode):
+        return twofish.Twofish(key)
+
+    def ecb_encrypt(self, key, data):
+        return self.context(key, MODE_ECB).encrypt(data)
+
+    def ecb_decrypt(self, key, data):
+        return self.context(key, MODE_ECB).decrypt(data)
+
+    def cbc_encrypt(self, key, iv, data):
+        _check_length(data)
+
+        encrypt_block = self.context(key, MODE_ECB).encrypt_block
+        unpack_from, pack_into = struct.unpack_from, struct.pack_into
+
+        out = bytearray(len(data))
+        a, b, c, d = struct.unpack("<4L", iv)
+
+        for offset in xrange(0, len(data), BLOCK_SIZE):
+            w0, w1, w2, w3 = unpack_from("<4L", data, offset)
+            a, b, c, d = encrypt_block(a ^ w0, b ^ w1, c ^ w2, d ^ w3)
+            pack_into("<4L", out, offset, a, b, c, d)
+
+        return str(out)
+
+    def cbc_decrypt(self, key, iv, data):
+        _check_length(data)
+
+        plaintext = self.ecb_decrypt(key, data)
+        return xor(plaintext, iv + data[:-BLOCK_SIZE])
+
+
+def register_backend(backend, verify=True):
+    """Registers the ``TwofishBackend`` instance `backend`. Backends
+    registered later take priority when no backend is requested by name.
+
+    Raises:
+        .CipherBackendError: If `verify` is True and `backend` fails the
+            Twofish known-answer test.
+
+    """
+    if verify:
+        _verify(backend)
+
+    _backends[backend.name] = backend
+
+
+def _verify(backend):
+    # With a zero IV, CBC over a single block is the same as ECB, so both
+    # modes are checked against the same vector.
+    iv = "\x00" * BLOCK_SIZE
+
+    try:
+        results = (
+            backend.ecb_encrypt(_CHECK_KEY, _CHECK_PLAINTEXT),
+            backend.ecb_decrypt(_CHECK_KEY, _CHECK_CIPHERTEXT),
+            backend.cbc_encrypt(_CHECK_KEY, iv, _CHECK_PLAINTEXT),
+            backend.cbc_decrypt(_CHECK_KEY, iv, _CHECK_CIPHERTEXT),
+        )
+    except Exception as ex:
+        error = "Cipher backend '{0}' failed: {1}".format(backend.name, ex)
+        raise errors.CipherBackendError(error)
+    finally:
+        backend.clear()
+
+    expected = (_CHECK_CIPHERTEXT, _CHECK_PLAINTEXT) * 2
+
+    if results != expected:
+        error = "Cipher backend '{0}' failed the known-answer test"
+        raise errors.CipherBackendError(error.format(backend.name))
+
+
+def set_default(name):
+    """Sets the backend returned by :func:`get_backend` when none is named.
+    Pass ``None`` to go back to the highest priority registered backend.
+
+    """
+    global _default
+
+    if name is not None:
+        get_backend(name)
+
+    _default = name
+
+
+def get_backend(name=None):
+    """Returns the backend registered as `name`, or the default backend.
+
+    Raises:
+        .CipherBackendError: If there is no backend named `name`.
+
+    """
+    name = name or _default
+
+    if name is None:
+        return next(reversed(_backends.values()))
+
+    try:
+        return _backends[name]
+    except KeyError:
+        error = "No cipher backend named '{0}'".format(name)
+        raise errors.CipherBackendError(error)
+
+
+def backends():
+    """Returns the names of the registered backends, highest priority last."""
+    return list(_backends)
+
+
+def clear():
+    """Drops the cached contexts of every registered backend."""
+    for backend in _backends.itervalues():
+        backend.clear()
+
+
+register_backend(PythonBackend())
+
+# libmcrypt, if its Python binding is installed and works. Otherwise the
+# Python backend stays the default.
+try:
+    register_backend(MCryptBackend())
+except (ImportError, errors.CipherBackendError):
+    pass
@@ -1,28 +1,275 @@
 # builtin
 import os
+import csv
+import json
+import mmap
+import array
 import collections
+import contextlib
 import hashlib
 import struct
 import hmac
-
-# external
-import mcrypt
+import StringIO
 
 # internal
-from . import errors, utils
+from . import cipher, errors, index, instrument, keycache, query, stretch
+from . import utils
+from .cipher import BLOCK_SIZE, MODE_CBC, MODE_ECB
 
 
 __builtin_type = type
 
-BLOCK_SIZE = 16   # 16 Byte blocks for Twofish
-MODE_CBC = 'cbc'  # Cipher Block Chaining
-MODE_ECB = 'ecb'  # Electronic Code Book
-
 TYPE_END = 0xff
 
+VERIFY_LAZY = 'lazy'  # compute the HMAC while parsing, check it on demand
+
+CHUNK_SIZE = 64 * 1024  # bytes of ciphertext decrypted at a time when streaming
+
+CHECKPOINT_INTERVAL = 256  # records between saved HMAC states
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_CSV = 'csv'
+EXPORT_FORMATS = (FORMAT_JSONL, FORMAT_CSV)
+
+# Fields exported unless others are requested. See query.FIELDS.
+EXPORT_FIELDS = ('group', 'title', 'username', 'password', 'url', 'notes')
+
+# Fields replaced by REDACTED when exporting with redact=True.
+REDACTED_FIELDS = ('password', 'history')
+REDACTED = "*" * 8
+
+EXPORT_BUFFER_SIZE = 64 * 1024  # bytes of output written at a time
+
+
+def _field_size(value_len):
+    """Returns the number of bytes a field with a `value_len` byte value
+    occupies in the data section, which is a multiple of `BLOCK_SIZE`.
+
+    """
+    length = PwSafeV3Field.HEADER_SIZE + value_len
+
+    if length < BLOCK_SIZE:
+        return BLOCK_SIZE
+
+    q, r = divmod(length, BLOCK_SIZE)
+    if r: q += 1
+
+    return BLOCK_SIZE * q
+
+
+def _raw_fields(fields):
+    """Returns the ``(type, value)`` pairs of `fields` in serialization
+    order: the ``TYPE_END`` field is moved last, and added if it is missing.
+    Text values given as ``unicode`` are UTF-8 encoded.
+
+    """
+    raw = []
+
+    for field in fields:
+        if field.type == TYPE_END:
+            continue
+
+        value = field.value
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        raw.append((field.type, value))
+
+    raw.append((TYPE_END, ""))
+    return raw
+
+
+class PwSafeV3FieldReader(object):
+    """Reads consecutive Password Safe v3 fields out of a decrypted data
+    section in a single linear pass.
+
+    Field headers are unpacked in place with ``struct.unpack_from`` and only
+    field values are copied out of the underlying buffer, so walking the
+    data section never copies the unread tail. Buffers are read through a
+    ``memoryview`` without being copied; only file-like objects are read
+    into memory.
+
+    Args:
+        data: A buffer (``str``, ``bytearray``, ``mmap``) or a file-like
+            object containing Password Safe v3 fields.
+        offset: The offset of the first field in `data`.
+        mac: An optional ``hmac.HMAC`` object which is updated with the
+            value of every field as it is read.
+
+    Attributes:
+        data: The underlying buffer.
+        offset: The offset of the next field to be read.
+
+    """
+    def __init__(self, data, offset=0, mac=None):
+        if isinstance(data, mmap.mmap):
+            # mmap only has the old buffer interface in Python 2, but slices
+            # and unpacks in place just the same.
+            view = data
+        else:
+            try:
+                view = memoryview(data)
+            except TypeError:
+                data = utils.bindata(utils.ioslice(data, 0))
+                view = memoryview(data)
+
+        self.data = data
+        self.view = view
+        self.offset = offset
+        self.mac = mac
+
+    @classmethod
+    def wrap(cls, data, offset=0):
+        """Returns `data` if it is already a ``PwSafeV3FieldReader``,
+        otherwise a new reader over `data` starting at `offset`.
+
+        """
+        if isinstance(data, cls):
+            return data
+        return cls(data, offset)
+
+    @property
+    def eof(self):
+        """True if there are no more fields to be read."""
+        return self.offset >= len(self.view)
+
+    def read_raw(self):
+        """Reads the next field header and advances past the field.
+
+        Returns:
+            A ``(type, value_offset, value_len)`` tuple describing where the
+            value of the field lives in the underlying buffer.
+
+        Raises:
+            .IntegrityError: If the field runs past the end of the buffer.
+
+        """
+        view, offset = self.view, self.offset
+        start = offset + PwSafeV3Field.HEADER_SIZE
+
+        if start > len(view):
+            raise errors.IntegrityError("Truncated field at %d" % offset)
+
+        value_len, ftype = struct.unpack_from("<lB", view, offset)
+        end = offset + _field_size(value_len)
+
+        if value_len < 0 or end > len(view):
+            raise errors.IntegrityError("Truncated field at %d" % offset)
+
+        if self.mac is not None:
+            self.mac.update(view[start:start + value_len])
+
+        self.offset = end
+        return ftype, start, value_len
+
+    def read(self):
+        """Reads the next field and returns it as a ``PwSafeV3Field``."""
+        ftype, start, length = self.read_raw()
+
+        return PwSafeV3Field(ftype, bytes(self.data[start:start + length]))
+
+    def peek_entry(self):
+        """Returns the size in bytes of the entry (the fields up to and
+        including the next ``TYPE_END`` field) starting at ``self.offset``,
+        or ``None`` if the buffer ends before the entry does.
+
+        """
+        view, end = self.view, len(self.view)
+        offset = self.offset
+
+        while offset + PwSafeV3Field.HEADER_SIZE <= end:
+            value_len, ftype = struct.unpack_from("<lB", view, offset)
+            offset += _field_size(value_len)
+
+            if offset > end:
+                break
+            if ftype == TYPE_END:
+                return offset - self.offset
+
+        return None
+
+    def iter_entry(self):
+        """Yields ``PwSafeV3Field`` instances up to and including the next
+        ``TYPE_END`` field.
+
+        """
+        ftype = None
+
+        while ftype != TYPE_END:
+            field = self.read()
+            ftype = field.type
+            yield field
+
+
+class PwSafeV3FieldWriter(object):
+    """Serializes Password Safe v3 fields into a single preallocated buffer.
+
+    Padding for every field is sliced out of one block of random bytes
+    requested up front, and the optional `mac` is updated with each value
+    as it is written.
+
+    Args:
+        size: The total size of the serialized fields.
+        padding: The total number of padding bytes the fields need.
+        mac: An optional ``hmac.HMAC`` object.
+
+    Attributes:
+        buf: The output ``bytearray``.
+        offset: The offset the next field will be written at.
+
+    """
+    def __init__(self, size, padding, mac=None):
+        self.buf = bytearray(size)
+        self.offset = 0
+        self.mac = mac
+        self._padding = memoryview(os.urandom(padding))
+        self._padoffset = 0
+
+    def write(self, ftype, value):
+        """Writes a field of type `ftype` with the value `value`."""
+        buf, offset = self.buf, self.offset
+        length = len(value)
+        start = offset + PwSafeV3Field.HEADER_SIZE
+        end = offset + _field_size(length)
+        padlen = end - start - length
+
+        struct.pack_into("<lB", buf, offset, length, ftype)
+        buf[start:start + length] = value
+        buf[start + length:end] = self._padding[self._padoffset:
+                                                self._padoffset + padlen]
+
+        self._padoffset += padlen
+        self.offset = end
+
+        if self.mac is not None:
+            self.mac.update(value)
+
+    def copy_entry(self, store, entry):
+        """Copies entry number `entry` of the ``PWSafeV3RecordStore``
+        `store` verbatim, padding included.
+
+        """
+        view = memoryview(store.data)
+        begin, end = store.span(entry)
+        offset = self.offset
+
+        self.buf[offset:offset + end - begin] = view[begin:end]
+        self.offset = offset + end - begin
+
+        if self.mac is not None:
+            starts, lengths = store.starts, store.lengths
+            for i in store.fields(entry):
+                self.mac.update(view[starts[i]:starts[i] + lengths[i]])
+
+
 class PwSafeV3Field(object):
     """Defines fields and operations for a Password Safe v3 Field
 
+    Fields are immutable. To change a field of a record, assign a new field
+    to it, which marks the record as modified::
+
+        record[ftype] = PwSafeV3Field(ftype, value)
+
     Attributes:
         type: Fill Out
         value: Fill Out
@@ -30,10 +277,21 @@ class PwSafeV3Field(object):
     """
     HEADER_SIZE = 5  # 4 Bytes (data length) + 1 byte (field type)
 
-    def __init__(self):
-        self.type = 0  # field type
-        self.value = None  # field value without padding
+    __slots__ = ('type', 'value')
+
+    def __init__(self, ftype=0, value=None):
+        _set = object.__setattr__
+        _set(self, 'type', ftype)  # field type
+        _set(self, 'value', value)  # field value without padding
 
+    def __setattr__(self, name, value):
+        raise AttributeError("PwSafeV3Field objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("PwSafeV3Field objects are immutable")
+
+    def __reduce__(self):
+        return self.__class__, (self.type, self.value)
 
     @classmethod
     def parse(cls, data, offset=0):
@@ -49,14 +307,7 @@ class PwSafeV3Field(object):
             An instance of ``PwSafeV3Field``.
 
         """
-        obj = cls()
-        dataio = utils.ioslice(data, offset)
-
-        data_len = struct.unpack('<l', dataio.read(4))[0]
-        obj.type = ord(dataio.read(1))
-        obj.value = dataio.read(data_len)
-
-        return obj
+        return PwSafeV3FieldReader(data, offset).read()
 
     @property
     def padding(self):
@@ -67,7 +318,7 @@ class PwSafeV3Field(object):
             ``(len(HEADER) + len(PADDING) + len(VALUE)) % BLOCK_SIZE == 0``.
 
         """
-        bufsize = len(self) - len(self.value)
+        bufsize = len(self) - PwSafeV3Field.HEADER_SIZE - len(self.value)
         return os.urandom(bufsize)
 
     def serialize(self):
@@ -85,14 +336,15 @@ class PwSafeV3Field(object):
             Packed binary form of this Password Safe v3 Field.
 
         """
-        fmt = "<lB%ss" % (len(self))
+        fmt = "<lB%ds" % (len(self) - PwSafeV3Field.HEADER_SIZE)
         data = self.value + self.padding
-        return  struct.pack(fmt, (len(self.value), self.type, data))
+        return struct.pack(fmt, len(self.value), self.type, data)
 
     def __eq__(self, other):
         """Returns True if `self` and `other` are the same instance or if they
-        are both instances of ``PwSafeV3Field`` and have the same ``str()``
-        representation (or, ``value`` attribute.
+        are both instances of ``PwSafeV3Field`` and have the same ``type`` and
+        ``value``. Values are compared as bytes, so binary fields such as
+        UUIDs compare without being decoded.
 
         """
         if self is other:
@@ -100,7 +352,10 @@ class PwSafeV3Field(object):
         elif not (self.__class__ is other.__class__):
             return False
         else:
-            return str(self) == str(other)
+            return self.type == other.type and self.value == other.value
+
+    def __ne__(self, other):
+        return not self == other
 
     def __unicode__(self):
         return unicode(self.value)
@@ -113,16 +368,7 @@ class PwSafeV3Field(object):
         `BLOCK_SIZE`.
 
         """
-        length = PwSafeV3Field.HEADER_SIZE + len(self.value)
-
-        if length < BLOCK_SIZE:
-            return BLOCK_SIZE
-
-        q = length / BLOCK_SIZE
-        r = length % BLOCK_SIZE
-        if r: q += 1
-
-        return (BLOCK_SIZE * q)
+        return _field_size(len(self.value))
 
 
 class PWSafeV3Header(collections.MutableMapping):
@@ -174,46 +420,221 @@ class PWSafeV3Header(collections.MutableMapping):
     TYPE_END                        = 0xff
 
     def __init__(self):
-        self.__fields = {}
+        # Header fields in file order. Unlike record fields, some header
+        # fields (such as Empty Groups) may appear more than once.
+        self.__fields = []
 
     @classmethod
     def parse(cls, data, offset=0):
+        """Parses the database header from `data` at `offset`.
+
+        Args:
+            data: A ``PwSafeV3FieldReader`` or a buffer of decrypted field
+                data. When a reader is given, it is left positioned at the
+                first field following the header.
+            offset: The offset of the header in `data`. Ignored if `data` is
+                a ``PwSafeV3FieldReader``.
+
+        """
         obj = cls()
-        type = None
+        reader = PwSafeV3FieldReader.wrap(data, offset)
 
-        while type != TYPE_END:
-            field = PwSafeV3Field.parse(data, offset)
-            type = field.type
-            obj[type] = field
-            offset += len(field)
+        for field in reader.iter_entry():
+            obj.add(field)
 
         return obj
 
+    def add(self, field):
+        """Adds `field` to the header, keeping any existing fields of the same
+        type. The field is placed before the ``TYPE_END`` field, if there is
+        one.
+
+        """
+        fields = self.__fields
+
+        if fields and fields[-1].type == TYPE_END and field.type != TYPE_END:
+            fields.insert(len(fields) - 1, field)
+        else:
+            fields.append(field)
+
+    def getall(self, key):
+        """Returns every field of type `key`, in file order."""
+        return [f for f in self.__fields if f.type == key]
+
+    def fields(self):
+        """Returns every header field, in file order."""
+        return list(self.__fields)
+
+    def _raw_fields(self):
+        return _raw_fields(self.__fields)
+
     def __setitem__(self, key, value):
-        self.__fields[key] = value
+        fields = self.__fields
+        indexes = [i for i, f in enumerate(fields) if f.type == key]
+
+        if not indexes:
+            self.add(value)
+            return
+
+        fields[indexes[0]] = value
+        for i in reversed(indexes[1:]):
+            del fields[i]
 
     def __getitem__(self, item):
-        return self.__fields.get(item)
+        for field in self.__fields:
+            if field.type == item:
+                return field
+        return None
 
     def __delitem__(self, key):
-        return self.__fields.__delitem__(key)
+        fields = [f for f in self.__fields if f.type != key]
+
+        if len(fields) == len(self.__fields):
+            raise KeyError(key)
+
+        self.__fields = fields
 
     def __iter__(self):
-        return self.__fields.__iter__()
+        seen = set()
+
+        for field in self.__fields:
+            if field.type not in seen:
+                seen.add(field.type)
+                yield field.type
 
     def __len__(self):
-        return sum(len(v) for v in self.itervalues())
+        return sum(len(f) for f in self.__fields)
 
     def __unicode__(self):
-        fmt = "%s: %s"
-        s = "\n".join(fmt.format(k, str(v)) for k, v in self.iteritems())
+        fmt = "{0}: {1!r}"
+        s = "\n".join(fmt.format(f.type, f.value) for f in self.__fields)
         return unicode(s)
 
     def __str__(self):
         return unicode(self).encode('utf-8')
 
 
-class PWSafeV3Record(collections.MutableMapping):
+class PWSafeV3RecordStore(object):
+    """Compact storage for the records of a parsed data section.
+
+    The decrypted data section is kept as one contiguous buffer, and every
+    field is described by an entry in three parallel arrays holding its
+    type, the offset of its value and the length of its value. Records
+    backed by a store (see :meth:`PWSafeV3Record.from_store`) only hold a
+    reference to the store and their entry number, and build
+    ``PwSafeV3Field`` instances on access.
+
+    Attributes:
+        data: The decrypted data section.
+        types: The type of each field.
+        starts: The offset of each field value in `data`.
+        lengths: The length of each field value.
+        entries: The index of the first field of each entry, followed by the
+            total number of fields.
+
+    """
+    __slots__ = ('data', 'types', 'starts', 'lengths', 'entries')
+
+    def __init__(self, data):
+        self.data = data
+        self.types = array.array('B')
+        self.starts = array.array('L')
+        self.lengths = array.array('L')
+        self.entries = array.array('L', [0])
+
+    @classmethod
+    def parse(cls, reader, checkpoints=None):
+        """Reads every remaining entry from the ``PwSafeV3FieldReader``
+        `reader` into a new store.
+
+        Args:
+            reader: The ``PwSafeV3FieldReader`` to read from.
+            checkpoints: An optional dictionary which is filled with a copy
+                of the reader's HMAC taken before every
+                ``CHECKPOINT_INTERVAL``\ th entry, keyed by entry number.
+
+        """
+        store = cls(reader.data)
+        types, starts, lengths = store.types, store.starts, store.lengths
+        entries, read_raw = store.entries, reader.read_raw
+
+        if reader.mac is None:
+            checkpoints = None
+
+        while not reader.eof:
+            ftype = None
+
+            if checkpoints is not None:
+                entry = len(entries) - 1
+                if not entry % CHECKPOINT_INTERVAL:
+                    checkpoints[entry] = reader.mac.copy()
+
+            while ftype != TYPE_END:
+                ftype, start, length = read_raw()
+                types.append(ftype)
+                starts.append(start)
+                lengths.append(length)
+
+            entries.append(len(types))
+
+        return store
+
+    def fields(self, entry):
+        """Returns the range of field indexes belonging to `entry`."""
+        return xrange(self.entries[entry], self.entries[entry + 1])
+
+    def find(self, entry, ftype):
+        """Returns the index of the field of type `ftype` in `entry`, or
+        ``None``.
+
+        """
+        types = self.types
+
+        for i in self.fields(entry):
+            if types[i] == ftype:
+                return i
+
+        return None
+
+    def value(self, i):
+        start = self.starts[i]
+        return self.data[start:start + self.lengths[i]]
+
+    def field(self, i):
+        """Builds a ``PwSafeV3Field`` for field `i`."""
+        return PwSafeV3Field(self.types[i], self.value(i))
+
+    def size(self, entry):
+        """Returns the number of bytes `entry` occupies in the data section."""
+        begin, end = self.span(entry)
+        return end - begin
+
+    def span(self, entry):
+        """Returns the ``(begin, end)`` byte offsets of `entry` in ``data``."""
+        first, last = self.entries[entry], self.entries[entry + 1] - 1
+        begin = self.starts[first] - PwSafeV3Field.HEADER_SIZE
+        end = self.starts[last] - PwSafeV3Field.HEADER_SIZE
+        end += _field_size(self.lengths[last])
+
+        return begin, end
+
+    def update_mac(self, mac, entry):
+        """Updates `mac` with the field values of `entry`."""
+        data, starts, lengths = self.data, self.starts, self.lengths
+
+        for i in self.fields(entry):
+            mac.update(data[starts[i]:starts[i] + lengths[i]])
+
+    def records(self, cls=None):
+        """Returns a record view for every entry in the store."""
+        cls = cls or PWSafeV3Record
+        return [cls.from_store(self, i) for i in xrange(len(self))]
+
+    def __len__(self):
+        return len(self.entries) - 1
+
+
+class PWSafeV3Record(object):
     """
     UUID                        0x01        UUID          Y              [1]
     Group                       0x02        Text          Y              [2]
@@ -241,57 +662,241 @@ class PWSafeV3Record(collections.MutableMapping):
     Password Policy Name        0x18        Text          Y              [19]
     End of Entry
     """
+    TYPE_UUID       = 0x01
     TYPE_TITLE      = 0x03
     TYPE_USERNAME   = 0x04
+    TYPE_NOTES      = 0x05
     TYPE_PASSWORD   = 0x06
     TYPE_GROUP      = 0x02
+    TYPE_URL        = 0x0d
+    TYPE_EMAIL      = 0x14
+    TYPE_CTIME      = 0x07
+    TYPE_PMTIME     = 0x08
+    TYPE_MTIME      = 0x0c
+    TYPE_PASSWORD_HISTORY   = 0x0f
+    TYPE_PASSWORD_POLICY    = 0x10
+    TYPE_OWN_SYMBOLS        = 0x16
+    TYPE_POLICY_NAME        = 0x18
+
+    # Records are either backed by a PWSafeV3RecordStore entry, or hold their
+    # fields in an ordered dictionary. A store-backed record copies its fields
+    # into a dictionary the first time it is modified. `_dirty` is set by
+    # every modification made through the mapping interface and cleared once
+    # the record has been saved. Fields are immutable, so the mapping
+    # interface is the only way to modify a record. `_owner` is the PWSafeDB
+    # the record belongs to, whose indexes are updated around every
+    # modification.
+    __slots__ = ('_fields', '_store', '_entry', '_dirty', '_owner')
 
     def __init__(self):
-        self.__fields = {}
+        self._fields = collections.OrderedDict()
+        self._store = None
+        self._entry = None
+        self._dirty = True
+        self._owner = None
+
+    @classmethod
+    def from_store(cls, store, entry):
+        """Returns a record which reads its fields from entry number `entry`
+        of the ``PWSafeV3RecordStore`` `store`.
+
+        """
+        record = cls.__new__(cls)
+        record._fields = None
+        record._store = store
+        record._entry = entry
+        record._dirty = False
+        record._owner = None
+
+        return record
 
     @classmethod
     def parse(cls, data, offset=0):
+        """Parses a single record from `data` at `offset`.
+
+        Args:
+            data: A ``PwSafeV3FieldReader`` or a buffer of decrypted field
+                data. When a reader is given, it is left positioned at the
+                first field following the record.
+            offset: The offset of the record in `data`. Ignored if `data` is
+                a ``PwSafeV3FieldReader``.
+
+        """
         record = cls()
-        rtype  = None
+        reader = PwSafeV3FieldReader.wrap(data, offset)
 
-        while rtype != TYPE_END:
-            field = PwSafeV3Field.parse(data, offset)
+        for field in reader.iter_entry():
             record[field.type] = field
-            offset += len(field)
-            rtype = field.type
 
         return record
 
+    def _raw_fields(self):
+        return _raw_fields(self.itervalues())
+
+    def _update_mac(self, mac):
+        if self._fields is None:
+            self._store.update_mac(mac, self._entry)
+        else:
+            for _, value in self._raw_fields():
+                mac.update(value)
+
+    def _modify(self):
+        self._dirty = True
+        return self._materialize()
+
+    def _edit(self, method, *args, **kwargs):
+        """Calls `method` of the field dictionary with `args` and `kwargs`.
+        The indexes of the owning database, if any, are updated around the
+        call.
+
+        """
+        fields = self._modify()
+        owner = self._owner
+
+        if owner is None:
+            return getattr(fields, method)(*args, **kwargs)
+
+        with owner.editing(self):
+            return getattr(fields, method)(*args, **kwargs)
+
+    def _materialize(self):
+        if self._fields is None:
+            store, entry = self._store, self._entry
+            self._fields = collections.OrderedDict(
+                (store.types[i], store.field(i)) for i in store.fields(entry)
+            )
+
+        return self._fields
+
+    def _required(self, ftype):
+        field = self[ftype]
+
+        if field is None:
+            raise KeyError(ftype)
+
+        return field
+
     @property
     def title(self):
-        return self.__fields[self.TYPE_TITLE]
+        return self._required(self.TYPE_TITLE)
 
     @property
     def group(self):
-        return self.__fields[self.TYPE_GROUP]
+        return self._required(self.TYPE_GROUP)
 
     @property
     def username(self):
-        return self.__fields[self.TYPE_USERNAME]
+        return self._required(self.TYPE_USERNAME)
 
     @property
     def password(self):
-        return self.__fields[self.TYPE_PASSWORD]
+        return self._required(self.TYPE_PASSWORD)
 
     def __setitem__(self, key, value):
-        self.__fields[key] = value
+        self._edit('__setitem__', key, value)
 
     def __getitem__(self, item):
-        return self.__fields.get(item)
+        if self._fields is not None:
+            return self._fields.get(item)
+
+        i = self._store.find(self._entry, item)
+        return None if i is None else self._store.field(i)
 
     def __delitem__(self, key):
-        return self.__fields.__delitem__(key)
+        self._edit('__delitem__', key)
 
     def __iter__(self):
-        return self.__fields.__iter__()
+        if self._fields is not None:
+            return iter(self._fields)
+
+        store = self._store
+        return (store.types[i] for i in store.fields(self._entry))
+
+    def __contains__(self, key):
+        if self._fields is not None:
+            return key in self._fields
+
+        return self._store.find(self._entry, key) is not None
 
     def __len__(self):
-        return sum(len(f) for f in self.itervalues())
+        if self._fields is not None:
+            return sum(len(f) for f in self._fields.itervalues())
+
+        return self._store.size(self._entry)
+
+    # The MutableMapping mixin methods. They are spelled out because the
+    # collections ABCs do not define __slots__ and would give every record a
+    # __dict__.
+
+    def get(self, key, default=None):
+        value = self[key]
+        return default if value is None else value
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield (key, self[key])
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def pop(self, key, *default):
+        return self._edit('pop', key, *default)
+
+    def popitem(self):
+        return self._edit('popitem', last=False)
+
+    def setdefault(self, key, default=None):
+        return self._edit('setdefault', key, default)
+
+    def update(self, *args, **kwargs):
+        self._edit('update', *args, **kwargs)
+
+    def clear(self):
+        self._edit('clear')
+
+    # Records compare like the MutableMapping they are registered as: equal
+    # if they hold equal fields, regardless of field order.
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return not self == other
+
+    __hash__ = None
+
+    # Pickled records carry their own fields rather than the store they were
+    # parsed into, which holds the whole data section.
+
+    def __getstate__(self):
+        fields = [(f.type, f.value) for f in self.itervalues()]
+        return fields, self._dirty
+
+    def __setstate__(self, state):
+        fields, self._dirty = state
+        self._store = None
+        self._entry = None
+        self._owner = None
+        self._fields = collections.OrderedDict(
+            (ftype, PwSafeV3Field(ftype, value)) for ftype, value in fields
+        )
 
     def __unicode__(self):
         s = "[{}] g: {} u: {} p: {}".format(
@@ -307,8 +912,12 @@ class PWSafeV3Record(collections.MutableMapping):
         return unicode(self).encode('utf=8')
 
 
+collections.MutableMapping.register(PWSafeV3Record)
+
 
 class PWSafeV3PreHeader(object):
+    TAG = "PWS3"
+
     def __init__(self):
         self.tag = None
         self.salt = None
@@ -337,6 +946,14 @@ class PWSafeV3PreHeader(object):
 
         return obj
 
+    def serialize(self):
+        """Returns the packed 152 byte preheader."""
+        return struct.pack(
+            "<4s32sl32s16s16s16s16s16s",
+            self.tag, self.salt, self.iter, self.hpp,
+            self.b1, self.b2, self.b3, self.b4, self.iv
+        )
+
     def __len__(self):
         return  (4+32+4+32+(16*4)+16)
 
@@ -347,18 +964,136 @@ class PWSafeV3PreHeader(object):
         return unicode(self).encode('utf-8')
 
 
+class PWSafeV3Layout(object):
+    """Describes the plaintext data section of a database file as it was last
+    parsed or saved, so that a later save only needs to rewrite the data
+    section from the first changed record onward.
+
+    Attributes:
+        records: The records, in file order.
+        offsets: The offset of each record in the data section.
+        end: The offset of the end of the last record.
+        header: The ``(type, value)`` pairs of the header fields.
+        checkpoints: A dictionary of HMAC states keyed by record number. Each
+            has been updated with every field value preceding that record.
+        signature: The :func:`.file_signature` of the file.
+
+    """
+    __slots__ = (
+        'records', 'offsets', 'end', 'header', 'checkpoints', 'signature'
+    )
+
+    def __init__(self, records, offsets, end, header, checkpoints=None,
+                 signature=None):
+        self.records = list(records)
+        self.offsets = array.array('L', offsets)
+        self.end = end
+        self.header = header
+        self.checkpoints = checkpoints if checkpoints is not None else {}
+        self.signature = signature
+
+    def first_changed(self, records):
+        """Returns the number of leading records of `records` which are
+        unchanged since the layout was recorded.
+
+        """
+        saved = self.records
+
+        for i, record in enumerate(records):
+            if i >= len(saved) or record is not saved[i] or record._dirty:
+                return i
+
+        return len(records)
+
+    def offset(self, i):
+        """Returns the offset of record `i`, or of the end of the records if
+        `i` is past the last record.
+
+        """
+        if i < len(self.offsets):
+            return self.offsets[i]
+        return self.end
+
+    def checkpoint(self, i):
+        """Returns the closest checkpoint at or before record `i` as a
+        ``(record number, HMAC copy)`` tuple, or ``(None, None)``.
+
+        """
+        start = max([x for x in self.checkpoints if x <= i] or [None])
+
+        if start is None:
+            return None, None
+
+        return start, self.checkpoints[start].copy()
+
+
+class RecordList(collections.Sequence):
+    """A read-only view of the records of a :class:`PWSafeDB`, in database
+    order. Records are added and removed through
+    :meth:`PWSafeDB.add_record`, :meth:`PWSafeDB.remove_record` and
+    :meth:`PWSafeDB.replace_record`, which keep the indexes of the database
+    current.
+
+    """
+    __slots__ = ('_records',)
+
+    def __init__(self, records):
+        self._records = records
+
+    def __getitem__(self, i):
+        return self._records[i]
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __reduce__(self):
+        return (list, (self._records,))
+
+    def __repr__(self):
+        return "RecordList({0!r})".format(self._records)
+
+
 class PWSafeDB(object):
     EOF_MARKER =  "PWS3-EOFPWS3-EOF"
     HDR_OFFSET = 152
+    MIN_ITER = 2048 # the minimum ITER allowed by the format
+    FORMAT_VERSION = "\x10\x03" # 0x0310, little-endian
+
+    # Field types matched by search() unless others are requested.
+    SEARCH_FIELDS = (PWSafeV3Record.TYPE_TITLE,)
+
+    # Every field type which makes sense to search.
+    SEARCHABLE_FIELDS = (
+        PWSafeV3Record.TYPE_TITLE,
+        PWSafeV3Record.TYPE_USERNAME,
+        PWSafeV3Record.TYPE_URL,
+        PWSafeV3Record.TYPE_EMAIL,
+        PWSafeV3Record.TYPE_NOTES,
+    )
 
     def __init__(self):
         self.preheader = None # unencrypted area
         self.header = None
-        self.records = []
-        self.hmac = None
+        self._records = [] # see the records property
+        self.hmac = None # HMAC stored in the database file
         self.pp = None # P'
         self.k = None
         self.l = None
+        self.stretch_backend = None # name of a pwsr.stretch backend
+        self.cipher_backend = None # name of a pwsr.cipher backend
+        self.parallel_decrypt = None # True, False or None to ask the backend
+        self.key_cache = None # a pwsr.keycache cache, None for keycache.get()
+        self._titles = {} # title -> [records], in database order
+        self._uuids = {} # uuid -> record
+        self._search_indexes = {} # field types -> index.TrigramIndex
+        self._range_indexes = {} # field type -> index.RangeIndex
+        self._groups = index.GroupTree(PWSafeV3Record.TYPE_GROUP)
+        self._editing = set() # ids of the records inside editing()
+        self._mac = None # HMAC of the field values computed while parsing
+        self._layout = None # PWSafeV3Layout of the file last parsed or saved
 
     def _check_password(self, pp, db_hpp):
         hpp = hashlib.new("sha256")
@@ -368,81 +1103,975 @@ class PWSafeDB(object):
         return db_hpp == hpp
 
     def _stretch_key(self, key, salt, iter_):
-        h = hashlib.new("sha256")
-        h.update(key)
-        h.update(salt)
-        digest = h.digest()
-
-        for _ in xrange(iter_):
-            tmp_h = hashlib.new("sha256")
-            tmp_h.update(digest)
-            digest = tmp_h.digest()
+        return stretch.stretch_key(key, salt, iter_, self.stretch_backend)
 
-        return digest
+    @property
+    def cipher(self):
+        """The :class:`.TwofishBackend` used by this database."""
+        return cipher.get_backend(self.cipher_backend)
 
     def _decrypt(self, data, key, iv=None, mode=MODE_ECB):
-        twofish = mcrypt.MCRYPT('twofish', mode)
-        twofish.init(key, iv)
-        plaintext = twofish.decrypt(data)
-        return plaintext
+        return self.cipher.decrypt(data, key, iv, mode)
+
+    def _encrypt(self, data, key, iv=None, mode=MODE_ECB):
+        return self.cipher.encrypt(data, key, iv, mode)
+
+    def _eof_offset(self, data):
+        """Returns the offset of the EOF marker in `data`.
+
+        A well-formed database ends with the marker followed by the 32 byte
+        HMAC, so the trailer is read at its fixed offset from the end of the
+        file. Files with trailing garbage fall back to a reverse search.
+
+        """
+        offset = len(data) - len(self.EOF_MARKER) - 32
+        marker = data[offset:offset + len(self.EOF_MARKER)]
+
+        if offset < self.HDR_OFFSET or marker != self.EOF_MARKER:
+            offset = data.rfind(self.EOF_MARKER)
+
+        if offset < self.HDR_OFFSET:
+            raise errors.IntegrityError("Unable to find the EOF marker")
+
+        if (offset - self.HDR_OFFSET) % BLOCK_SIZE:
+            raise errors.IntegrityError("Truncated data section")
+
+        return offset
 
     def _decrypt_data_section(self, data, iv, k):
-        ieof = data.rindex(PWSafeDB.EOF_MARKER)
+        ieof = self._eof_offset(data)
+        size = ieof - PWSafeDB.HDR_OFFSET
+        backend = self.cipher
+
+        parallel = self.parallel_decrypt
+        if parallel is None:
+            parallel = backend.use_parallel(size)
+
+        if parallel:
+            ciphertext = buffer(data, PWSafeDB.HDR_OFFSET, size)
+            return backend.cbc_decrypt_parallel(k, iv, ciphertext)
+
         ciphertext = data[PWSafeDB.HDR_OFFSET:ieof]
         plaintext  = self._decrypt(ciphertext, k, iv, mode=MODE_CBC)
 
         return plaintext
 
     def _get_hmac(self, data):
-        start = data.rindex(self.EOF_MARKER) + len(self.EOF_MARKER)
+        start = self._eof_offset(data) + len(self.EOF_MARKER)
         end = start + 32
         hmac_slice = data[start:end]
 
         return hmac_slice
 
-    def parse(self, db, key):
-        """Parses a PWSafe v3 database file."""
-        data = utils.ioslice(db, offset=0)
-        bindata = utils.bindata(data)
+    def _read_preheader(self, db):
+        """Reads and parses only the unencrypted preheader of `db`.
 
-        ph = PWSafeV3PreHeader.parse(bindata)
-        pp = self._stretch_key(key, ph.salt, ph.iter)
+        Raises:
+            .InvalidDatabaseError: If `db` does not start with a Password
+                Safe v3 preheader.
 
-        if not self._check_password(pp, ph.hpp):
-            raise errors.InvalidPasswordError("Incorrect password")
+        """
+        try:
+            db.seek(0)
+            data = db.read(self.HDR_OFFSET)
+        except AttributeError:
+            data = db[:self.HDR_OFFSET]
 
-        k = self._decrypt(ph.b1, pp) + self._decrypt(ph.b2, pp) # decrypt data
-        l = self._decrypt(ph.b3, pp) + self._decrypt(ph.b4, pp) # used for hmac
+        if len(data) < self.HDR_OFFSET:
+            raise errors.InvalidDatabaseError("Database file is too short")
 
-        hmac = self._get_hmac(bindata)
-        udata = self._decrypt_data_section(bindata, ph.iv, k) # decrypted data section
+        if data[:len(PWSafeV3PreHeader.TAG)] != PWSafeV3PreHeader.TAG:
+            raise errors.InvalidDatabaseError("Not a Password Safe v3 file")
 
-        header = PWSafeV3Header.parse(udata)
-        offset = len(header)
+        return PWSafeV3PreHeader.parse(data)
 
-        records = []
-        while offset < len(udata):
-            record = PWSafeV3Record.parse(udata, offset)
-            records.append(record)
-            offset += len(record)
+    def check_password(self, db, key):
+        """Returns True if `key` is the password of the database `db`.
 
-        self.preheader = ph
-        self.header = header
-        self.records = records
-        #self.hmac = hmac
-        self.pp = pp
-        self.k = k
-        self.l = l
+        Only the 152 byte preheader is read, so wrong passwords are rejected
+        without touching the rest of the file.
 
-    def search(self, key):
-        records = []
-        for record in self.records:
-            if key.lower() in str(record.title).lower():
-                records.append(record)
-        return records
+        Raises:
+            .InvalidDatabaseError: If `db` is not a Password Safe v3 file.
 
-    def groupby(self, key='group'):
-        grouped = collections.defaultdict(list)
+        """
+        ph = self._read_preheader(db)
+        return self._unlock_key(ph, key) is not None
+
+    def create(self, key, iterations=MIN_ITER):
+        """Initializes a new, empty database protected by `key`, with fresh
+        random keys K and L. Use :meth:`save` to write it to a file.
+
+        Raises:
+            ValueError: If `iterations` is less than ``MIN_ITER``.
+
+        """
+        if iterations < self.MIN_ITER:
+            error = "ITER must be at least {0}".format(self.MIN_ITER)
+            raise ValueError(error)
+
+        ph = PWSafeV3PreHeader()
+        ph.tag = PWSafeV3PreHeader.TAG
+        ph.salt = os.urandom(32)
+        ph.iter = iterations
+
+        pp = self._stretch_key(key, ph.salt, ph.iter)
+        k, l = os.urandom(32), os.urandom(32)
+        keys = self._encrypt(k + l, pp)
+
+        ph.hpp = hashlib.sha256(pp).digest()
+        ph.b1, ph.b2, ph.b3, ph.b4 = (keys[i:i + 16] for i in (0, 16, 32, 48))
+        ph.iv = os.urandom(BLOCK_SIZE)
+
+        header = PWSafeV3Header()
+        header.add(PwSafeV3Field(PWSafeV3Header.TYPE_VERSION,
+                                 self.FORMAT_VERSION))
+        header.add(PwSafeV3Field(PWSafeV3Header.TYPE_UUID, os.urandom(16)))
+        header.add(PwSafeV3Field(PWSafeV3Header.TYPE_END, ""))
+
+        self.preheader = ph
+        self.header = header
+        self._set_records([])
+        self.hmac = None
+        self.pp = pp
+        self.k = k
+        self.l = l
+        self._mac = None
+        self._layout = None
+
+    def _unlock_key(self, ph, key):
+        """Returns P' for `key` and the preheader `ph`, or None if `key` is
+        not the database password.
+
+        P' is taken from the key cache when it holds a P' which matches
+        H(P'), and is stretched and cached otherwise.
+
+        """
+        inst = instrument.get()
+        cache = self.key_cache
+
+        if cache is None:
+            cache = keycache.get()
+
+        pp = cache.get(ph.salt, ph.iter, key)
+        if pp is not None:
+            if self._check_password(pp, ph.hpp):
+                inst.count('key_cache_hits')
+                return pp
+            cache.forget(ph.salt, ph.iter, key)
+
+        with inst.phase('stretch'):
+            pp = self._stretch_key(key, ph.salt, ph.iter)
+
+        if not self._check_password(pp, ph.hpp):
+            return None
+
+        cache.put(ph.salt, ph.iter, key, pp)
+        return pp
+
+    def _unlock(self, ph, key):
+        """Stretches `key` with the salt and ITER of the preheader `ph` (see
+        :meth:`_unlock_key`) and decrypts K and L.
+
+        Returns:
+            A ``(P', K, L)`` tuple.
+
+        Raises:
+            .InvalidPasswordError: If `key` is not the database password.
+
+        """
+        inst = instrument.get()
+        pp = self._unlock_key(ph, key)
+
+        if pp is None:
+            raise errors.InvalidPasswordError("Incorrect password")
+
+        with inst.phase('keys_decrypt'):
+            keys = self._decrypt(ph.b1 + ph.b2 + ph.b3 + ph.b4, pp)
+
+        k = keys[:32] # decrypt data
+        l = keys[32:] # used for hmac
+
+        return pp, k, l
+
+    def _iter_data_section(self, db, iv, k, chunk_size=CHUNK_SIZE):
+        """Reads the data section of the open database file `db` and yields
+        it decrypted, `chunk_size` bytes at a time.
+
+        Each chunk is decrypted in CBC mode with the last ciphertext block of
+        the previous chunk as its IV.
+
+        """
+        chunk_size -= chunk_size % BLOCK_SIZE
+
+        db.seek(0, os.SEEK_END)
+        end = db.tell() - len(self.EOF_MARKER) - 32  # 32 byte HMAC
+
+        db.seek(end)
+        trailer = db.read()
+        if end < self.HDR_OFFSET or not trailer.startswith(self.EOF_MARKER):
+            raise errors.IntegrityError("Unable to find the EOF marker")
+
+        if (end - self.HDR_OFFSET) % BLOCK_SIZE:
+            raise errors.IntegrityError("Truncated data section")
+
+        self.hmac = trailer[len(self.EOF_MARKER):]
+
+        offset = self.HDR_OFFSET
+        db.seek(offset)
+        inst = instrument.get()
+
+        while offset < end:
+            ciphertext = db.read(min(chunk_size, end - offset))
+            offset += len(ciphertext)
+
+            with inst.phase('data_decrypt'):
+                plaintext = self._decrypt(ciphertext, k, iv, mode=MODE_CBC)
+
+            inst.count('bytes_decrypted', len(ciphertext))
+            yield plaintext
+            iv = ciphertext[-BLOCK_SIZE:]
+
+    def iter_parse(self, db, key, chunk_size=CHUNK_SIZE, verify=True):
+        """Parses the PWSafe v3 database file `db` incrementally, yielding
+        each record as soon as it has been decrypted.
+
+        The data section is decrypted `chunk_size` bytes at a time, so at
+        most one chunk and the records it completes are held in memory. The database header
+        is available as ``self.header`` once the first record is yielded.
+        Records are not added to ``self.records``, which is emptied along with
+        any state left by an earlier parse.
+
+        Records are yielded before the HMAC can be checked. With `verify`
+        set to True, the HMAC is checked after the last record and an
+        ``IntegrityError`` ends the iteration if it does not match; callers
+        which stop early get no integrity guarantee.
+
+        Args:
+            db: A seekable file-like object opened in binary mode.
+            key: The database password.
+            chunk_size: The number of ciphertext bytes decrypted at a time.
+            verify: See :meth:`parse`.
+
+        """
+        ph = self._read_preheader(db)
+        pp, k, l = self._unlock(ph, key)
+
+        self.preheader = ph
+        self.header = None
+        self._set_records([])
+        self.hmac = None
+        self.pp = pp
+        self.k = k
+        self.l = l
+        self._layout = None
+
+        self._mac = mac = self._new_mac(l) if verify else None
+
+        buf = ""
+        reader = PwSafeV3FieldReader(buf)
+        inst = instrument.get()
+
+        for plaintext in self._iter_data_section(db, ph.iv, k, chunk_size):
+            # Carry over the partial entry at the end of the last chunk.
+            buf = buf[reader.offset:] + plaintext
+            reader = PwSafeV3FieldReader(buf, mac=mac)
+            records = []
+
+            with inst.phase('record_parse'):
+                while reader.peek_entry() is not None:
+                    if self.header is None:
+                        self.header = PWSafeV3Header.parse(reader)
+                    else:
+                        records.append(PWSafeV3Record.parse(reader))
+
+            inst.count('records', len(records))
+
+            for record in records:
+                yield record
+
+        if not reader.eof:
+            raise errors.IntegrityError("Truncated entry at end of database")
+
+        if verify and verify != VERIFY_LAZY:
+            self.verify()
+
+    def parse(self, db, key, verify=True):
+        """Parses a PWSafe v3 database file.
+
+        The HMAC over the field values is computed as the fields are parsed,
+        so verifying it does not require a second pass over the data.
+
+        Args:
+            db: A file-like object or a string containing the database. Real
+                files are memory-mapped rather than read into memory.
+            key: The database password.
+            verify: ``True`` to check the HMAC once parsing completes,
+                ``False`` to skip it entirely, or ``'lazy'`` to compute it
+                while parsing but only check it when :meth:`verify` is
+                called.
+
+        Raises:
+            .InvalidDatabaseError: If `db` is not a Password Safe v3 file.
+            .InvalidPasswordError: If `key` is not the database password.
+            .IntegrityError: If the file is truncated or, when `verify` is
+                True, its HMAC does not match.
+
+        """
+        inst = instrument.get()
+
+        # Reject wrong passwords before reading past the preheader.
+        ph = self._read_preheader(db)
+        pp, k, l = self._unlock(ph, key)
+
+        with utils.mapped(db) as data:
+            hmac = self._get_hmac(data)
+
+            with inst.phase('data_decrypt'):
+                udata = self._decrypt_data_section(data, ph.iv, k) # decrypted data section
+
+        inst.count('bytes_decrypted', len(udata))
+
+        mac = self._new_mac(l) if verify else None
+        reader = PwSafeV3FieldReader(udata, mac=mac)
+
+        with inst.phase('header_parse'):
+            header = PWSafeV3Header.parse(reader)
+
+        checkpoints = {}
+
+        with inst.phase('record_parse'):
+            store = PWSafeV3RecordStore.parse(reader, checkpoints)
+            records = store.records()
+
+        inst.count('records', len(store))
+        inst.count('fields', len(store.types))
+
+        self.preheader = ph
+        self.header = header
+        self._layout = PWSafeV3Layout(
+            records,
+            (store.span(i)[0] for i in xrange(len(store))),
+            reader.offset,
+            header._raw_fields(),
+            checkpoints,
+            utils.file_signature(db) if hasattr(db, 'read') else None
+        )
+
+        with inst.phase('index'):
+            self._set_records(records)
+
+        self.hmac = hmac
+        self.pp = pp
+        self.k = k
+        self.l = l
+        self._mac = mac
+
+        if verify and verify != VERIFY_LAZY:
+            with inst.phase('verify'):
+                self.verify()
+
+    def _new_mac(self, l):
+        return hmac.new(l, digestmod=hashlib.sha256)
+
+    def verify(self):
+        """Checks the HMAC stored in the database file against the HMAC of
+        the field values computed while parsing.
+
+        Raises:
+            .IntegrityError: If the HMACs differ, meaning the file has been
+                tampered with or corrupted.
+            ValueError: If the database was parsed with ``verify=False``.
+
+        """
+        if self._mac is None:
+            raise ValueError("The HMAC was not computed while parsing")
+
+        if not hmac.compare_digest(self._mac.digest(), self.hmac):
+            raise errors.IntegrityError("Database HMAC mismatch")
+
+    def _serialize(self, records, mac=None, header=True, checkpoints=None,
+                   first=0):
+        """Serializes the header (if `header` is True) and `records` into
+        one preallocated buffer.
+
+        Records which are still backed by a ``PWSafeV3RecordStore`` are
+        copied verbatim from the store. Every other entry is serialized field
+        by field.
+
+        Args:
+            records: The records to serialize.
+            mac: An optional HMAC to update with the field values.
+            header: True to serialize the header before the records.
+            checkpoints: An optional dictionary which is filled with copies
+                of `mac` as in :meth:`PWSafeV3RecordStore.parse`.
+            first: The record number of ``records[0]``, used to number the
+                checkpoints.
+
+        Returns:
+            A ``(buffer, offsets)`` tuple, where `offsets` holds the offset
+            of each record in `buffer`.
+
+        """
+        entries = []
+        size = padding = 0
+
+        for record in records:
+            if record._fields is None:
+                entries.append((record._store, record._entry))
+                size += record._store.size(record._entry)
+            else:
+                entries.append(record._raw_fields())
+
+        if header:
+            entries.insert(0, self.header._raw_fields())
+
+        for entry in entries:
+            if isinstance(entry, list):
+                for _, value in entry:
+                    fsize = _field_size(len(value))
+                    size += fsize
+                    padding += fsize - PwSafeV3Field.HEADER_SIZE - len(value)
+
+        if mac is None:
+            checkpoints = None
+
+        writer = PwSafeV3FieldWriter(size, padding, mac)
+        offsets = []
+        number = first - 1 if header else first
+
+        for entry in entries:
+            if checkpoints is not None and number >= 0:
+                if not number % CHECKPOINT_INTERVAL:
+                    checkpoints[number] = mac.copy()
+
+            offsets.append(writer.offset)
+
+            if isinstance(entry, list):
+                for ftype, value in entry:
+                    writer.write(ftype, value)
+            else:
+                writer.copy_entry(*entry)
+
+            number += 1
+
+        if header:
+            offsets = offsets[1:]
+
+        return writer.buf, offsets
+
+    def save(self, dbfn, incremental=True):
+        """Writes the database to the file `dbfn`.
+
+        If `dbfn` is the file the database was last parsed from or saved to,
+        has not changed on disk since, and the header is unchanged, only the
+        data section from the first changed record onward is re-encrypted
+        (see :meth:`_save_incremental`). Otherwise the whole database is
+        re-encrypted (see :meth:`_save_full`). Either way the file is
+        replaced atomically.
+
+        Records are only known to have changed when they are modified
+        through their mapping interface (``record[ftype] = field``), added
+        with :meth:`add_record` or removed with :meth:`remove_record`.
+
+        Args:
+            dbfn: The database file path.
+            incremental: False to always re-encrypt the whole database.
+
+        Raises:
+            ValueError: If the database has not been unlocked.
+
+        """
+        if self.k is None or self.preheader is None:
+            raise ValueError("The database must be unlocked before saving")
+
+        layout = self._layout
+        saved = False
+
+        if (incremental and layout is not None and
+                layout.signature is not None and
+                layout.header == self.header._raw_fields()):
+            saved = self._save_incremental(dbfn, layout)
+
+        if not saved:
+            self._save_full(dbfn)
+
+        for record in self._records:
+            record._dirty = False
+
+        self._layout.signature = utils.file_signature(dbfn)
+
+    def _save_full(self, dbfn):
+        """Writes the whole database to `dbfn`.
+
+        The header and records are serialized into one buffer, the HMAC is
+        computed as fields are serialized, and the data section is encrypted
+        with a single CBC call under a freshly generated IV. The file is
+        written to a temporary file which is synced and then renamed over
+        `dbfn`, so a failed save never leaves a partially written database.
+
+        """
+        utils.atomic_write(dbfn, self._dump())
+
+    def _dump(self):
+        """Encrypts the whole database and returns the file contents as a
+        list of strings. See :meth:`_save_full`.
+
+        """
+        mac = self._new_mac(self.l)
+        checkpoints = {}
+        plaintext, offsets = self._serialize(self._records, mac, True,
+                                             checkpoints)
+
+        self.preheader.iv = os.urandom(BLOCK_SIZE)
+        ciphertext = self._encrypt(
+            bytes(plaintext), self.k, self.preheader.iv, MODE_CBC
+        )
+
+        self.hmac = mac.digest()
+        self._mac = mac
+        self._layout = PWSafeV3Layout(
+            self._records, offsets, len(plaintext),
+            self.header._raw_fields(), checkpoints
+        )
+
+        return [
+            self.preheader.serialize(),
+            ciphertext,
+            self.EOF_MARKER,
+            self.hmac,
+        ]
+
+    def _unchanged_on_disk(self, f, layout):
+        """Returns True if the open database file `f` is still the file
+        described by `layout`: its :func:`.file_signature` matches, and it
+        ends with the HMAC last parsed or saved.
+
+        """
+        if utils.file_signature(f) != layout.signature or self.hmac is None:
+            return False
+
+        trailer = self.EOF_MARKER + self.hmac
+
+        try:
+            f.seek(-len(trailer), os.SEEK_END)
+        except IOError:
+            return False
+
+        return f.read() == trailer
+
+    def _save_incremental(self, dbfn, layout):
+        """Rewrites `dbfn` from the first record which changed since `layout`
+        was recorded.
+
+        Under CBC the ciphertext of the unchanged records stays valid, so it
+        is copied from the old file as is and only the tail is encrypted,
+        with the last ciphertext block before it as the IV. The HMAC is
+        resumed from the closest checkpoint preceding the first changed
+        record. The new file is written next to `dbfn` and renamed over it,
+        as in :meth:`_save_full`.
+
+        Returns:
+            False, without writing anything, if `dbfn` changed on disk since
+            `layout` was recorded. True otherwise.
+
+        """
+        try:
+            f = open(dbfn, 'rb')
+        except IOError:
+            return False
+
+        with f:
+            if not self._unchanged_on_disk(f, layout):
+                return False
+
+            self._write_incremental(dbfn, f, layout)
+
+        return True
+
+    def _write_incremental(self, dbfn, f, layout):
+        records = self._records
+        first = layout.first_changed(records)
+
+        if first == len(records) == len(layout.records):
+            return  # nothing changed
+
+        start, mac = layout.checkpoint(first)
+
+        if mac is None:
+            start, mac = 0, self._new_mac(self.l)
+            for _, value in layout.header:
+                mac.update(value)
+
+        for record in records[start:first]:
+            record._update_mac(mac)
+
+        checkpoints = dict(
+            (k, v) for k, v in layout.checkpoints.iteritems() if k <= first
+        )
+        plaintext, offsets = self._serialize(
+            records[first:], mac, False, checkpoints, first
+        )
+
+        offset = layout.offset(first)
+        digest = mac.digest()
+
+        f.seek(self.HDR_OFFSET + offset - BLOCK_SIZE)
+        iv = f.read(BLOCK_SIZE)
+        ciphertext = self._encrypt(bytes(plaintext), self.k, iv, MODE_CBC)
+
+        def chunks():
+            # The unchanged preheader and ciphertext, then the new tail.
+            f.seek(0)
+            remaining = self.HDR_OFFSET + offset
+
+            while remaining:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise errors.IntegrityError("Truncated data section")
+                remaining -= len(data)
+                yield data
+
+            yield ciphertext
+            yield self.EOF_MARKER
+            yield digest
+
+        utils.atomic_write(dbfn, chunks())
+
+        self.hmac = digest
+        self._mac = mac
+        self._layout = PWSafeV3Layout(
+            records,
+            layout.offsets[:first].tolist() + [offset + x for x in offsets],
+            offset + len(plaintext),
+            layout.header,
+            checkpoints
+        )
+
+    @property
+    def records(self):
+        """The records of the database, as a read-only :class:`RecordList`.
+        Use :meth:`add_record`, :meth:`remove_record` and
+        :meth:`replace_record` to change them.
+
+        """
+        return RecordList(self._records)
+
+    def _set_records(self, records):
+        """Replaces every record of the database with the list `records`
+        and rebuilds the indexes.
+
+        """
+        # Records dropped by a new parse no longer belong to the database.
+        for record in self._records:
+            record._owner = None
+
+        for record in records:
+            record._owner = self
+
+        self._records = records
+        self._build_indexes()
+
+    def _build_indexes(self):
+        self._titles = {}
+        self._uuids = {}
+        self._search_indexes = {}
+        self._range_indexes = {}
+        self._groups = index.GroupTree(
+            PWSafeV3Record.TYPE_GROUP, self._records, self._empty_groups()
+        )
+
+        for record in self._records:
+            self._index_record(record)
+
+    def _empty_groups(self):
+        if self.header is None:
+            return []
+
+        fields = self.header.getall(PWSafeV3Header.TYPE_EMPTY_GROUPS)
+        return [x.value for x in fields]
+
+    def _index_record(self, record):
+        title = record[PWSafeV3Record.TYPE_TITLE]
+        if title is not None:
+            self._titles.setdefault(title.value, []).append(record)
+
+        uuid = record[PWSafeV3Record.TYPE_UUID]
+        if uuid is not None:
+            self._uuids.setdefault(uuid.value, record)
+
+    def _unindex_record(self, record):
+        title = record[PWSafeV3Record.TYPE_TITLE]
+        if title is not None:
+            matches = self._titles.get(title.value, [])
+            matches[:] = [x for x in matches if x is not record]
+            if not matches:
+                self._titles.pop(title.value, None)
+
+        uuid = record[PWSafeV3Record.TYPE_UUID]
+        if uuid is not None and self._uuids.get(uuid.value) is record:
+            del self._uuids[uuid.value]
+
+            # Fall back to another record sharing the UUID, if any.
+            for other in self._records:
+                if other is record:
+                    continue
+                field = other[PWSafeV3Record.TYPE_UUID]
+                if field is not None and field.value == uuid.value:
+                    self._uuids[uuid.value] = other
+                    break
+
+    def _secondary_indexes(self):
+        """Returns the search and range indexes built so far."""
+        return self._search_indexes.values() + self._range_indexes.values()
+
+    def add_record(self, record):
+        """Appends `record` to the database. A record belongs to one database
+        at a time, the one it was last added to.
+
+        """
+        record._owner = self
+        self._records.append(record)
+        self._index_record(record)
+        self._groups.add(record)
+
+        for secondary in self._secondary_indexes():
+            secondary.add(record)
+
+    def remove_record(self, record):
+        """Removes `record` from the database.
+
+        Raises:
+            ValueError: If `record` is not in the database.
+
+        """
+        index = next(
+            (i for i, x in enumerate(self._records) if x is record), None
+        )
+
+        if index is None:
+            raise ValueError("Record is not in the database")
+
+        del self._records[index]
+        record._owner = None
+        self._unindex_record(record)
+        self._groups.remove(record)
+
+        for secondary in self._secondary_indexes():
+            secondary.remove(record)
+
+    def replace_record(self, record, new):
+        """Replaces `record` with `new`, keeping its position in the
+        database.
+
+        Raises:
+            ValueError: If `record` is not in the database.
+
+        """
+        index = next(
+            (i for i, x in enumerate(self._records) if x is record), None
+        )
+
+        if index is None:
+            raise ValueError("Record is not in the database")
+
+        self._records[index] = new
+        record._owner = None
+        new._owner = self
+        self._unindex_record(record)
+        self._index_record(new)
+        self._groups.replace(record, new)
+
+        for secondary in self._secondary_indexes():
+            secondary.remove(record)
+            secondary.add(new)
+
+    @contextlib.contextmanager
+    def editing(self, record):
+        """Updates the indexes of the database once for all the changes made
+        to `record` within the ``with`` block::
+
+            with pwsafe.editing(record):
+                record[PWSafeV3Record.TYPE_TITLE] = title
+                record[PWSafeV3Record.TYPE_GROUP] = group
+
+        Every modification of a record already runs within this block, so it
+        is only needed to batch several of them.
+
+        Raises:
+            ValueError: If `record` is not in the database.
+
+        """
+        if record._owner is not self:
+            raise ValueError("Record is not in the database")
+
+        key = id(record)
+
+        if key in self._editing:
+            yield record
+            return
+
+        self._editing.add(key)
+        self._unindex_record(record)
+
+        for secondary in self._secondary_indexes():
+            secondary.remove(record)
+
+        try:
+            yield record
+        finally:
+            self._editing.discard(key)
+            self._index_record(record)
+            self._groups.replace(record, record)
+
+            for secondary in self._secondary_indexes():
+                secondary.add(record)
+
+    def get_uuid(self, uuid):
+        """Returns the record whose UUID field (0x01) is `uuid`.
+
+        Args:
+            uuid: The 16 byte binary UUID.
+
+        Raises:
+            KeyError: If no record has the UUID `uuid`.
+
+        """
+        try:
+            return self._uuids[uuid]
+        except KeyError:
+            error = "Unable to find entry with UUID '{0}'"
+            raise KeyError(error.format(uuid.encode('hex')))
+
+    def _search_index(self, fields):
+        fields = tuple(sorted(set(fields)))
+
+        try:
+            return self._search_indexes[fields]
+        except KeyError:
+            with instrument.get().phase('search_index'):
+                search_index = index.TrigramIndex(fields, self._records)
+            self._search_indexes[fields] = search_index
+            return search_index
+
+    def search(self, key, fields=None):
+        """Returns the records which contain `key` (case-insensitive) in any
+        of the `fields`.
+
+        Args:
+            key: The search key.
+            fields: The field types to search. Defaults to ``SEARCH_FIELDS``
+                (title only). An index over each distinct set of fields is
+                built on first use and reused until the database is parsed
+                again.
+
+        """
+        search_index = self._search_index(fields or self.SEARCH_FIELDS)
+
+        with instrument.get().phase('search'):
+            return search_index.search(key)
+
+    def _range_index(self, ftype):
+        try:
+            return self._range_indexes[ftype]
+        except KeyError:
+            kind = query.kind(ftype)
+            decode = lambda x: query.decode(kind, x)
+
+            with instrument.get().phase('range_index'):
+                range_index = index.RangeIndex(ftype, decode, self._records)
+            self._range_indexes[ftype] = range_index
+            return range_index
+
+    def _decoded(self, record, predicate):
+        if predicate.kind in query.ORDERED_KINDS:
+            return self._range_index(predicate.ftype).value(record)
+
+        field = record[predicate.ftype]
+        if field is None:
+            return None
+
+        return query.decode(predicate.kind, field.value)
+
+    def query(self, *predicates):
+        """Returns the records which satisfy every one of `predicates`.
+
+        Predicates on ``time_t`` and integer fields are answered from a
+        sorted index of the decoded field values, which is built on first
+        use and kept up to date as records are added, removed or edited. The
+        most selective of them picks the candidate records in O(log n + k),
+        and the remaining predicates are checked against each candidate.
+
+        Args:
+            predicates: :class:`.query.Predicate` instances, or strings such
+                as ``"expiry<2026-11-01"``. See :mod:`pwsr.query`.
+
+        Returns:
+            The matching records, in order of the field whose index picked
+            the candidates or, if no predicate could use an index, in
+            database order.
+
+        Raises:
+            .QueryError: If a predicate is invalid.
+
+        """
+        predicates = [query.parse(x) for x in predicates]
+        inst = instrument.get()
+        best = None
+
+        for predicate in predicates:
+            if not predicate.ranged:
+                continue
+
+            range_index = self._range_index(predicate.ftype)
+            start, stop = range_index.span(*predicate.bounds())
+
+            if best is None or stop - start < best[0]:
+                best = (stop - start, predicate, range_index, start, stop)
+
+        with inst.phase('query'):
+            if best is None:
+                candidates = self._records
+            else:
+                _, chosen, range_index, start, stop = best
+                candidates = range_index.slice(start, stop)
+                predicates = [x for x in predicates if x is not chosen]
+
+            inst.count('query_candidates', len(candidates))
+
+            return [
+                record for record in candidates
+                if all(x.match(self._decoded(record, x)) for x in predicates)
+            ]
+
+    @property
+    def groups(self):
+        """The :class:`.GroupTree` of the records, which includes the groups
+        named in the Empty Groups (0x11) header field.
+
+        """
+        return self._groups
+
+    def grouped(self, group=""):
+        """Yields the records in `group` (default: all records) and its
+        subgroups, ordered by group path and then database order.
+
+        Raises:
+            KeyError: If there is no such group.
+
+        """
+        return self._groups.iter_records(group)
+
+    def groupby(self, key='group'):
+        """Returns a dictionary which maps each distinct value of the
+        record attribute `key` to the records holding it. Groups are read
+        from the group tree rather than from the records.
+
+        """
+        if key == 'group':
+            return collections.defaultdict(list, self._groups.groups())
+
+        grouped = collections.defaultdict(list)
 
         for record in self:
             field = getattr(record, key)
@@ -452,29 +2081,226 @@ class PWSafeDB(object):
         return grouped
 
     def __getitem__(self, item):
-        for record in self.records:
-            if str(record.title) == item:
-                return record
+        matches = self._titles.get(item)
+        if matches:
+            return matches[0]
 
         error = "Unable to find entry for '{0}'".format(item)
         raise KeyError(error)
 
     def __iter__(self):
-        for record in self.records:
+        for record in self._records:
             yield record
 
     def __str__(self):
         s = str(self.preheader) + "\n"
         s = s + str(self.header) + "\n"
-        s = s + "\n".join(str(x) for x in self.records)
+        s = s + "\n".join(str(x) for x in self._records)
 
         return s
 
 
-def parse(dbfn, dbpw):
+def parse(dbfn, dbpw, verify=True):
+    pwsafe = PWSafeDB()
+
+    with instrument.get().phase('parse'):
+        with open(dbfn, 'rb') as database:
+            pwsafe.parse(database, dbpw, verify)
+
+    return pwsafe
+
+
+def check_password(dbfn, dbpw):
+    """Returns True if `dbpw` is the password of the database file `dbfn`.
+    Only the preheader of the file is read.
+
+    Raises:
+        .InvalidDatabaseError: If `dbfn` is not a Password Safe v3 file.
+
+    """
+    pwsafe = PWSafeDB()
+
+    with open(dbfn, 'rb') as database:
+        return pwsafe.check_password(database, dbpw)
+
+
+def iter_records(dbfn, dbpw, chunk_size=CHUNK_SIZE, verify=True):
+    """Yields the records of the database file `dbfn` one at a time as the
+    file is read and decrypted. See :meth:`PWSafeDB.iter_parse`.
+
+    Decryption stops as soon as the generator is closed or discarded. The
+    HMAC is only checked once the last record has been yielded, so a lookup
+    must exhaust the generator before it trusts the record it found.
+
+    """
     pwsafe = PWSafeDB()
 
     with open(dbfn, 'rb') as database:
-        pwsafe.parse(database, dbpw)
+        records = pwsafe.iter_parse(database, dbpw, chunk_size, verify)
+
+        for record in records:
+            yield record
+
+
+def find_record(dbfn, dbpw, key, verify=True):
+    """Looks `key` up in the database file `dbfn` while it is read, as
+    :func:`.utils.stream_find_record` does, without holding every record in
+    memory.
+
+    Args:
+        dbfn: The database file.
+        dbpw: The database password.
+        key: The title to look up.
+        verify: If True, the rest of the file is still decrypted after a
+            match, so that its HMAC is checked before the record is returned.
+            If False, reading stops at the first exact title match and the
+            HMAC is never checked, so a tampered file is not detected.
+
+    Raises:
+        .KeyLookupError: If no record matches `key`.
+        .IntegrityError: If `verify` is True and the HMAC does not match.
+
+    """
+    records = iter_records(dbfn, dbpw, verify=verify)
 
-    return pwsafe
\ No newline at end of file
+    try:
+        record = utils.stream_find_record(records, key)
+
+        if verify:
+            collections.deque(records, maxlen=0)
+    finally:
+        records.close()
+
+    return record
+
+
+def _export_columns(fields):
+    columns = []
+
+    for name in fields:
+        if name not in query.FIELDS:
+            raise ValueError("Unknown field: '{0}'".format(name))
+        ftype, kind = query.FIELDS[name]
+        columns.append((name, ftype, kind))
+
+    return columns
+
+
+def _export_value(record, ftype, kind):
+    field = record[ftype]
+
+    if field is None:
+        return None
+
+    value = query.decode(kind, field.value)
+
+    if kind == query.KIND_TEXT:
+        return value.decode('utf-8', 'replace')
+    elif kind == query.KIND_UUID and value is not None:
+        return str(value)
+
+    return value
+
+
+def iter_export(records, fmt=FORMAT_JSONL, fields=EXPORT_FIELDS,
+                redact=False):
+    """Yields the serialized form of each record in `records`, one line at a
+    time, as UTF-8 encoded strings. CSV output starts with a header line
+    naming the fields.
+
+    Args:
+        records: An iterable of records, such as the generator returned by
+            :func:`iter_records`.
+        fmt: ``FORMAT_JSONL`` for one JSON object per record, or
+            ``FORMAT_CSV``.
+        fields: The names of the fields to export, from
+            :data:`.query.FIELDS`. Time and integer fields are exported as
+            integers and UUIDs in their hyphenated form. Missing fields are
+            null, or empty in CSV.
+        redact: If True, replace passwords and password histories with
+            ``REDACTED``.
+
+    Raises:
+        ValueError: If `fmt` or a field name is unknown.
+
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: '{0}'".format(fmt))
+
+    columns = _export_columns(fields)
+    redacted = set(REDACTED_FIELDS) if redact else ()
+
+    if fmt == FORMAT_CSV:
+        buf = StringIO.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+
+        def line(values):
+            writer.writerow([
+                "" if x is None else unicode(x).encode('utf-8')
+                for x in values
+            ])
+            out = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return out
+
+        yield line(fields)
+    else:
+        names = [x[0] for x in columns]
+        line = lambda values: json.dumps(dict(zip(names, values))) + "\n"
+
+    for record in records:
+        values = []
+
+        for name, ftype, kind in columns:
+            value = _export_value(record, ftype, kind)
+            if name in redacted and value is not None:
+                value = REDACTED
+            values.append(value)
+
+        yield line(values)
+
+
+def export_records(records, outfile, fmt=FORMAT_JSONL, fields=EXPORT_FIELDS,
+                   redact=False, buffer_size=EXPORT_BUFFER_SIZE):
+    """Writes `records` to the file-like object `outfile` as JSON Lines or
+    CSV. See :func:`iter_export` for the arguments.
+
+    Records are serialized as they are pulled from `records`, and output is
+    written `buffer_size` bytes at a time rather than once per record.
+
+    Returns:
+        The number of records written.
+
+    """
+    chunk, size = [], 0
+    count = -1 if fmt == FORMAT_CSV else 0  # the CSV header is not a record
+
+    for line in iter_export(records, fmt, fields, redact):
+        chunk.append(line)
+        size += len(line)
+        count += 1
+
+        if size >= buffer_size:
+            outfile.write("".join(chunk))
+            chunk, size = [], 0
+
+    outfile.write("".join(chunk))
+    outfile.flush()
+
+    instrument.get().count('records_exported', count)
+    return count
+
+
+def export(dbfn, dbpw, outfile, **kwargs):
+    """Writes the records of the database file `dbfn` to `outfile` while the
+    file is being decrypted, without holding every record in memory. See
+    :func:`iter_records` and :func:`export_records`.
+
+    The HMAC of the file is only checked once every record has been
+    written, so a corrupt database raises ``IntegrityError`` after its
+    records have been exported.
+
+    """
+    records = iter_records(dbfn, dbpw)
+    return export_records(records, outfile, **kwargs)
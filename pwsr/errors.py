@@ -3,7 +3,48 @@ class InvalidPasswordError(Exception):
     pass
 
 
+class InvalidDatabaseError(Exception):
+    pass
+
+
+class IntegrityError(Exception):
+    """Raised when a database file is truncated, corrupted or fails HMAC
+    verification.
+
+    """
+    pass
+
+
+class CipherBackendError(Exception):
+    pass
+
+
+class StretchBackendError(Exception):
+    pass
+
+
+class AgentError(Exception):
+    pass
+
+
 class KeyLookupError(Exception):
     def __init__(self, message=None, key=None):
         super(KeyLookupError, self).__init__(message)
-        self.key = key
\ No newline at end of file
+        self.key = key
+
+
+class SyncError(Exception):
+    pass
+
+
+class SyncConflictError(SyncError):
+    """Raised when the remote copy of a database changed while it was being
+    synchronized.
+
+    """
+    pass
+
+
+class QueryError(Exception):
+    """Raised when a query predicate cannot be parsed."""
+    pass
@@ -0,0 +1,563 @@
+# builtin
+import bisect
+import collections
+
+# internal
+from . import instrument
+
+
+NGRAM_SIZE = 3
+
+GROUP_SEPARATOR = "."
+GROUP_ESCAPE = "\\"
+
+
+def normalize(value):
+    """Returns the normalized, searchable form of `value`: a lowercased UTF-8
+    string.
+
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.lower()
+
+
+def ngrams(text, n=NGRAM_SIZE):
+    """Returns the set of `n` character substrings of `text`."""
+    return set(text[i:i + n] for i in xrange(len(text) - n + 1))
+
+
+class TrigramIndex(object):
+    """An inverted index which maps every trigram found in a set of record
+    fields to the records containing it.
+
+    Queries are answered by intersecting the posting lists of the query's
+    trigrams and then confirming each candidate with a plain substring match,
+    so results are exactly those of a case-insensitive substring scan over
+    the indexed fields, in the order the records were added.
+
+    Args:
+        fields: The field types to index.
+        records: An optional iterable of records to index.
+
+    """
+    def __init__(self, fields, records=()):
+        self.fields = tuple(fields)
+        self._records = []  # position -> record, or None once removed
+        self._texts = []  # position -> tuple of normalized field values
+        self._positions = {}  # id(record) -> position
+        self._postings = collections.defaultdict(set)
+
+        for record in records:
+            self.add(record)
+
+    def _normalized(self, record):
+        texts = []
+
+        for ftype in self.fields:
+            field = record[ftype]
+            if field is not None:
+                texts.append(normalize(field.value))
+
+        return tuple(texts)
+
+    def add(self, record):
+        """Adds `record` to the index."""
+        position = len(self._records)
+        texts = self._normalized(record)
+
+        self._records.append(record)
+        self._texts.append(texts)
+        self._positions[id(record)] = position
+
+        for text in texts:
+            for gram in ngrams(text):
+                self._postings[gram].add(position)
+
+    def remove(self, record):
+        """Removes `record` from the index. Does nothing if `record` was
+        never added.
+
+        """
+        position = self._positions.pop(id(record), None)
+        if position is None:
+            return
+
+        for text in self._texts[position]:
+            for gram in ngrams(text):
+                posting = self._postings[gram]
+                posting.discard(position)
+                if not posting:
+                    del self._postings[gram]
+
+        self._records[position] = None
+        self._texts[position] = ()
+
+    def _candidates(self, query):
+        grams = ngrams(query)
+
+        if not grams:
+            # Too short to use the index.
+            return sorted(self._positions.itervalues())
+
+        postings = sorted(
+            (self._postings.get(gram, ()) for gram in grams), key=len
+        )
+
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+
+        return sorted(candidates)
+
+    def search(self, key):
+        """Returns the records which contain `key` (case-insensitive) in any
+        of the indexed fields.
+
+        """
+        query = normalize(key)
+        texts = self._texts
+        records = self._records
+        candidates = self._candidates(query)
+
+        instrument.get().count('search_candidates', len(candidates))
+
+        return [
+            records[i] for i in candidates
+            if any(query in text for text in texts[i])
+        ]
+
+    def __len__(self):
+        return len(self._positions)
+
+
+def split_group(group):
+    """Returns the components of the dot-separated Password Safe group path
+    `group` as a tuple. Dots escaped with a backslash (``\\.``) are part of
+    a component rather than separators. The empty path has no components.
+
+    """
+    if not group:
+        return ()
+
+    escaped = GROUP_ESCAPE + GROUP_SEPARATOR
+
+    if escaped not in group:
+        return tuple(group.split(GROUP_SEPARATOR))
+
+    components = []
+
+    for part in group.replace(escaped, "\0").split(GROUP_SEPARATOR):
+        components.append(part.replace("\0", GROUP_SEPARATOR))
+
+    return tuple(components)
+
+
+def join_group(components):
+    """Returns the group path for `components`, escaping dots. This is the
+    inverse of :func:`split_group`.
+
+    """
+    escaped = GROUP_ESCAPE + GROUP_SEPARATOR
+    return GROUP_SEPARATOR.join(
+        x.replace(GROUP_SEPARATOR, escaped) for x in components
+    )
+
+
+class GroupNode(object):
+    """A group in a :class:`GroupTree`.
+
+    Attributes:
+        name: The last component of the group path.
+        path: The components of the group path.
+        parent: The parent node, or None for the root.
+        children: The subgroups, keyed by name.
+        records: The records directly in this group, in database order.
+        count: The number of records in this group and all of its subgroups.
+        declared: True if the group is listed in the Empty Groups (0x11)
+            header field.
+
+    """
+    __slots__ = (
+        'name', 'path', 'parent', 'children', 'records', 'count', 'declared',
+        '_names'
+    )
+
+    def __init__(self, name="", path=(), parent=None):
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.children = {}
+        self.records = []
+        self.count = 0
+        self.declared = False
+        self._names = []  # sorted child names
+
+    @property
+    def group(self):
+        """The group path of this node, as stored in a record."""
+        return join_group(self.path)
+
+    def child(self, name):
+        """Returns the subgroup `name`, creating it if needed."""
+        node = self.children.get(name)
+
+        if node is None:
+            node = GroupNode(name, self.path + (name,), self)
+            self.children[name] = node
+            bisect.insort(self._names, name)
+
+        return node
+
+    def subgroups(self):
+        """Returns the subgroups, sorted by name."""
+        children = self.children
+        return [children[x] for x in self._names]
+
+    def walk(self):
+        """Yields this node and every node below it, depth first, with
+        subgroups in name order.
+
+        """
+        stack = [self]
+
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.subgroups()))
+
+    def iter_records(self):
+        """Yields the records of this group and its subgroups, in the order
+        of :meth:`walk`.
+
+        """
+        for node in self.walk():
+            for record in node.records:
+                yield record
+
+    def _prune(self):
+        """Removes this node, and then each ancestor, while it has no
+        records, no subgroups and is not declared.
+
+        """
+        node = self
+
+        while (node.parent is not None and not node.count and
+               not node.children and not node.declared):
+            parent = node.parent
+            del parent.children[node.name]
+            parent._names.remove(node.name)
+            node = parent
+
+    def __len__(self):
+        return self.count
+
+
+class GroupTree(object):
+    """The hierarchy of record groups. Group paths are split on dots (see
+    :func:`split_group`) so that a group and all of its subgroups can be
+    listed and counted without scanning the records.
+
+    Records without a group belong to the root node, whose path is empty.
+
+    Args:
+        field: The field type holding the group path.
+        records: An optional iterable of records to add.
+        empty_groups: An optional iterable of group paths which exist even
+            when they hold no records, such as the values of the Empty Groups
+            header field.
+
+    """
+    def __init__(self, field, records=(), empty_groups=()):
+        self.field = field
+        self.root = GroupNode()
+        self._nodes = {}  # id(record) -> node
+
+        for group in empty_groups:
+            self.declare(group)
+
+        for record in records:
+            self.add(record)
+
+    def _group(self, record):
+        field = record[self.field]
+        return field.value if field is not None else ""
+
+    def _node(self, group, create=False):
+        node = self.root
+
+        for name in split_group(group):
+            if create:
+                node = node.child(name)
+            else:
+                node = node.children.get(name)
+                if node is None:
+                    return None
+
+        return node
+
+    def declare(self, group):
+        """Adds the group `group` even though it may hold no records."""
+        self._node(group, create=True).declared = True
+
+    def add(self, record):
+        """Adds `record` to the node for its group."""
+        node = self._node(self._group(record), create=True)
+        node.records.append(record)
+        self._nodes[id(record)] = node
+
+        while node is not None:
+            node.count += 1
+            node = node.parent
+
+    def remove(self, record):
+        """Removes `record` from the tree. Does nothing if `record` was
+        never added.
+
+        """
+        node = self._nodes.pop(id(record), None)
+        if node is None:
+            return
+
+        node.records[:] = [x for x in node.records if x is not record]
+        leaf = node
+
+        while node is not None:
+            node.count -= 1
+            node = node.parent
+
+        leaf._prune()
+
+    def replace(self, record, new):
+        """Replaces `record` with `new`. If both are in the same group, `new`
+        takes the place of `record` within it.
+
+        """
+        node = self._nodes.get(id(record))
+
+        if node is None or node is not self._node(self._group(new)):
+            self.remove(record)
+            self.add(new)
+            return
+
+        del self._nodes[id(record)]
+        self._nodes[id(new)] = node
+        node.records[:] = [new if x is record else x for x in node.records]
+
+    def node(self, group=""):
+        """Returns the :class:`GroupNode` for `group`.
+
+        Raises:
+            KeyError: If there is no such group.
+
+        """
+        node = self._node(group)
+
+        if node is None:
+            raise KeyError(group)
+
+        return node
+
+    def count(self, group=""):
+        """Returns the number of records in `group` and its subgroups."""
+        return self.node(group).count
+
+    def counts(self, group=""):
+        """Returns a list of ``(group, count)`` tuples for `group` and every
+        group below it, in tree order.
+
+        """
+        return [(x.group, x.count) for x in self.node(group).walk()]
+
+    def subtree(self, group=""):
+        """Returns the records in `group` and its subgroups, in tree order.
+        """
+        return list(self.node(group).iter_records())
+
+    def iter_records(self, group=""):
+        """Yields the records in `group` and its subgroups, in tree order."""
+        return self.node(group).iter_records()
+
+    def groups(self):
+        """Returns a dictionary which maps each group path holding records
+        to the records directly in it.
+
+        """
+        return dict(
+            (x.group, list(x.records)) for x in self.root.walk() if x.records
+        )
+
+    def empty_groups(self):
+        """Returns the paths of the declared groups which hold no records,
+        in tree order.
+
+        """
+        return [
+            x.group for x in self.root.walk() if x.declared and not x.count
+        ]
+
+    def __len__(self):
+        return self.root.count
+
+
+class RangeIndex(object):
+    """A sorted secondary index over the decoded values of one field type,
+    which answers range queries in O(log n + k).
+
+    Each record's field is decoded once, when the record is added, and the
+    decoded value is kept for :meth:`value`. Records without the field, or
+    whose field cannot be decoded, are not part of any range.
+
+    The records given to the constructor are sorted once, in O(n log n).
+    Records added later are inserted in order. Removed records leave a
+    tombstone, and the index is compacted once tombstones make up
+    ``COMPACT_FRACTION`` of it.
+
+    Args:
+        field: The field type to index.
+        decode: A callable which returns the decoded form of a raw field
+            value, or None.
+        records: An optional iterable of records to index.
+
+    """
+    COMPACT_FRACTION = 0.25
+    COMPACT_MIN = 64  # tombstones always tolerated
+
+    def __init__(self, field, decode, records=()):
+        self.field = field
+        self.decode = decode
+        self._records = []  # position -> record, or None once removed
+        self._values = []  # position -> decoded value
+        self._positions = {}  # id(record) -> position
+
+        for record in records:
+            self._append(record, self._decoded(record))
+
+        self._sort()
+
+    def _decoded(self, record):
+        field = record[self.field]
+        return None if field is None else self.decode(field.value)
+
+    def _append(self, record, value):
+        position = len(self._records)
+
+        self._records.append(record)
+        self._values.append(value)
+        self._positions[id(record)] = position
+
+        return position
+
+    def _sort(self):
+        """Rebuilds the sorted values from scratch. Equal values stay in
+        position order, as they would after inserting them one by one.
+
+        """
+        pairs = sorted(
+            (value, position) for position, value in enumerate(self._values)
+            if value is not None and self._records[position] is not None
+        )
+
+        self._keys = [value for value, _ in pairs]  # sorted decoded values
+        self._order = [position for _, position in pairs]  # in _keys order
+
+    def add(self, record):
+        """Adds `record` to the index."""
+        value = self._decoded(record)
+        position = self._append(record, value)
+
+        if value is not None:
+            i = bisect.bisect_right(self._keys, value)
+            self._keys.insert(i, value)
+            self._order.insert(i, position)
+
+    def remove(self, record):
+        """Removes `record` from the index. Does nothing if `record` was
+        never added.
+
+        """
+        position = self._positions.pop(id(record), None)
+        if position is None:
+            return
+
+        value = self._values[position]
+
+        if value is not None:
+            i = bisect.bisect_left(self._keys, value)
+            while self._order[i] != position:
+                i += 1
+            del self._keys[i]
+            del self._order[i]
+
+        self._records[position] = None
+        self._values[position] = None
+
+        removed = len(self._records) - len(self._positions)
+        if removed > max(self.COMPACT_MIN,
+                         self.COMPACT_FRACTION * len(self._records)):
+            self._compact()
+
+    def _compact(self):
+        """Drops the tombstones left by :meth:`remove`."""
+        live = [i for i, x in enumerate(self._records) if x is not None]
+        renumber = dict((old, new) for new, old in enumerate(live))
+
+        self._records = [self._records[i] for i in live]
+        self._values = [self._values[i] for i in live]
+        self._positions = dict(
+            (id(record), i) for i, record in enumerate(self._records)
+        )
+        self._order = [renumber[i] for i in self._order]
+
+    def value(self, record):
+        """Returns the decoded field value of `record`."""
+        position = self._positions.get(id(record))
+
+        if position is None:
+            return self._decoded(record)
+
+        return self._values[position]
+
+    def span(self, low=None, high=None, low_inclusive=True,
+             high_inclusive=True):
+        """Returns the ``(start, stop)`` slice of the sorted values between
+        `low` and `high`. Open ends are None.
+
+        """
+        keys = self._keys
+
+        if low is None:
+            start = 0
+        elif low_inclusive:
+            start = bisect.bisect_left(keys, low)
+        else:
+            start = bisect.bisect_right(keys, low)
+
+        if high is None:
+            stop = len(keys)
+        elif high_inclusive:
+            stop = bisect.bisect_right(keys, high)
+        else:
+            stop = bisect.bisect_left(keys, high)
+
+        return start, max(start, stop)
+
+    def slice(self, start, stop):
+        """Returns the records of the slice `start`:`stop` of the sorted
+        values (see :meth:`span`), in value order.
+
+        """
+        records = self._records
+        return [records[i] for i in self._order[start:stop]]
+
+    def range(self, *args, **kwargs):
+        """Returns the records whose value lies in a range, in value order.
+        Takes the arguments of :meth:`span`.
+
+        """
+        return self.slice(*self.span(*args, **kwargs))
+
+    def __len__(self):
+        return len(self._positions)
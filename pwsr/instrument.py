@@ -0,0 +1,137 @@
+"""Instrumentation hooks for the phases of database operations.
+
+Code in pwsr reports to the installed instrument (see :func:`install`) with
+``phase(name)``, a context manager timing one phase, and ``count(name, n)``.
+The default :class:`Instrument` ignores both: its ``phase()`` returns one
+shared no-op context manager. Reporting happens once per phase or per chunk
+of data, never per field, so an uninstrumented run does no extra work
+proportional to the size of the database.
+
+Example:
+    >>> profiler = instrument.install(instrument.Profiler())
+    >>> pwsafe = db.parse(dbfn, dbpw)
+    >>> print profiler.report()
+
+"""
+# builtin
+import time
+import collections
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class Instrument(object):
+    """The null instrument, and the interface every instrument implements.
+
+    Attributes:
+        enabled: False for instruments which discard everything reported to
+            them.
+
+    """
+    enabled = False
+
+    def phase(self, name):
+        """Returns a context manager which times the phase `name`."""
+        return _NULL_PHASE
+
+    def count(self, name, n=1):
+        """Adds `n` to the counter `name`."""
+        pass
+
+
+class _Phase(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.profiler.durations.setdefault(self.name, 0.0)
+        self.start = self.profiler.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.profiler.clock() - self.start)
+        return False
+
+
+class Profiler(Instrument):
+    """Accumulates the duration and number of calls of every phase and the
+    value of every counter, in the order they were first reported.
+
+    Args:
+        clock: A callable returning the current time in seconds.
+        callback: An optional callable, called as ``callback(name, seconds)``
+            whenever a phase ends.
+
+    """
+    enabled = True
+
+    def __init__(self, clock=time.time, callback=None):
+        self.clock = clock
+        self.callback = callback
+        self.durations = collections.OrderedDict()  # phase -> seconds
+        self.calls = collections.Counter()  # phase -> times entered
+        self.counters = collections.OrderedDict()  # counter -> value
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def record(self, name, seconds):
+        """Adds `seconds` to the duration of the phase `name`."""
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        self.calls[name] += 1
+
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """Returns a human readable breakdown of the phases and counters."""
+        lines = []
+        width = max([len(x) for x in self.durations] +
+                    [len(x) for x in self.counters] + [0])
+
+        for name, seconds in self.durations.iteritems():
+            line = "{0:<{1}}  {2:10.6f}s".format(name, width, seconds)
+            if self.calls[name] > 1:
+                line += "  ({0} calls)".format(self.calls[name])
+            lines.append(line)
+
+        for name, value in self.counters.iteritems():
+            lines.append("{0:<{1}}  {2:>10}".format(name, width, value))
+
+        return "\n".join(lines)
+
+
+_instrument = Instrument()
+
+
+def get():
+    """Returns the installed instrument."""
+    return _instrument
+
+
+def install(instrument):
+    """Installs `instrument` and returns it. Pass ``None`` to go back to the
+    null instrument.
+
+    """
+    global _instrument
+    _instrument = instrument or Instrument()
+    return _instrument
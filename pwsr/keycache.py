@@ -0,0 +1,146 @@
+"""Caches stretched keys (P') so that unlocking a database again does not
+repeat key stretching.
+
+Entries are identified by :func:`cache_id`, a hash of the salt and ITER of
+the database preheader together with the password, so a wrong password never
+matches an entry. ``PWSafeDB`` still checks a cached P' against the stored
+H(P') before using it.
+
+Caches only ever hold keys in memory. The default :class:`KeyCache` holds
+nothing; :class:`MemoryKeyCache` keeps keys for the life of the process, and
+``agent.AgentKeyCache`` keeps them in a running key cache agent so that they
+survive across command line invocations.
+
+Example:
+    >>> keycache.install(keycache.MemoryKeyCache(ttl=300))
+    >>> pwsafe = db.parse(dbfn, dbpw)  # stretches the key
+    >>> pwsafe = db.parse(dbfn, dbpw)  # reuses it
+
+"""
+# builtin
+import time
+import struct
+import hashlib
+
+
+DEFAULT_TTL = 15 * 60  # seconds
+
+
+def cache_id(salt, iterations, key):
+    """Returns the identifier of the P' stretched from `key` with `salt` and
+    `iterations`.
+
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    h = hashlib.sha256(salt)
+    h.update(struct.pack("<L", iterations))
+    h.update(key)
+
+    return h.hexdigest()
+
+
+class KeyCache(object):
+    """The null key cache, and the interface every key cache implements."""
+
+    def get(self, salt, iterations, key):
+        """Returns the cached P' for `key`, `salt` and `iterations`, or
+        None.
+
+        """
+        return None
+
+    def put(self, salt, iterations, key, pp):
+        """Caches the P' `pp` stretched from `key`, `salt` and
+        `iterations`.
+
+        """
+        pass
+
+    def forget(self, salt, iterations, key):
+        """Drops the cached P' for `key`, `salt` and `iterations`."""
+        pass
+
+    def clear(self):
+        """Drops every cached P'."""
+        pass
+
+
+class MemoryKeyCache(KeyCache):
+    """Keeps stretched keys in this process for `ttl` seconds.
+
+    Args:
+        ttl: Seconds an entry stays valid after it was cached.
+        clock: A callable returning the current time in seconds.
+
+    """
+    def __init__(self, ttl=DEFAULT_TTL, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}  # cache_id -> (P', expiry)
+
+    def get_id(self, ident):
+        """Like :meth:`get`, but takes a :func:`cache_id`."""
+        entry = self._entries.get(ident)
+
+        if entry is None:
+            return None
+
+        pp, expiry = entry
+
+        if self.clock() >= expiry:
+            del self._entries[ident]
+            return None
+
+        return pp
+
+    def put_id(self, ident, pp):
+        """Like :meth:`put`, but takes a :func:`cache_id`."""
+        self.expire()
+        self._entries[ident] = (pp, self.clock() + self.ttl)
+
+    def forget_id(self, ident):
+        """Like :meth:`forget`, but takes a :func:`cache_id`."""
+        self._entries.pop(ident, None)
+
+    def get(self, salt, iterations, key):
+        return self.get_id(cache_id(salt, iterations, key))
+
+    def put(self, salt, iterations, key, pp):
+        self.put_id(cache_id(salt, iterations, key), pp)
+
+    def forget(self, salt, iterations, key):
+        self.forget_id(cache_id(salt, iterations, key))
+
+    def clear(self):
+        self._entries.clear()
+
+    def expire(self):
+        """Drops the entries whose TTL has passed."""
+        now = self.clock()
+
+        for ident, (_, expiry) in self._entries.items():
+            if now >= expiry:
+                del self._entries[ident]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = KeyCache()
+
+
+def get():
+    """Returns the installed key cache."""
+    return _cache
+
+
+def install(cache):
+    """Installs `cache` and returns it. Pass ``None`` to go back to the null
+    key cache.
+
+    """
+    global _cache
+    _cache = cache if cache is not None else KeyCache()
+    return _cache
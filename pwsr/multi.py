@@ -0,0 +1,147 @@
+"""Opens and searches several databases at once.
+
+Unlocking a database is dominated by key stretching, which is CPU-bound and
+holds the GIL, so the databases are opened in a pool of worker processes
+rather than threads. Each worker parses one database and sends back only the
+records asked for; see :meth:`.PWSafeV3Record.__getstate__`.
+
+Example:
+    >>> results = multi.open_many(["team-a.psafe3", "team-b.psafe3"], dbpw,
+    ...                           key="gmail")
+    >>> for dbfn, record in multi.merged(results):
+    ...     print dbfn, record
+
+"""
+# builtin
+import glob
+import multiprocessing
+
+# internal
+from . import db, errors, utils
+
+
+# The errors which fail a single database without failing the others.
+VAULT_ERRORS = (
+    errors.InvalidDatabaseError,
+    errors.InvalidPasswordError,
+    errors.IntegrityError,
+    IOError,
+    OSError,
+)
+
+
+class VaultResult(object):
+    """The outcome of opening one database.
+
+    Attributes:
+        dbfn: The database file.
+        records: The matching records. Empty if the database failed to open.
+        error: The exception raised while opening the database, or None.
+
+    """
+    __slots__ = ('dbfn', 'records', 'error')
+
+    def __init__(self, dbfn, records=None, error=None):
+        self.dbfn = dbfn
+        self.records = records or []
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def expand(patterns):
+    """Returns the database files named by `patterns`, a list of paths or
+    glob patterns, without duplicates. Patterns which match nothing are kept
+    as they are so that opening them reports the missing file.
+
+    """
+    dbfns = []
+
+    for pattern in patterns:
+        pattern = utils.abspath(pattern)
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        dbfns.extend(x for x in matches if x not in dbfns)
+
+    return dbfns
+
+
+def open_vault(dbfn, dbpw, key=None, fields=None, verify=True, where=None):
+    """Opens `dbfn` and returns a :class:`VaultResult` holding the records
+    matching `key` (see :func:`.find_record`) and the query predicates
+    `where` (see :func:`.query_records`), or every record if neither is
+    given. A database without a match is not an error.
+
+    """
+    try:
+        pwsafe = db.parse(dbfn, dbpw, verify)
+    except VAULT_ERRORS as ex:
+        return VaultResult(dbfn, error=ex)
+
+    if key is None and not where:
+        return VaultResult(dbfn, pwsafe.records)
+
+    try:
+        if where:
+            records = utils.query_records(pwsafe, where, key, fields)
+        else:
+            records = utils.find_record(pwsafe, key, True, fields)
+    except errors.KeyLookupError:
+        records = []
+
+    return VaultResult(dbfn, records)
+
+
+def _open_vault(args):
+    return open_vault(*args)
+
+
+def open_many(dbfns, dbpw, key=None, fields=None, processes=None,
+              verify=True, where=None):
+    """Opens every database in `dbfns` concurrently. See :func:`open_vault`.
+
+    Args:
+        dbfns: The database files.
+        dbpw: The password of the databases.
+        key: The search key, or None to return every record.
+        fields: The field types searched. See :meth:`.PWSafeDB.search`.
+        processes: The number of worker processes. Defaults to one per
+            database, up to the number of CPUs. Databases are opened in this
+            process if there is only one, or if `processes` is 1.
+        verify: Passed to :func:`.db.parse`.
+        where: Query predicates the records must satisfy.
+
+    Returns:
+        A :class:`VaultResult` for each database, in the order of `dbfns`.
+
+    """
+    tasks = [(dbfn, dbpw, key, fields, verify, where) for dbfn in dbfns]
+    processes = processes or min(len(tasks), multiprocessing.cpu_count())
+
+    if len(tasks) < 2 or processes < 2:
+        return [_open_vault(x) for x in tasks]
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        # One database per task: each task is a whole key stretch.
+        results = pool.map(_open_vault, tasks, chunksize=1)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
+
+
+def merged(results):
+    """Yields ``(dbfn, record)`` for every record of the successful
+    `results`.
+
+    """
+    for result in results:
+        for record in result.records:
+            yield result.dbfn, record
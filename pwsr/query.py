@@ -0,0 +1,276 @@
+"""Field predicates for structured record queries.
+
+A predicate has the form ``FIELD OP VALUE``, such as ``expiry<2026-11-01``
+or ``protected=1``. ``FIELD`` is one of the names in :data:`FIELDS` or a field
+type written in hex (``0x0a``), and ``OP`` is one of ``=``, ``!=``, ``<``,
+``<=``, ``>``, ``>=`` or ``~`` (case-insensitive substring, text fields only).
+A record without the field never matches.
+
+Field values are decoded according to the type table of
+:class:`.PWSafeV3Record`:
+
+* ``time_t`` fields are compared as seconds since the epoch. Query values may
+  be an integer, a UTC date (``2026-10-01``) or date and time
+  (``2026-10-01T12:00:00``), ``now``, or an offset from now such as ``-365d``
+  or ``+2w`` (units ``s``, ``m``, ``h``, ``d`` and ``w``).
+* 1, 2 and 4 byte fields are little-endian integers.
+* UUIDs are compared as :class:`uuid.UUID`, and may be given with or without
+  hyphens.
+* Everything else is compared as text.
+
+Example:
+    >>> pwsafe.query("pmtime<-365d", "protected!=1")
+
+"""
+# builtin
+import re
+import time
+import uuid
+import calendar
+import datetime
+import collections
+
+# internal
+from . import errors
+
+
+KIND_TEXT = 'text'
+KIND_TIME = 'time'
+KIND_INT = 'int'
+KIND_UUID = 'uuid'
+
+# Kinds with a meaningful order, which are answered from range indexes.
+ORDERED_KINDS = (KIND_TIME, KIND_INT)
+
+# Query name -> (field type, kind)
+FIELDS = collections.OrderedDict([
+    ('uuid',            (0x01, KIND_UUID)),
+    ('group',           (0x02, KIND_TEXT)),
+    ('title',           (0x03, KIND_TEXT)),
+    ('username',        (0x04, KIND_TEXT)),
+    ('notes',           (0x05, KIND_TEXT)),
+    ('password',        (0x06, KIND_TEXT)),
+    ('ctime',           (0x07, KIND_TIME)),
+    ('pmtime',          (0x08, KIND_TIME)),
+    ('atime',           (0x09, KIND_TIME)),
+    ('expiry',          (0x0a, KIND_TIME)),
+    ('mtime',           (0x0c, KIND_TIME)),
+    ('url',             (0x0d, KIND_TEXT)),
+    ('autotype',        (0x0e, KIND_TEXT)),
+    ('history',         (0x0f, KIND_TEXT)),
+    ('policy',          (0x10, KIND_TEXT)),
+    ('expiry_interval', (0x11, KIND_INT)),
+    ('run_command',     (0x12, KIND_TEXT)),
+    ('dca',             (0x13, KIND_INT)),
+    ('email',           (0x14, KIND_TEXT)),
+    ('protected',       (0x15, KIND_INT)),
+    ('symbols',         (0x16, KIND_TEXT)),
+    ('shift_dca',       (0x17, KIND_INT)),
+    ('policy_name',     (0x18, KIND_TEXT)),
+])
+
+_KINDS = dict(FIELDS.itervalues())  # field type -> kind
+
+OPERATORS = ('=', '!=', '<', '<=', '>', '>=', '~')
+
+_PREDICATE = re.compile(
+    r"^\s*(?P<field>0x[0-9a-fA-F]{1,2}|[A-Za-z_]+)\s*"
+    r"(?P<op>!=|<=|>=|=|<|>|~)\s*(?P<value>.*?)\s*$"
+)
+
+_OFFSET = re.compile(r"^(?P<sign>[+-])(?P<n>\d+)(?P<unit>[smhdw])$")
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+_DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S")
+
+
+def kind(ftype):
+    """Returns the kind of value held by fields of type `ftype`."""
+    return _KINDS.get(ftype, KIND_TEXT)
+
+
+def decode(kind, value):
+    """Returns the field value `value` decoded as `kind`, or None if it
+    cannot be decoded.
+
+    """
+    if kind == KIND_TEXT:
+        return value
+    elif kind == KIND_UUID:
+        return uuid.UUID(bytes=value) if len(value) == 16 else None
+    elif not 0 < len(value) <= 8:
+        return None
+
+    # time_t and integer fields are little-endian; time_t is normally 4
+    # bytes but may be stored in 8.
+    return sum(ord(c) << (8 * i) for i, c in enumerate(value))
+
+
+def parse_time(text, now=None):
+    """Returns the time described by `text` in seconds since the epoch. See
+    the module documentation for the accepted forms.
+
+    Raises:
+        .QueryError: If `text` is not a time.
+
+    """
+    now = int(time.time() if now is None else now)
+
+    if text == 'now':
+        return now
+
+    match = _OFFSET.match(text)
+    if match:
+        offset = int(match.group('n')) * _UNITS[match.group('unit')]
+        return now + offset if match.group('sign') == '+' else now - offset
+
+    if text.isdigit():
+        return int(text)
+
+    for fmt in _DATE_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(parsed.utctimetuple())
+
+    raise errors.QueryError("Invalid time: '{0}'".format(text))
+
+
+def parse_value(kind, text, now=None):
+    """Returns the query value `text` converted for comparison with field
+    values of `kind`.
+
+    Raises:
+        .QueryError: If `text` is not a valid value of `kind`.
+
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    if kind == KIND_TIME:
+        return parse_time(text, now)
+
+    try:
+        if kind == KIND_INT:
+            return int(text, 0)
+        elif kind == KIND_UUID:
+            return uuid.UUID(text)
+    except ValueError:
+        error = "Invalid {0} value: '{1}'".format(kind, text)
+        raise errors.QueryError(error)
+
+    return text
+
+
+class Predicate(object):
+    """A single ``FIELD OP VALUE`` condition.
+
+    Attributes:
+        ftype: The field type.
+        kind: The kind of the field values. See :func:`kind`.
+        op: The operator.
+        value: The value compared against, converted for `kind`.
+
+    """
+    __slots__ = ('ftype', 'kind', 'op', 'value')
+
+    def __init__(self, ftype, op, value):
+        if op not in OPERATORS:
+            raise errors.QueryError("Invalid operator: '{0}'".format(op))
+
+        self.ftype = ftype
+        self.kind = kind(ftype)
+        self.op = op
+        self.value = value
+
+        if op == '~' and self.kind != KIND_TEXT:
+            raise errors.QueryError("'~' only applies to text fields")
+        elif self.kind == KIND_UUID and op not in ('=', '!='):
+            raise errors.QueryError("UUIDs can only be compared with = or !=")
+
+        if op == '~':
+            self.value = value.lower()
+
+    @property
+    def ranged(self):
+        """True if the predicate selects a range of a range index."""
+        return self.kind in ORDERED_KINDS and self.op not in ('!=', '~')
+
+    def bounds(self):
+        """Returns the ``(low, high, low_inclusive, high_inclusive)`` range
+        of values selected by a :attr:`ranged` predicate. Open ends are None.
+
+        """
+        op, value = self.op, self.value
+
+        if op == '=':
+            return value, value, True, True
+        elif op in ('<', '<='):
+            return None, value, True, op == '<='
+        else:
+            return value, None, op == '>=', True
+
+    def match(self, value):
+        """Returns True if the decoded field value `value` satisfies the
+        predicate. A missing (None) value never does.
+
+        """
+        if value is None:
+            return False
+
+        op, expected = self.op, self.value
+
+        if op == '=':
+            return value == expected
+        elif op == '!=':
+            return value != expected
+        elif op == '<':
+            return value < expected
+        elif op == '<=':
+            return value <= expected
+        elif op == '>':
+            return value > expected
+        elif op == '>=':
+            return value >= expected
+        else:
+            return expected in value.lower()
+
+    def __repr__(self):
+        return "Predicate(0x{0:02x} {1} {2!r})".format(
+            self.ftype, self.op, self.value
+        )
+
+
+def parse(expr, now=None):
+    """Parses the predicate `expr`, a string such as ``"expiry<now"``.
+    :class:`Predicate` instances are returned unchanged.
+
+    Args:
+        expr: The predicate.
+        now: The time relative times are measured from. Defaults to the
+            current time.
+
+    Raises:
+        .QueryError: If `expr` is not a valid predicate.
+
+    """
+    if isinstance(expr, Predicate):
+        return expr
+
+    match = _PREDICATE.match(expr)
+    if not match:
+        raise errors.QueryError("Invalid predicate: '{0}'".format(expr))
+
+    name = match.group('field').lower()
+
+    if name.startswith('0x'):
+        ftype = int(name, 16)
+    elif name in FIELDS:
+        ftype = FIELDS[name][0]
+    else:
+        raise errors.QueryError("Unknown field: '{0}'".format(name))
+
+    value = parse_value(kind(ftype), match.group('value'), now)
+    return Predicate(ftype, match.group('op'), value)
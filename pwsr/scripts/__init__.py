@@ -1,13 +1,25 @@
 # builtin
+import os
 import sys
 import json
+import errno
+import signal
+import contextlib
 
 # internal
+import pwsr.db as db
+import pwsr.sync as sync
+import pwsr.multi as multi
+import pwsr.agent as agent
+import pwsr.keycache as keycache
+import pwsr.instrument as instrument
 import pwsr.utils as utils
+import pwsr.errors as errors
 
 # Constants
 EXIT_SUCCESS = 0
 EXIT_FAILURE = 1
+EXIT_BROKEN_PIPE = 128 + signal.SIGPIPE  # as if killed by SIGPIPE
 HIDDEN_PASSWORD = "*" * 8
 DEFAULT_CONFIG_FN = utils.abspath("~/.pwsr/conf.json")
 
@@ -54,6 +66,199 @@ def save_conf(config, fn=None):
         json.dump(config, f)
 
 
+def connect_agent(dbfn, dbpw, config=None):
+    """Returns an :class:`.AgentClient` for a running pwsr agent which has
+    `dbfn` unlocked, or ``None`` if there is no such agent. The agent only
+    answers lookups made with the database password `dbpw`.
+
+    """
+    path = (config or {}).get('AGENT_SOCK')
+
+    with utils.ignored(errors.AgentError):
+        return agent.connect(dbfn, path, dbpw)
+
+
+def connect_key_cache(config=None):
+    """Installs and returns an :class:`.AgentKeyCache` for a running key
+    cache agent, or returns ``None`` if there is no such agent.
+
+    """
+    path = (config or {}).get('KEYCACHE_SOCK')
+    cache = agent.connect_key_cache(path)
+
+    if cache is not None:
+        keycache.install(cache)
+
+    return cache
+
+
+def fetch_remote_db(remote, dbpw):
+    """Returns the path of an up to date local copy of the database synced to
+    the directory or HTTP URL `remote` by pwsr-sync. See
+    :func:`.sync.fetch_vault`.
+
+    """
+    backend = sync.open_backend(remote)
+
+    try:
+        return sync.fetch_vault(backend, dbpw)
+    except KeyError:
+        error = "No database has been synced to {0}".format(remote)
+        raise errors.SyncError(error)
+
+
+class BatchLookup(object):
+    """Resolves keys through a running agent, or else through the database,
+    which is unlocked and parsed at most once for all lookups.
+
+    Args:
+        client: An :class:`.AgentClient`, or None.
+        dbfn: The database file.
+        dbpw: The database password.
+
+    """
+    def __init__(self, client, dbfn, dbpw):
+        self.client = client
+        self.dbfn = dbfn
+        self.dbpw = dbpw
+        self._pwsafe = None
+
+    @property
+    def pwsafe(self):
+        if self._pwsafe is None:
+            self._pwsafe = db.parse(self.dbfn, self.dbpw)
+        return self._pwsafe
+
+    def get(self, key):
+        """Returns the record matching `key`. See :func:`.find_record`."""
+        if self.client:
+            try:
+                return self.client.get(key)
+            except errors.AgentError:
+                self.client = None
+
+        return utils.find_record(self.pwsafe, key)
+
+    def search(self, key, fields=None):
+        """Returns the records matching `key`. See :func:`.find_record`."""
+        if self.client:
+            try:
+                return self.client.search(key, fields)
+            except errors.AgentError:
+                self.client = None
+
+        return utils.find_record(self.pwsafe, key, True, fields)
+
+
+def _text(value):
+    value = getattr(value, 'value', value)
+
+    if value is None:
+        return None
+
+    return value.decode('utf-8', 'replace')
+
+
+def record_to_json(record, hide=False):
+    """Returns a JSON serializable dictionary for `record`, which is either
+    a :class:`.PWSafeV3Record` or an :class:`.AgentRecord`.
+
+    """
+    out = {}
+
+    for name in ('title', 'group', 'username', 'password'):
+        try:
+            out[name] = _text(getattr(record, name))
+        except KeyError:
+            out[name] = None
+
+    if hide and out['password'] is not None:
+        out['password'] = HIDDEN_PASSWORD
+
+    return out
+
+
+def run_batch(lookup, hide=False, infile=None, outfile=None):
+    """Reads keys from `infile` (default: stdin), one per line, and writes
+    one line of JSON per key to `outfile` (default: stdout) as soon as the
+    key is resolved::
+
+        {"key": ..., "records": [{"title": ..., ...}, ...]}
+        {"key": ..., "error": "..."}
+
+    Args:
+        lookup: A callable which returns the record or list of records
+            matching a key, and raises ``KeyLookupError`` if there is none.
+        hide: If True, replace passwords with asterisks.
+
+    """
+    infile = infile or sys.stdin
+    outfile = outfile or sys.stdout
+
+    # Avoid the read-ahead of file iteration so keys are answered as they
+    # arrive on a pipe.
+    for line in iter(infile.readline, ""):
+        key = line.rstrip("\r\n")
+
+        if not key:
+            continue
+
+        result = {'key': _text(key)}
+
+        try:
+            records = lookup(key)
+        except errors.KeyLookupError as ex:
+            result['error'] = str(ex)
+        else:
+            if not isinstance(records, list):
+                records = [records]
+            result['records'] = [record_to_json(x, hide) for x in records]
+
+        outfile.write(json.dumps(result) + "\n")
+        outfile.flush()
+
+
+@contextlib.contextmanager
+def piped_output():
+    """Exits quietly with ``EXIT_BROKEN_PIPE`` if stdout is closed by its
+    reader while output is written within the block, as when it is piped
+    to ``head``, instead of printing a traceback.
+
+    """
+    try:
+        yield
+    except IOError as ex:
+        if ex.errno != errno.EPIPE:
+            raise
+
+        # Output still buffered for stdout would fail again at exit.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(EXIT_BROKEN_PIPE)
+
+
+def start_profile():
+    """Installs and returns an :class:`.instrument.Profiler`."""
+    return instrument.install(instrument.Profiler())
+
+
+def phase(name):
+    """Times the phase `name` with the installed instrument."""
+    return instrument.get().phase(name)
+
+
+def print_profile(profiler):
+    """Writes the breakdown collected by `profiler` to stderr. Does nothing
+    if `profiler` is None.
+
+    """
+    if profiler is None:
+        return
+
+    for line in profiler.report().splitlines():
+        sys.stderr.write("[profile] {0}\n".format(line))
+
+
 def error(msg, kill=False):
     err = "[!] {0}\n".format(msg)
     sys.stderr.write(err)
@@ -66,7 +271,7 @@ def info(msg):
     print "[-]", str(msg)
 
 
-def print_record(record, hide=False):
+def print_record(record, hide=False, source=None):
     title = record.title
     group = record.group
     username = record.username
@@ -74,9 +279,35 @@ def print_record(record, hide=False):
 
     out = "[{}] '{}' '{}' '{}'"
     out = out.format(group, title, username, password)
+
+    if source:
+        out = "{}: {}".format(source, out)
+
     print out
 
 
 def print_records(records, hide=False):
-    for record in sorted(records, key=lambda x: str(x.group)):
-        print_record(record, hide)
\ No newline at end of file
+    """Prints `records` ordered by group. A :class:`.PWSafeDB` is listed
+    in the order of its group tree, without sorting.
+
+    """
+    if isinstance(records, db.PWSafeDB):
+        records = records.grouped()
+    else:
+        records = sorted(records, key=lambda x: str(x.group))
+
+    for record in records:
+        print_record(record, hide)
+
+
+def print_vault_results(results, hide=False):
+    """Prints the records of several databases, each prefixed with the name
+    of the database it came from. See :func:`.multi.open_many`.
+
+    """
+    records = sorted(
+        multi.merged(results), key=lambda x: (str(x[1].group), x[0])
+    )
+
+    for dbfn, record in records:
+        print_record(record, hide, os.path.basename(dbfn))
\ No newline at end of file
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# builtin
+import os
+import sys
+import argparse
+
+# internal
+import pwsr
+import pwsr.db as db
+import pwsr.cipher as cipher
+import pwsr.agent as agent
+import pwsr.keycache as keycache
+import pwsr.utils as utils
+import pwsr.errors as errors
+import pwsr.scripts as scripts
+
+
+def get_arg_parser():
+    version = pwsr.__version__
+    parser = argparse.ArgumentParser(
+        description="pwsr-agent version {0}".format(version)
+    )
+
+    parser.add_argument(
+        "--db",
+        dest="dbfn",
+        default=None,
+        help="Path to PasswordSafe Database File"
+    )
+
+    parser.add_argument(
+        "--dbpw",
+        dest="dbpw",
+        default=None,
+        help="PasswordSafe Database key"
+    )
+
+    parser.add_argument(
+        "--socket",
+        dest="socket",
+        default=None,
+        help="Agent socket path (default: $PWSR_AGENT_SOCK or "
+             "~/.pwsr/agent.sock)"
+    )
+
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        default=agent.DEFAULT_IDLE_TIMEOUT,
+        type=int,
+        help="Lock the agent after this many idle seconds"
+    )
+
+    parser.add_argument(
+        "--key-cache",
+        dest="key_cache",
+        default=False,
+        action="store_true",
+        help="Run a key cache agent, which holds stretched keys in memory "
+             "for --ttl seconds instead of an unlocked database (socket: "
+             "$PWSR_KEYCACHE_SOCK or ~/.pwsr/keys.sock)"
+    )
+
+    parser.add_argument(
+        "--ttl",
+        dest="ttl",
+        default=keycache.DEFAULT_TTL,
+        type=int,
+        help="Seconds the key cache agent keeps each key"
+    )
+
+    parser.add_argument(
+        "--foreground",
+        dest="foreground",
+        default=False,
+        action="store_true",
+        help="Do not detach from the terminal"
+    )
+
+    parser.add_argument(
+        "--lock",
+        dest="lock",
+        default=False,
+        action="store_true",
+        help="Lock a running agent. With --key-cache, drop every cached "
+             "key and stop the key cache agent"
+    )
+
+    return parser
+
+
+def validate_params(argparser, **kwargs):
+    args = kwargs['args']
+
+    if args.lock or args.key_cache:
+        return
+
+    if not (kwargs['dbfn'] and kwargs['dbpw']):
+        error = "Must provide both a pwsafe database and a password either."
+        raise scripts.ArgumentError(error, show_help=True)
+
+
+def lock(path, key_cache=False):
+    if key_cache:
+        client = agent.connect_key_cache(path)
+    else:
+        client = agent.connect(path=path)
+
+    if not client:
+        raise errors.AgentError("No agent is running")
+
+    client.lock()
+    scripts.info("Agent locked")
+
+
+def daemonize():
+    """Detaches the current process from the terminal. The parent process
+    exits once the child has been forked.
+
+    Parallel decryption workers are stopped first: the forked parent exits
+    without running its exit handlers, which would leave them orphaned with
+    the database key.
+
+    """
+    cipher.close_pool()
+
+    if os.fork():
+        os._exit(scripts.EXIT_SUCCESS)
+
+    os.setsid()
+
+    if os.fork():
+        os._exit(scripts.EXIT_SUCCESS)
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+
+def main():
+    # Parse the commandline arguments
+    argparser = get_arg_parser()
+    args = argparser.parse_args()
+
+    # Attempt to load a pwsafe-remote configuration file
+    config  = scripts.load_conf()
+
+    # Extract pwsafe-remote parameters
+    dbfn    = args.dbfn or config.get('PWDB')
+    dbfn    = utils.abspath(dbfn) if dbfn else None
+    dbpw    = args.dbpw or config.get('PWDB_KEY')
+    if args.key_cache:
+        path = agent.keycache_socket_path(
+            args.socket or config.get('KEYCACHE_SOCK')
+        )
+    else:
+        path = agent.socket_path(args.socket or config.get('AGENT_SOCK'))
+
+    try:
+        # Attempt to validate input parameters
+        validate_params(argparser, dbfn=dbfn, dbpw=dbpw, args=args)
+
+        if args.lock:
+            lock(path, args.key_cache)
+            sys.exit(scripts.EXIT_SUCCESS)
+
+        if args.key_cache:
+            server = agent.KeyCacheServer(path, args.ttl, args.timeout)
+            scripts.info("Key cache listening on {0}".format(path))
+
+            if not args.foreground:
+                daemonize()
+
+            server.serve_until_locked()
+            sys.exit(scripts.EXIT_SUCCESS)
+
+        # Unlock the database before detaching so errors are visible
+        pwsafe = db.parse(dbfn, dbpw)
+        server = agent.AgentServer(path, pwsafe, dbfn, dbpw, args.timeout)
+        scripts.info("Agent listening on {0}".format(path))
+
+        if not args.foreground:
+            daemonize()
+
+        server.serve_until_locked()
+    except scripts.ArgumentError as ex:
+        if ex.show_help:
+            argparser.print_help()
+        scripts.error(ex, kill=True)
+    except (errors.AgentError, errors.InvalidPasswordError,
+            errors.InvalidDatabaseError, errors.IntegrityError) as ex:
+        scripts.error(ex, kill=True)
+
+    sys.exit(scripts.EXIT_SUCCESS)
+
+if __name__ == "__main__":
+    main()
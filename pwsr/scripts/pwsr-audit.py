@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# builtin
+import sys
+import json
+import argparse
+
+# internal
+import pwsr
+import pwsr.audit as audit
+import pwsr.utils as utils
+import pwsr.errors as errors
+import pwsr.scripts as scripts
+
+
+def get_arg_parser():
+    version = pwsr.__version__
+    parser = argparse.ArgumentParser(
+        description="pwsr-audit version {0}. Reports reused passwords, "
+                    "passwords which have not been changed for a long time "
+                    "and passwords which violate their policy, as JSON "
+                    "lines".format(version)
+    )
+
+    parser.add_argument(
+        "--db",
+        dest="dbfn",
+        default=None,
+        help="Path to PasswordSafe Database File"
+    )
+
+    parser.add_argument(
+        "--dbpw",
+        dest="dbpw",
+        default=None,
+        help="Passwor dSafe Database key"
+    )
+
+    parser.add_argument(
+        "--remote",
+        dest="remote",
+        default=None,
+        help="Read the database synced to this directory or HTTP URL by "
+             "pwsr-sync instead of --db, through the local cache"
+    )
+
+    parser.add_argument(
+        "--max-age",
+        dest="max_age",
+        default=audit.DEFAULT_MAX_AGE,
+        type=int,
+        metavar="DAYS",
+        help="Report passwords last changed more than DAYS days ago "
+             "(default: %d). 0 disables the check" % audit.DEFAULT_MAX_AGE
+    )
+
+    parser.add_argument(
+        "--no-history",
+        dest="history",
+        default=True,
+        action="store_false",
+        help="Ignore password histories when looking for reused passwords"
+    )
+
+    parser.add_argument(
+        "--key-cache",
+        dest="key_cache",
+        default=False,
+        action="store_true",
+        help="Reuse and keep stretched keys in a running "
+             "'pwsr-agent --key-cache'"
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        default=False,
+        action="store_true",
+        help="Print a timing breakdown to stderr"
+    )
+
+    return parser
+
+
+def validate_params(argparser, **kwargs):
+    if not ((kwargs['dbfn'] or kwargs['remote']) and kwargs['dbpw']):
+        error = "Must provide both a pwsafe database and a password."
+        raise scripts.ArgumentError(error, show_help=True)
+
+    if kwargs['args'].max_age < 0:
+        error = "--max-age must not be negative"
+        raise scripts.ArgumentError(error)
+
+
+def write_findings(findings, outfile=None):
+    """Writes each finding as one line of JSON to `outfile` (default:
+    stdout) as it is produced.
+
+    """
+    outfile = outfile or sys.stdout
+
+    for finding in findings:
+        outfile.write(json.dumps(finding) + "\n")
+
+    outfile.flush()
+
+
+def main():
+    # Parse the commandline arguments
+    argparser = get_arg_parser()
+    args = argparser.parse_args()
+
+    # Attempt to load a pwsafe-remote configuration file
+    config  = scripts.load_conf()
+
+    # Extract pwsafe-remote parameters
+    dbfn    = args.dbfn or config.get('PWDB')
+    dbpw    = args.dbpw or config.get('PWDB_KEY')
+    remote  = args.remote or config.get('REMOTE')
+    profile = scripts.start_profile() if args.profile else None
+
+    try:
+        # Attempt to validate input parameters
+        validate_params(argparser, dbfn=dbfn, dbpw=dbpw, remote=remote,
+                        args=args)
+
+        # Read a remote database from the local cache if it is current
+        if remote:
+            with scripts.phase('fetch_remote'):
+                dbfn = scripts.fetch_remote_db(remote, dbpw)
+        else:
+            dbfn = utils.abspath(dbfn)
+
+        if args.key_cache or config.get('KEY_CACHE'):
+            with scripts.phase('key_cache_connect'):
+                scripts.connect_key_cache(config)
+
+        findings = audit.audit_file(
+            dbfn, dbpw, max_age=args.max_age or None, history=args.history
+        )
+
+        with scripts.piped_output(), scripts.phase('audit'):
+            write_findings(findings)
+    except scripts.ArgumentError as ex:
+        if ex.show_help:
+            argparser.print_help()
+        scripts.error(ex, kill=True)
+    except (errors.IntegrityError, errors.InvalidDatabaseError,
+            errors.InvalidPasswordError, errors.SyncError) as ex:
+        scripts.error(ex, kill=True)
+    finally:
+        scripts.print_profile(profile)
+
+    sys.exit(scripts.EXIT_SUCCESS)
+
+if __name__ == "__main__":
+    main()
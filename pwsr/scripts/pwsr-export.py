@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# builtin
+import os
+import sys
+import argparse
+
+# internal
+import pwsr
+import pwsr.db as db
+import pwsr.query as query
+import pwsr.utils as utils
+import pwsr.errors as errors
+import pwsr.scripts as scripts
+
+
+def get_arg_parser():
+    version = pwsr.__version__
+    parser = argparse.ArgumentParser(
+        description="pwsr-export version {0}".format(version)
+    )
+
+    parser.add_argument(
+        "--db",
+        dest="dbfn",
+        default=None,
+        help="Path to PasswordSafe Database File"
+    )
+
+    parser.add_argument(
+        "--dbpw",
+        dest="dbpw",
+        default=None,
+        help="Passwor dSafe Database key"
+    )
+
+    parser.add_argument(
+        "--remote",
+        dest="remote",
+        default=None,
+        help="Read the database synced to this directory or HTTP URL by "
+             "pwsr-sync instead of --db, through the local cache"
+    )
+
+    parser.add_argument(
+        "--format",
+        dest="format",
+        default=db.FORMAT_JSONL,
+        choices=db.EXPORT_FORMATS,
+        help="Output format (default: %s)" % db.FORMAT_JSONL
+    )
+
+    parser.add_argument(
+        "--fields",
+        dest="fields",
+        default=",".join(db.EXPORT_FIELDS),
+        help="Comma separated fields to export (default: %s). One of: %s" % (
+            ",".join(db.EXPORT_FIELDS), ", ".join(query.FIELDS)
+        )
+    )
+
+    parser.add_argument(
+        "--hide",
+        dest="hide",
+        default=False,
+        action="store_true",
+        help="Replace passwords and password histories with *'s"
+    )
+
+    parser.add_argument(
+        "--output",
+        dest="output",
+        default=None,
+        help="Write to this file instead of stdout"
+    )
+
+    parser.add_argument(
+        "--key-cache",
+        dest="key_cache",
+        default=False,
+        action="store_true",
+        help="Reuse and keep stretched keys in a running "
+             "'pwsr-agent --key-cache'"
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        default=False,
+        action="store_true",
+        help="Print a timing breakdown to stderr"
+    )
+
+    return parser
+
+
+def validate_params(argparser, **kwargs):
+    if not ((kwargs['dbfn'] or kwargs['remote']) and kwargs['dbpw']):
+        error = "Must provide both a pwsafe database and a password."
+        raise scripts.ArgumentError(error, show_help=True)
+
+    if not kwargs['fields']:
+        error = "Must export at least one field."
+        raise scripts.ArgumentError(error, show_help=True)
+
+    unknown = [x for x in kwargs['fields'] if x not in query.FIELDS]
+    if unknown:
+        error = "Unknown fields: {0}".format(", ".join(unknown))
+        raise scripts.ArgumentError(error, show_help=True)
+
+
+def open_output(fn=None):
+    """Returns a binary file object for `fn`, or for stdout if `fn` is
+    None, buffered in ``EXPORT_BUFFER_SIZE`` blocks.
+
+    """
+    if fn:
+        return open(utils.abspath(fn), 'wb', db.EXPORT_BUFFER_SIZE)
+
+    return os.fdopen(os.dup(sys.stdout.fileno()), 'wb',
+                     db.EXPORT_BUFFER_SIZE)
+
+
+def main():
+    # Parse the commandline arguments
+    argparser = get_arg_parser()
+    args = argparser.parse_args()
+
+    # Attempt to load a pwsafe-remote configuration file
+    config  = scripts.load_conf()
+
+    # Extract pwsafe-remote parameters
+    dbfn    = args.dbfn or config.get('PWDB')
+    dbpw    = args.dbpw or config.get('PWDB_KEY')
+    remote  = args.remote or config.get('REMOTE')
+    fields  = [x.strip() for x in args.fields.split(",") if x.strip()]
+    profile = scripts.start_profile() if args.profile else None
+
+    try:
+        # Attempt to validate input parameters
+        validate_params(argparser, dbfn=dbfn, dbpw=dbpw, remote=remote,
+                        fields=fields)
+
+        # Read a remote database from the local cache if it is current
+        if remote:
+            with scripts.phase('fetch_remote'):
+                dbfn = scripts.fetch_remote_db(remote, dbpw)
+        else:
+            dbfn = utils.abspath(dbfn)
+
+        if args.key_cache or config.get('KEY_CACHE'):
+            with scripts.phase('key_cache_connect'):
+                scripts.connect_key_cache(config)
+
+        # Records are written as they are decrypted
+        with scripts.piped_output(), open_output(args.output) as outfile:
+            with scripts.phase('export'):
+                db.export(dbfn, dbpw, outfile, fmt=args.format,
+                          fields=fields, redact=args.hide)
+    except scripts.ArgumentError as ex:
+        if ex.show_help:
+            argparser.print_help()
+        scripts.error(ex, kill=True)
+    except (errors.IntegrityError, errors.InvalidDatabaseError,
+            errors.InvalidPasswordError, errors.SyncError) as ex:
+        scripts.error(ex, kill=True)
+    finally:
+        scripts.print_profile(profile)
+
+    sys.exit(scripts.EXIT_SUCCESS)
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,6 @@
 # builtin
 import sys
 import argparse
-import collections
 
 # external
 import pyperclip
@@ -36,6 +35,14 @@ def get_arg_parser():
         help="Passwor dSafe Database key"
     )
 
+    parser.add_argument(
+        "--remote",
+        dest="remote",
+        default=None,
+        help="Read the database synced to this directory or HTTP URL by "
+             "pwsr-sync instead of --db, through the local cache"
+    )
+
     parser.add_argument(
         "--hide",
         dest="hide",
@@ -52,6 +59,42 @@ def get_arg_parser():
         help="List Password Safe entries"
     )
 
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        default=False,
+        action="store_true",
+        help="Read keys from stdin, one per line, and print the results as "
+             "JSON lines"
+    )
+
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        default=True,
+        action="store_false",
+        help="Stop reading the database at the first exact title match. "
+             "Faster on large databases, but the HMAC is not checked, so a "
+             "tampered database is not detected"
+    )
+
+    parser.add_argument(
+        "--key-cache",
+        dest="key_cache",
+        default=False,
+        action="store_true",
+        help="Reuse and keep stretched keys in a running "
+             "'pwsr-agent --key-cache'"
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        default=False,
+        action="store_true",
+        help="Print a timing breakdown to stderr"
+    )
+
     parser.add_argument(
         "key",
         metavar="KEY",
@@ -66,11 +109,16 @@ def get_arg_parser():
 def validate_params(argparser, **kwargs):
     args = kwargs['args']
 
-    if not (kwargs['dbfn'] and kwargs['dbpw']):
+    if not ((kwargs['dbfn'] or kwargs['remote']) and kwargs['dbpw']):
         error = "Must provide both a pwsafe database and a password either."
         raise scripts.ArgumentError(error, show_help=True)
 
-    if not (kwargs['key'] or args.list):
+    if args.batch and (kwargs['key'] or args.list):
+        error = "--batch reads keys from stdin and cannot be combined with " \
+                "a key or --list"
+        raise scripts.ArgumentError(error, show_help=True)
+
+    if not (kwargs['key'] or args.list or args.batch):
         error = "Must provide a pwsafe key to look up, or --list"
         raise scripts.ArgumentError(error, show_help=True)
 
@@ -79,6 +127,23 @@ def clip_password(password):
     pyperclip.copy(str(password))
 
 
+def list_records(client, dbfn, dbpw):
+    if client:
+        with utils.ignored(errors.AgentError):
+            return client.list()
+
+    return db.parse(dbfn, dbpw)
+
+
+def get_record(client, dbfn, dbpw, key, verify=True):
+    if client:
+        with utils.ignored(errors.AgentError):
+            return client.get(key)
+
+    # Only the matching records are kept in memory
+    return db.find_record(dbfn, dbpw, key, verify)
+
+
 def main():
     # Parse the commandline arguments
     argparser = get_arg_parser()
@@ -89,31 +154,59 @@ def main():
 
     # Extract pwsafe-remote parameters
     dbfn    = args.dbfn or config.get('PWDB')
-    dbfn    = utils.abspath(dbfn)
+    dbfn    = utils.abspath(dbfn) if dbfn else None
     dbpw    = args.dbpw or config.get('PWDB_KEY')
+    remote  = args.remote or config.get('REMOTE')
     key     = args.key
     hide    = args.hide
+    profile = scripts.start_profile() if args.profile else None
 
     try:
         # Attempt to validate input parameters
-        validate_params(argparser, dbfn=dbfn, dbpw=dbpw, key=key, args=args)
-
-        # Parse the pwsafe database
-        pwsafe = db.parse(dbfn, dbpw)
-
-        if args.list:
-            scripts.print_records(pwsafe, hide)
+        validate_params(argparser, dbfn=dbfn, dbpw=dbpw, key=key,
+                        remote=remote, args=args)
+
+        # Read a remote database from the local cache if it is current
+        if remote:
+            with scripts.phase('fetch_remote'):
+                dbfn = scripts.fetch_remote_db(remote, dbpw)
+
+        # Use a running agent if there is one
+        with scripts.phase('agent_connect'):
+            client = scripts.connect_agent(dbfn, dbpw, config)
+
+        if args.key_cache or config.get('KEY_CACHE'):
+            with scripts.phase('key_cache_connect'):
+                scripts.connect_key_cache(config)
+
+        if args.batch:
+            # Unlock once and answer every key read from stdin
+            lookup = scripts.BatchLookup(client, dbfn, dbpw)
+            with scripts.piped_output(), scripts.phase('batch'):
+                scripts.run_batch(lookup.get, hide)
+        elif args.list:
+            with scripts.phase('lookup'):
+                records = list_records(client, dbfn, dbpw)
+            with scripts.piped_output(), scripts.phase('print'):
+                scripts.print_records(records, hide)
         else:
             # Find record
-            record = utils.find_record(pwsafe, key)
-            scripts.print_record(record, hide)
-            clip_password(record.password)
+            with scripts.phase('lookup'):
+                record = get_record(client, dbfn, dbpw, key, args.verify)
+            with scripts.phase('print'):
+                scripts.print_record(record, hide)
+            with scripts.phase('clipboard'):
+                clip_password(record.password)
     except scripts.ArgumentError as ex:
         if ex.show_help:
             argparser.print_help()
         scripts.error(ex, kill=True)
-    except errors.KeyLookupError as ex:
+    except (errors.KeyLookupError, errors.IntegrityError,
+            errors.InvalidDatabaseError, errors.InvalidPasswordError,
+            errors.SyncError) as ex:
         scripts.error(ex, kill=True)
+    finally:
+        scripts.print_profile(profile)
 
     sys.exit(scripts.EXIT_SUCCESS)
 
@@ -11,6 +11,8 @@ import pyperclip
 # internal
 import pwsr
 import pwsr.db as db
+import pwsr.multi as multi
+import pwsr.query as query
 import pwsr.utils as utils
 import pwsr.errors as errors
 import pwsr.scripts as scripts
@@ -26,7 +28,9 @@ def get_arg_parser():
         "--db",
         dest="dbfn",
         default=None,
-        help="Path to PasswordSafe Database File"
+        action="append",
+        help="Path to PasswordSafe Database File. Repeatable, and may be a "
+             "glob pattern; several databases are searched in parallel"
     )
 
     parser.add_argument(
@@ -36,6 +40,14 @@ def get_arg_parser():
         help="Passwor dSafe Database key"
     )
 
+    parser.add_argument(
+        "--remote",
+        dest="remote",
+        default=None,
+        help="Read the database synced to this directory or HTTP URL by "
+             "pwsr-sync instead of --db, through the local cache"
+    )
+
     parser.add_argument(
         "--hide",
         dest="hide",
@@ -52,6 +64,51 @@ def get_arg_parser():
         help="List All Password Safe entries"
     )
 
+    parser.add_argument(
+        "--all-fields",
+        dest="all_fields",
+        default=False,
+        action="store_true",
+        help="Also search usernames, URLs, email addresses and notes"
+    )
+
+    parser.add_argument(
+        "--where",
+        dest="where",
+        default=None,
+        action="append",
+        metavar="PREDICATE",
+        help="Only show entries whose fields satisfy PREDICATE, such as "
+             "'expiry<2026-11-01', 'pmtime<-365d' or 'protected=1'. "
+             "Repeatable; every predicate must hold"
+    )
+
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        default=False,
+        action="store_true",
+        help="Read keys from stdin, one per line, and print the results as "
+             "JSON lines"
+    )
+
+    parser.add_argument(
+        "--key-cache",
+        dest="key_cache",
+        default=False,
+        action="store_true",
+        help="Reuse and keep stretched keys in a running "
+             "'pwsr-agent --key-cache'"
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        default=False,
+        action="store_true",
+        help="Print a timing breakdown to stderr"
+    )
+
     parser.add_argument(
         "key",
         metavar="KEY",
@@ -66,19 +123,79 @@ def get_arg_parser():
 def validate_params(argparser, **kwargs):
     args = kwargs['args']
 
-    if not (kwargs['dbfn'] and kwargs['dbpw']):
+    if not ((kwargs['dbfns'] or kwargs['remote']) and kwargs['dbpw']):
         error = "Must provide both a pwsafe database and a password either."
         raise scripts.ArgumentError(error, show_help=True)
 
-    if not (kwargs['key'] or args.list):
-        error = "Must provide a pwsafe key to search for or --list."
+    if len(kwargs['dbfns']) > 1 and (args.batch or kwargs['remote']):
+        error = "--batch and --remote take a single database"
+        raise scripts.ArgumentError(error, show_help=True)
+
+    if args.batch and (kwargs['key'] or args.list or args.where):
+        error = "--batch reads keys from stdin and cannot be combined with " \
+                "a key, --list or --where"
         raise scripts.ArgumentError(error, show_help=True)
 
+    if not (kwargs['key'] or args.list or args.batch or args.where):
+        error = "Must provide a pwsafe key to search for, --where or --list."
+        raise scripts.ArgumentError(error, show_help=True)
+
+    for predicate in args.where or []:
+        try:
+            query.parse(predicate)
+        except errors.QueryError as ex:
+            raise scripts.ArgumentError(str(ex))
+
 
 def clip_password(password):
     pyperclip.copy(str(password))
 
 
+def list_records(client, dbfn, dbpw):
+    if client:
+        with utils.ignored(errors.AgentError):
+            return client.list()
+
+    return db.parse(dbfn, dbpw)
+
+
+def search_records(client, dbfn, dbpw, key, fields=None, where=None):
+    if client:
+        with utils.ignored(errors.AgentError):
+            if where:
+                return client.query(where, key, fields)
+            return client.search(key, fields)
+
+    pwsafe = db.parse(dbfn, dbpw)
+
+    if where:
+        return utils.query_records(pwsafe, where, key, fields)
+
+    return utils.find_record(pwsafe, key, multiple=True, fields=fields)
+
+
+def search_vaults(dbfns, dbpw, key, fields=None, where=None):
+    """Searches every database in `dbfns` in parallel and returns the
+    :class:`.VaultResult` of each. Databases which fail to open are reported
+    without stopping the search of the others.
+
+    """
+    results = multi.open_many(dbfns, dbpw, key, fields, where=where)
+
+    for result in results:
+        if not result.ok:
+            scripts.error("{0}: {1}".format(result.dbfn, result.error))
+
+    if (key or where) and not any(x.records for x in results if x.ok):
+        if all(x.ok for x in results):
+            error = "No database contained an entry for '{0}'".format(
+                key if key else " and ".join(where)
+            )
+            raise errors.KeyLookupError(message=error, key=key)
+
+    return results
+
+
 def main():
     # Parse the commandline arguments
     argparser = get_arg_parser()
@@ -88,31 +205,80 @@ def main():
     config  = scripts.load_conf()
 
     # Extract pwsafe-remote parameters
-    dbfn    = args.dbfn or config.get('PWDB')
-    dbfn    = utils.abspath(dbfn)
+    dbfns   = multi.expand(args.dbfn or filter(None, [config.get('PWDB')]))
+    dbfn    = dbfns[0] if dbfns else None
     dbpw    = args.dbpw or config.get('PWDB_KEY')
+    remote  = args.remote or config.get('REMOTE')
     key     = args.key
     hide    = args.hide
+    profile = scripts.start_profile() if args.profile else None
+    fields  = db.PWSafeDB.SEARCHABLE_FIELDS if args.all_fields else None
+    where   = args.where
 
     try:
         # Attempt to validate input parameters
-        validate_params(argparser, dbfn=dbfn, dbpw=dbpw, key=key, args=args)
+        validate_params(
+            argparser, dbfns=dbfns, dbpw=dbpw, key=key, remote=remote,
+            args=args
+        )
+
+        if args.key_cache or config.get('KEY_CACHE'):
+            with scripts.phase('key_cache_connect'):
+                scripts.connect_key_cache(config)
 
-        # Parse the pwsafe database
-        pwsafe = db.parse(dbfn, dbpw)
+        # Unlock several databases concurrently and merge their records
+        if len(dbfns) > 1:
+            with scripts.phase('lookup'):
+                results = search_vaults(
+                    dbfns, dbpw, None if args.list else key, fields, where
+                )
 
-        if args.list:
-            scripts.print_records(pwsafe, hide)
+            with scripts.piped_output(), scripts.phase('print'):
+                scripts.print_vault_results(results, hide)
+
+            if not all(x.ok for x in results):
+                sys.exit(scripts.EXIT_FAILURE)
+
+            sys.exit(scripts.EXIT_SUCCESS)
+
+        # Read a remote database from the local cache if it is current
+        if remote:
+            with scripts.phase('fetch_remote'):
+                dbfn = scripts.fetch_remote_db(remote, dbpw)
+
+        # Use a running agent if there is one
+        with scripts.phase('agent_connect'):
+            client = scripts.connect_agent(dbfn, dbpw, config)
+
+        if args.batch:
+            # Unlock once and answer every key read from stdin
+            lookup = scripts.BatchLookup(client, dbfn, dbpw)
+            with scripts.piped_output(), scripts.phase('batch'):
+                scripts.run_batch(lambda x: lookup.search(x, fields), hide)
         else:
-            # Find records
-            records = utils.find_record(pwsafe, key, multiple=True)
-            scripts.print_records(records, hide)
+            if args.list and not where:
+                with scripts.phase('lookup'):
+                    records = list_records(client, dbfn, dbpw)
+            else:
+                # Find records
+                with scripts.phase('lookup'):
+                    records = search_records(
+                        client, dbfn, dbpw, None if args.list else key,
+                        fields, where
+                    )
+
+            with scripts.piped_output(), scripts.phase('print'):
+                scripts.print_records(records, hide)
     except scripts.ArgumentError as ex:
         if ex.show_help:
             argparser.print_help()
         scripts.error(ex, kill=True)
-    except errors.KeyLookupError as ex:
+    except (errors.KeyLookupError, errors.IntegrityError,
+            errors.InvalidDatabaseError, errors.InvalidPasswordError,
+            errors.SyncError, errors.QueryError) as ex:
         scripts.error(ex, kill=True)
+    finally:
+        scripts.print_profile(profile)
 
     sys.exit(scripts.EXIT_SUCCESS)
 
@@ -1 +1,134 @@
-__author__ = 'bworrell'
+#!/usr/bin/env python
+
+# builtin
+import sys
+import argparse
+
+# internal
+import pwsr
+import pwsr.db as db
+import pwsr.sync as sync
+import pwsr.utils as utils
+import pwsr.errors as errors
+import pwsr.scripts as scripts
+
+
+def get_arg_parser():
+    version = pwsr.__version__
+    parser = argparse.ArgumentParser(
+        description="pwsr-sync version {0}".format(version)
+    )
+
+    parser.add_argument(
+        "--db",
+        dest="dbfn",
+        default=None,
+        help="Path to PasswordSafe Database File"
+    )
+
+    parser.add_argument(
+        "--dbpw",
+        dest="dbpw",
+        default=None,
+        help="PasswordSafe Database key"
+    )
+
+    parser.add_argument(
+        "--dir",
+        dest="dir",
+        default=None,
+        help="Sync with this directory or HTTP URL"
+    )
+
+    parser.add_argument(
+        "--drive-folder",
+        dest="drive_folder",
+        default=None,
+        help="Sync with the Google Drive folder with this id"
+    )
+
+    parser.add_argument(
+        "--credentials",
+        dest="credentials",
+        default=None,
+        help="Google OAuth 2.0 credentials file"
+    )
+
+    parser.add_argument(
+        "--state",
+        dest="state",
+        default=None,
+        help="Sync state file (default: ~/.pwsr/sync/<database hash>)"
+    )
+
+    return parser
+
+
+def validate_params(argparser, **kwargs):
+    if not (kwargs['dbfn'] and kwargs['dbpw']):
+        error = "Must provide both a pwsafe database and a password either."
+        raise scripts.ArgumentError(error, show_help=True)
+
+    if bool(kwargs['dir']) == bool(kwargs['drive_folder']):
+        error = "Must provide exactly one of --dir or --drive-folder"
+        raise scripts.ArgumentError(error, show_help=True)
+
+    if kwargs['drive_folder'] and not kwargs['credentials']:
+        error = "Must provide --credentials to sync with Google Drive"
+        raise scripts.ArgumentError(error, show_help=True)
+
+
+def get_backend(dirname, folder, credentials):
+    if dirname:
+        backend = sync.open_backend(dirname)
+    else:
+        credentials = sync.load_credentials(credentials)
+        http = sync.shared_http(credentials)
+        backend = sync.GoogleDriveBackend(folder, http)
+
+    # Local directories are as fast as the cache itself.
+    if isinstance(backend, sync.LocalDirectoryBackend):
+        return backend
+
+    return sync.CachingBackend(backend, sync.VaultCache())
+
+
+def main():
+    # Parse the commandline arguments
+    argparser = get_arg_parser()
+    args = argparser.parse_args()
+
+    # Attempt to load a pwsafe-remote configuration file
+    config  = scripts.load_conf()
+
+    # Extract pwsafe-remote parameters
+    dbfn    = args.dbfn or config.get('PWDB')
+    dbfn    = utils.abspath(dbfn) if dbfn else None
+    dbpw    = args.dbpw or config.get('PWDB_KEY')
+    dirname = args.dir or config.get('SYNC_DIR')
+    folder  = args.drive_folder or config.get('DRIVE_FOLDER')
+    creds   = args.credentials or config.get('DRIVE_CREDENTIALS')
+
+    try:
+        # Attempt to validate input parameters
+        validate_params(
+            argparser, dbfn=dbfn, dbpw=dbpw, dir=dirname,
+            drive_folder=folder, credentials=creds
+        )
+
+        backend = get_backend(dirname, folder, creds)
+        pwsafe = db.parse(dbfn, dbpw)
+        result = sync.sync(pwsafe, backend, dbfn, args.state)
+        scripts.info("Synced: {0}".format(result))
+    except scripts.ArgumentError as ex:
+        if ex.show_help:
+            argparser.print_help()
+        scripts.error(ex, kill=True)
+    except (errors.SyncError, errors.IntegrityError,
+            errors.InvalidDatabaseError, errors.InvalidPasswordError) as ex:
+        scripts.error(ex, kill=True)
+
+    sys.exit(scripts.EXIT_SUCCESS)
+
+if __name__ == "__main__":
+    main()
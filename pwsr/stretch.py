@@ -0,0 +1,153 @@
+# builtin
+import hashlib
+import collections
+
+# internal
+from . import errors
+
+
+# Known-answer vector used to verify backends before they are used. Computed
+# with the reference implementation below.
+_CHECK_KEY = "pwsr"
+_CHECK_SALT = "\x00" * 32
+_CHECK_ITER = 64
+
+_backends = collections.OrderedDict()
+_default = None
+
+
+def _stretch_reference(key, salt, iterations):
+    """The key stretching loop as described in section 2.3 of the Password
+    Safe v3 format specification. Kept as the reference that every other
+    backend is verified against.
+
+    """
+    h = hashlib.new("sha256")
+    h.update(key)
+    h.update(salt)
+    digest = h.digest()
+
+    for _ in xrange(iterations):
+        tmp_h = hashlib.new("sha256")
+        tmp_h.update(digest)
+        digest = tmp_h.digest()
+
+    return digest
+
+
+def _stretch_hashlib(key, salt, iterations):
+    """Performs the stretch loop using the ``hashlib.sha256`` constructor
+    bound to a local, which avoids the name-based ``hashlib.new()`` lookup
+    and the extra ``update()`` call on every iteration.
+
+    """
+    sha256 = hashlib.sha256
+    digest = sha256(key + salt).digest()
+
+    for _ in xrange(iterations):
+        digest = sha256(digest).digest()
+
+    return digest
+
+
+def register_backend(name, func, verify=True):
+    """Registers a key stretching backend.
+
+    Backends registered later take priority over earlier ones when no
+    explicit backend is requested.
+
+    Args:
+        name: The name of the backend.
+        func: A callable with the signature ``func(key, salt, iterations)``
+            which returns the 32 byte stretched key P'.
+        verify: If True, `func` is checked against the reference
+            implementation before it is registered.
+
+    Raises:
+        .StretchBackendError: If `verify` is True and `func` does not
+            produce the same P' and H(P') as the reference implementation.
+
+    """
+    if verify:
+        _verify(name, func)
+
+    _backends[name] = func
+
+
+def _verify(name, func):
+    try:
+        pp = func(_CHECK_KEY, _CHECK_SALT, _CHECK_ITER)
+    except Exception as ex:
+        error = "Key stretching backend '{0}' failed: {1}".format(name, ex)
+        raise errors.StretchBackendError(error)
+
+    expected = _stretch_reference(_CHECK_KEY, _CHECK_SALT, _CHECK_ITER)
+    hpp = hashlib.sha256(pp).digest()
+
+    if pp != expected or hpp != hashlib.sha256(expected).digest():
+        error = "Key stretching backend '{0}' produced an incorrect P'"
+        raise errors.StretchBackendError(error.format(name))
+
+
+def set_default(name):
+    """Sets the backend used by :func:`stretch_key` when none is given. Pass
+    ``None`` to go back to the highest priority registered backend.
+
+    """
+    global _default
+
+    if name is not None:
+        get_backend(name)
+
+    _default = name
+
+
+def get_backend(name=None):
+    """Returns the stretching function registered as `name`, or the default
+    backend if `name` is None.
+
+    Raises:
+        .StretchBackendError: If there is no backend registered as `name`.
+
+    """
+    name = name or _default
+
+    if name is None:
+        return next(reversed(_backends.values()))
+
+    try:
+        return _backends[name]
+    except KeyError:
+        error = "No key stretching backend named '{0}'".format(name)
+        raise errors.StretchBackendError(error)
+
+
+def backends():
+    """Returns the names of the registered backends, highest priority last."""
+    return list(_backends)
+
+
+def stretch_key(key, salt, iterations, backend=None):
+    """Returns the stretched key P' for `key`, `salt` and `iterations`.
+
+    Args:
+        key: The database passphrase.
+        salt: The 32 byte salt from the database preheader.
+        iterations: The ITER value from the database preheader.
+        backend: The name of the backend to use. Defaults to the highest
+            priority registered backend.
+
+    """
+    func = get_backend(backend)
+    return func(key, salt, iterations)
+
+
+register_backend('reference', _stretch_reference, verify=False)
+register_backend('hashlib', _stretch_hashlib)
+
+# The whole loop in C, if the optional extension was built. See _stretch.c.
+try:
+    from . import _stretch
+    register_backend('native', _stretch.stretch)
+except (ImportError, errors.StretchBackendError):
+    pass
@@ -1 +1,1232 @@
-__author__ = 'bworrell'
+"""Record-level synchronization of Password Safe databases.
+
+The remote copy of a database is not the database file. It is a set of
+objects held by a :class:`SyncBackend`:
+
+* One sealed blob per record, named after the record's content digest.
+* A sealed ``manifest`` which maps every record UUID to its content digest
+  and last modification time, and holds the database header fields and the
+  SHA-256 of the preheader.
+* The ``preheader`` of the database, which carries K and L encrypted under
+  the stretched password just like the database file does. It is uploaded
+  again only when it changes, such as after a password change.
+
+Blobs are sealed with the K and L keys of the database (CBC encryption under
+K followed by an HMAC-SHA256 under L). Content digests are keyed with L, so
+nothing stored remotely reveals record contents to anyone without the
+database password.
+
+Remote objects can be read through a :class:`VaultCache`, which keeps local
+copies keyed by the remote revision and the SHA-256 of their content, so an
+unchanged object costs a single metadata request (or a conditional GET).
+:func:`fetch_vault` rebuilds a local database file from the remote objects
+through the cache, for reading a database where it has not been synced.
+
+A sync fetches the manifest and compares it against digests of the local
+records and the digests recorded by the previous sync (the *base*). Only
+records which differ are transferred, so the number of requests made is
+proportional to the number of changed records rather than to the size of the
+database. A record changed on one side only is copied to the other side. A
+record changed on both sides is resolved in favour of the most recent Last
+Modification Time (0x0c). A modification always wins over a deletion.
+
+"""
+# builtin
+import os
+import json
+import hmac
+import time
+import collections
+import struct
+import urllib
+import hashlib
+import httplib
+import urlparse
+import binascii
+import StringIO
+import SocketServer
+import BaseHTTPServer
+
+# internal
+from . import errors, utils
+from .db import (PWSafeDB, PWSafeV3Header, PWSafeV3Record, PwSafeV3Field,
+                 PwSafeV3FieldReader)
+from .cipher import BLOCK_SIZE, MODE_CBC
+
+
+MANIFEST = "manifest"
+MANIFEST_VERSION = 1
+PREHEADER = "preheader"
+VAULT = "vault"  # cache name of the databases rebuilt by fetch_vault()
+
+DEFAULT_STATE_DIR = utils.abspath("~/.pwsr/sync")
+DEFAULT_CACHE_DIR = utils.abspath("~/.pwsr/cache")
+DEFAULT_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # seconds since last use
+DEFAULT_CACHE_MAX_SIZE = 256 * 1024 * 1024  # bytes
+HTTP_TIMEOUT = 30  # seconds
+
+_MAC_SIZE = hashlib.sha256().digest_size
+_LENGTH = struct.Struct("<L")
+
+
+def seal(pwsafe, data):
+    """Encrypts and authenticates `data` with the keys of the unlocked
+    ``PWSafeDB`` `pwsafe`.
+
+    Returns:
+        ``IV | CBC(K, length | data | padding) | HMAC(L, IV | ciphertext)``
+
+    """
+    iv = os.urandom(BLOCK_SIZE)
+    plaintext = _LENGTH.pack(len(data)) + data
+    plaintext += os.urandom(-len(plaintext) % BLOCK_SIZE)
+
+    ciphertext = pwsafe.cipher.encrypt(plaintext, pwsafe.k, iv, MODE_CBC)
+    digest = hmac.new(pwsafe.l, iv + ciphertext, hashlib.sha256).digest()
+
+    return iv + ciphertext + digest
+
+
+def unseal(pwsafe, blob):
+    """Returns the data sealed in `blob` by :func:`seal`.
+
+    Raises:
+        .SyncError: If `blob` is malformed, has been tampered with or was not
+            sealed with the keys of `pwsafe`.
+
+    """
+    body, digest = blob[:-_MAC_SIZE], blob[-_MAC_SIZE:]
+
+    if len(body) < 2 * BLOCK_SIZE or len(body) % BLOCK_SIZE:
+        raise errors.SyncError("Malformed sync object")
+
+    expected = hmac.new(pwsafe.l, body, hashlib.sha256).digest()
+    if not hmac.compare_digest(digest, expected):
+        error = "Sync object failed authentication. It was modified or " \
+                "written by a different database."
+        raise errors.SyncError(error)
+
+    iv, ciphertext = body[:BLOCK_SIZE], body[BLOCK_SIZE:]
+    plaintext = pwsafe.cipher.decrypt(ciphertext, pwsafe.k, iv, MODE_CBC)
+    length = _LENGTH.unpack_from(plaintext)[0]
+
+    if length > len(plaintext) - _LENGTH.size:
+        raise errors.SyncError("Malformed sync object")
+
+    return plaintext[_LENGTH.size:_LENGTH.size + length]
+
+
+def record_digest(pwsafe, record):
+    """Returns the hex HMAC-SHA256 (keyed with L) of the fields of `record`,
+    which identifies its content.
+
+    """
+    mac = hmac.new(pwsafe.l, digestmod=hashlib.sha256)
+
+    for ftype, value in record._raw_fields():
+        mac.update(struct.pack("<LB", len(value), ftype))
+        mac.update(value)
+
+    return mac.hexdigest()
+
+
+def record_mtime(record):
+    """Returns the Last Modification Time (0x0c) of `record`, falling back
+    to its Creation Time (0x07), or 0 if it has neither.
+
+    """
+    for ftype in (PWSafeV3Record.TYPE_MTIME, PWSafeV3Record.TYPE_CTIME):
+        field = record[ftype]
+
+        if field is None:
+            continue
+        elif len(field.value) == 4:
+            return struct.unpack("<L", field.value)[0]
+        elif len(field.value) == 8:
+            return struct.unpack("<Q", field.value)[0]
+
+    return 0
+
+
+def record_uuid(record):
+    """Returns the hex UUID of `record`, or None if it does not have one."""
+    field = record[PWSafeV3Record.TYPE_UUID]
+
+    if field is None:
+        return None
+
+    return binascii.hexlify(field.value)
+
+
+class SyncBackend(object):
+    """Base class for sync storage backends.
+
+    A backend stores opaque strings under flat names. Every stored object
+    has a revision, an opaque string which changes whenever the object does.
+
+    Attributes:
+        uri: A string which identifies the storage location, used to key
+            cached copies of its objects.
+
+    """
+    uri = None
+
+    def stat(self, name):
+        """Returns the revision of `name`, or None if it does not exist."""
+        raise NotImplementedError()
+
+    def get(self, name):
+        """Returns a ``(data, revision)`` tuple for `name`.
+
+        Raises:
+            KeyError: If `name` does not exist.
+
+        """
+        raise NotImplementedError()
+
+    def fetch(self, name, revision=None):
+        """Conditionally fetches `name`.
+
+        Returns:
+            A ``(data, revision)`` tuple, where `data` is None if the current
+            revision of `name` is `revision`.
+
+        Raises:
+            KeyError: If `name` does not exist.
+
+        """
+        current = self.stat(name)
+
+        if current is None:
+            raise KeyError(name)
+        elif revision is not None and current == revision:
+            return None, current
+
+        return self.get(name)
+
+    def put(self, name, data):
+        """Stores `data` as `name` and returns its new revision."""
+        raise NotImplementedError()
+
+    def delete(self, name):
+        """Deletes `name`. Does nothing if it does not exist."""
+        raise NotImplementedError()
+
+    def list(self):
+        """Returns the names of every stored object."""
+        raise NotImplementedError()
+
+    def flush(self):
+        """Persists any state the backend buffers locally. Called at the end
+        of every :meth:`Syncer.sync`.
+
+        """
+        pass
+
+
+class LocalDirectoryBackend(SyncBackend):
+    """Stores objects as files in the directory `path`, which is created if
+    it does not exist. Useful for syncing through a shared or network
+    filesystem, and for testing.
+
+    """
+    def __init__(self, path):
+        self.path = utils.abspath(path)
+        self.uri = "file://" + self.path
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+
+    def _fn(self, name):
+        return os.path.join(self.path, name)
+
+    def _revision(self, st):
+        return "{0}-{1}-{2!r}".format(st.st_ino, st.st_size, st.st_mtime)
+
+    def stat(self, name):
+        try:
+            return self._revision(os.stat(self._fn(name)))
+        except OSError:
+            return None
+
+    def get(self, name):
+        try:
+            with open(self._fn(name), 'rb') as f:
+                return f.read(), self._revision(os.fstat(f.fileno()))
+        except IOError:
+            raise KeyError(name)
+
+    def put(self, name, data):
+        utils.atomic_write(self._fn(name), [data])
+        return self.stat(name)
+
+    def delete(self, name):
+        with utils.ignored(OSError):
+            os.unlink(self._fn(name))
+
+    def list(self):
+        return [x for x in os.listdir(self.path) if not x.startswith(".")]
+
+
+_http = None
+
+
+def shared_http(credentials=None):
+    """Returns the process-wide ``httplib2.Http`` client, authorized with the
+    ``oauth2client`` `credentials` when it is first created. Reusing one
+    client keeps its connections alive across every request of a sync.
+
+    """
+    global _http
+
+    if _http is None:
+        import httplib2
+
+        http = httplib2.Http(timeout=HTTP_TIMEOUT)
+        if credentials is not None:
+            http = credentials.authorize(http)
+
+        _http = http
+
+    return _http
+
+
+def load_credentials(fn):
+    """Loads OAuth 2.0 credentials stored by ``oauth2client`` in `fn`.
+
+    Raises:
+        .SyncError: If `fn` does not hold valid credentials.
+
+    """
+    from oauth2client.file import Storage
+
+    credentials = Storage(utils.abspath(fn)).get()
+
+    if credentials is None or credentials.invalid:
+        error = "No valid Google credentials in {0}".format(fn)
+        raise errors.SyncError(error)
+
+    return credentials
+
+
+class GoogleDriveBackend(SyncBackend):
+    """Stores objects as files in a Google Drive folder.
+
+    Args:
+        folder: The id of the Drive folder to store objects in.
+        http: An authorized ``httplib2.Http``. Defaults to
+            :func:`shared_http`.
+
+    """
+    MIMETYPE = "application/octet-stream"
+
+    def __init__(self, folder, http=None):
+        from apiclient import discovery
+
+        self.folder = folder
+        self.uri = "gdrive://" + folder
+        self._http = http or shared_http()
+        self._service = discovery.build('drive', 'v2', http=self._http)
+        self._files = {}  # name -> Drive file resource, filled on use
+
+    def _query(self, query):
+        files, token = [], None
+        query = "'{0}' in parents and trashed = false{1}".format(
+            self.folder, query
+        )
+
+        while True:
+            response = self._service.files().list(
+                q=query, pageToken=token
+            ).execute(http=self._http)
+
+            files.extend(response.get('items', []))
+            token = response.get('nextPageToken')
+
+            if not token:
+                return files
+
+    def _lookup(self, name):
+        """Returns the current file resource for `name`, bypassing the
+        cached resources so the revision is never stale.
+
+        """
+        files = self._query(" and title = '{0}'".format(name))
+        resource = files[0] if files else None
+
+        if resource is None:
+            self._files.pop(name, None)
+        else:
+            self._files[name] = resource
+
+        return resource
+
+    def _resource(self, name):
+        """Returns the file resource for `name`, looking it up only if it
+        has not been seen yet. Only the objects a sync touches are looked
+        up, never the whole folder.
+
+        """
+        return self._files.get(name) or self._lookup(name)
+
+    def stat(self, name):
+        resource = self._lookup(name)
+        return resource['etag'] if resource else None
+
+    def get(self, name):
+        resource = self._resource(name)
+
+        if resource is None:
+            raise KeyError(name)
+
+        request = self._service.files().get_media(fileId=resource['id'])
+        return request.execute(http=self._http), resource['etag']
+
+    def put(self, name, data):
+        from apiclient.http import MediaInMemoryUpload
+
+        media = MediaInMemoryUpload(data, mimetype=self.MIMETYPE)
+        resource = self._resource(name)
+        files = self._service.files()
+
+        if resource is None:
+            body = {
+                'title': name,
+                'mimeType': self.MIMETYPE,
+                'parents': [{'id': self.folder}],
+            }
+            request = files.insert(body=body, media_body=media)
+        else:
+            request = files.update(fileId=resource['id'], media_body=media)
+
+        resource = request.execute(http=self._http)
+        self._files[name] = resource
+
+        return resource['etag']
+
+    def delete(self, name):
+        resource = self._resource(name)
+        self._files.pop(name, None)
+
+        if resource is not None:
+            request = self._service.files().delete(fileId=resource['id'])
+            request.execute(http=self._http)
+
+    def list(self):
+        self._files = dict((x['title'], x) for x in self._query(""))
+        return list(self._files)
+
+
+class HTTPBackend(SyncBackend):
+    """Stores objects on a plain HTTP server, such as
+    :class:`DirectoryHTTPServer`, under the base URL `url`.
+
+    Objects are read with ``GET`` (``If-None-Match`` for conditional
+    fetches), stat with ``HEAD``, written with ``PUT`` and removed with
+    ``DELETE``. Revisions are the ``ETag`` response headers. ``GET`` on the
+    base URL returns a JSON list of the object names.
+
+    A single persistent connection is reused for every request and
+    reopened if the server closes it.
+
+    """
+    def __init__(self, url, timeout=HTTP_TIMEOUT):
+        parts = urlparse.urlsplit(url)
+
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError("Not an HTTP URL: {0}".format(url))
+
+        self.uri = url.rstrip("/")
+        self.timeout = timeout
+        self._scheme = parts.scheme
+        self._netloc = parts.netloc
+        self._path = parts.path.rstrip("/")
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            if self._scheme == 'https':
+                cls = httplib.HTTPSConnection
+            else:
+                cls = httplib.HTTPConnection
+            self._conn = cls(self._netloc, timeout=self.timeout)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _request(self, method, name, body=None, headers=None):
+        path = self._path + "/" + urllib.quote(name)
+
+        for attempt in (0, 1):
+            conn = self._connect()
+
+            try:
+                conn.request(method, path, body, headers or {})
+                response = conn.getresponse()
+                return response, response.read()
+            except (httplib.HTTPException, EnvironmentError) as ex:
+                # The server may have closed an idle keep-alive connection.
+                self.close()
+
+                if attempt:
+                    error = "{0} {1} failed: {2}".format(method, path, ex)
+                    raise errors.SyncError(error)
+
+    def _check(self, method, name, response, *expected):
+        if response.status not in expected:
+            error = "{0} {1} failed: {2} {3}"
+            error = error.format(method, name, response.status,
+                                 response.reason)
+            raise errors.SyncError(error)
+
+    def stat(self, name):
+        response, _ = self._request('HEAD', name)
+
+        if response.status == httplib.NOT_FOUND:
+            return None
+
+        self._check('HEAD', name, response, httplib.OK)
+        return response.getheader('etag')
+
+    def get(self, name):
+        return self.fetch(name)
+
+    def fetch(self, name, revision=None):
+        headers = {'If-None-Match': revision} if revision else {}
+        response, body = self._request('GET', name, headers=headers)
+
+        if response.status == httplib.NOT_FOUND:
+            raise KeyError(name)
+        elif response.status == httplib.NOT_MODIFIED:
+            return None, revision
+
+        self._check('GET', name, response, httplib.OK)
+        return body, response.getheader('etag')
+
+    def put(self, name, data):
+        response, _ = self._request('PUT', name, data)
+        self._check('PUT', name, response, httplib.OK, httplib.CREATED,
+                    httplib.NO_CONTENT)
+        return response.getheader('etag')
+
+    def delete(self, name):
+        response, _ = self._request('DELETE', name)
+        self._check('DELETE', name, response, httplib.OK,
+                    httplib.NO_CONTENT, httplib.NOT_FOUND)
+
+    def list(self):
+        response, body = self._request('GET', "")
+        self._check('GET', "", response, httplib.OK)
+        return json.loads(body)
+
+
+class _DirectoryHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def _name(self):
+        name = urllib.unquote(self.path.lstrip("/"))
+
+        if "/" in name or name.startswith("."):
+            return None
+
+        return name
+
+    def _send(self, status, body="", etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read(self, name):
+        """Returns the content and ETag of `name`, or ``(None, None)``."""
+        try:
+            data, _ = self.server.backend.get(name)
+        except KeyError:
+            return None, None
+
+        return data, '"%s"' % hashlib.sha256(data).hexdigest()
+
+    def do_GET(self):
+        name = self._name()
+
+        if name == "":
+            return self._send(httplib.OK, json.dumps(self.server.backend.list()))
+
+        data, etag = self._read(name) if name else (None, None)
+
+        if data is None:
+            self._send(httplib.NOT_FOUND)
+        elif self.headers.get('If-None-Match') == etag:
+            self._send(httplib.NOT_MODIFIED, etag=etag)
+        else:
+            self._send(httplib.OK, data, etag)
+
+    def do_HEAD(self):
+        name = self._name()
+        data, etag = self._read(name) if name else (None, None)
+
+        if data is None:
+            self._send(httplib.NOT_FOUND)
+        else:
+            self.send_response(httplib.OK)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+
+    def do_PUT(self):
+        name = self._name()
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if not name:
+            return self._send(httplib.FORBIDDEN)
+
+        self.server.backend.put(name, data)
+        self._send(httplib.CREATED, etag='"%s"' % hashlib.sha256(data).hexdigest())
+
+    def do_DELETE(self):
+        name = self._name()
+
+        if not name:
+            return self._send(httplib.FORBIDDEN)
+
+        self.server.backend.delete(name)
+        self._send(httplib.NO_CONTENT)
+
+
+class DirectoryHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """Serves the objects of a :class:`LocalDirectoryBackend` in `path` over
+    the protocol spoken by :class:`HTTPBackend`, with the SHA-256 of each
+    object as its ETag. Meant as a local stand-in for a remote server.
+
+    Args:
+        address: The ``(host, port)`` to listen on. Port 0 picks a free port.
+        path: The directory holding the objects.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address, path):
+        self.backend = LocalDirectoryBackend(path)
+        BaseHTTPServer.HTTPServer.__init__(self, address, _DirectoryHTTPHandler)
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server_address)
+
+
+def open_backend(spec):
+    """Returns an :class:`HTTPBackend` if `spec` is an HTTP(S) URL, or a
+    :class:`LocalDirectoryBackend` for the directory `spec` otherwise.
+
+    """
+    if urlparse.urlsplit(spec).scheme in ('http', 'https'):
+        return HTTPBackend(spec)
+    return LocalDirectoryBackend(spec)
+
+
+class VaultCache(object):
+    """A local cache of remote objects.
+
+    Objects are stored once per distinct content, named by their SHA-256.
+    An index maps each cached ``(backend, name)`` to the remote revision
+    the content was fetched at. Reading through the cache only asks the
+    backend whether that revision is still current, and downloads the object
+    again only if it is not.
+
+    Changes to the index are kept in memory until :meth:`flush`, which
+    first evicts the entries unused for `max_age` seconds, and then the
+    least recently used entries until the cached objects fit in `max_size`
+    bytes. The most recently used entry is never evicted. :meth:`fetch`
+    flushes on its own.
+
+    Args:
+        path: The cache directory.
+        max_age: The maximum age of an entry, in seconds since its last use.
+        max_size: The maximum total size of the cached objects, in bytes.
+
+    """
+    INDEX = "index.json"
+
+    def __init__(self, path=None, max_age=DEFAULT_CACHE_MAX_AGE,
+                 max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.path = utils.abspath(path or DEFAULT_CACHE_DIR)
+        self.max_age = max_age
+        self.max_size = max_size
+        self._index = None
+        self._changed = False
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+
+    def _key(self, backend, name):
+        return "{0}/{1}".format(backend.uri, name)
+
+    def _object_fn(self, digest):
+        return os.path.join(self.path, digest)
+
+    @property
+    def index(self):
+        """The cache index: a dictionary of cache key to ``{"revision",
+        "digest", "size", "used"}``.
+
+        """
+        if self._index is None:
+            try:
+                with open(os.path.join(self.path, self.INDEX)) as f:
+                    self._index = json.load(f)
+            except (IOError, ValueError):
+                self._index = {}
+
+        return self._index
+
+    def _lookup(self, backend, name):
+        """Returns the index entry for `name` if its object is intact."""
+        entry = self.index.get(self._key(backend, name))
+
+        if entry is None:
+            return None
+
+        try:
+            size = os.path.getsize(self._object_fn(entry['digest']))
+        except OSError:
+            size = None
+
+        return entry if size == entry['size'] else None
+
+    def store(self, backend, name, data, revision):
+        """Caches `data` as revision `revision` of `name` and returns the
+        path of the cached copy.
+
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        fn = self._object_fn(digest)
+
+        # A lost cache entry is only a cache miss, so skip the fsync.
+        if not os.path.exists(fn):
+            utils.atomic_write(fn, [data], fsync=False)
+
+        self.index[self._key(backend, name)] = {
+            'revision': revision,
+            'digest': digest,
+            'size': len(data),
+            'used': time.time(),
+        }
+        self._changed = True
+
+        return fn
+
+    def cached(self, backend, name, revision):
+        """Returns the path of the cached copy of `name` if it was cached at
+        `revision`, or None.
+
+        """
+        entry = self._lookup(backend, name)
+
+        if entry is None or entry['revision'] != revision:
+            return None
+
+        entry['used'] = time.time()
+        self._changed = True
+
+        return self._object_fn(entry['digest'])
+
+    def forget(self, backend, name):
+        """Drops the cached copy of `name`, if any."""
+        if self.index.pop(self._key(backend, name), None) is not None:
+            self._changed = True
+
+    def _fetch(self, backend, name):
+        entry = self._lookup(backend, name)
+        revision = entry['revision'] if entry else None
+        data, current = backend.fetch(name, revision)
+
+        if data is not None:
+            self.store(backend, name, data, current)
+            return data, current
+
+        entry['used'] = time.time()
+        self._changed = True
+
+        return None, revision
+
+    def fetch(self, backend, name):
+        """Returns the path of an up to date local copy of `name`.
+
+        Raises:
+            KeyError: If `name` does not exist remotely.
+
+        """
+        self._fetch(backend, name)
+        entry = self.index[self._key(backend, name)]
+        self.flush()
+
+        return self._object_fn(entry['digest'])
+
+    def get(self, backend, name):
+        """Returns a ``(data, revision)`` tuple for `name`, like
+        :meth:`SyncBackend.get`.
+
+        """
+        data, revision = self._fetch(backend, name)
+
+        if data is None:
+            entry = self.index[self._key(backend, name)]
+            with open(self._object_fn(entry['digest']), 'rb') as f:
+                data = f.read()
+
+        return data, revision
+
+    def flush(self, now=None):
+        """Applies the eviction policy and saves the index."""
+        if not self._changed:
+            return
+
+        self.evict(now)
+        fn = os.path.join(self.path, self.INDEX)
+        utils.atomic_write(fn, [json.dumps(self.index)], fsync=False)
+        self._changed = False
+
+    def evict(self, now=None):
+        """Evicts expired entries, then the least recently used entries
+        until the cache is within ``max_size``, and deletes the objects no
+        longer referenced.
+
+        """
+        now = now or time.time()
+        index = self.index
+
+        for key, entry in index.items():
+            if now - entry['used'] > self.max_age:
+                del index[key]
+
+        sizes = dict((x['digest'], x['size']) for x in index.itervalues())
+        refs = collections.Counter(x['digest'] for x in index.itervalues())
+        total = sum(sizes.itervalues())
+
+        by_use = sorted(index.items(), key=lambda x: x[1]['used'])
+
+        for key, entry in by_use[:-1]:
+            if total <= self.max_size:
+                break
+
+            del index[key]
+            refs[entry['digest']] -= 1
+
+            if not refs[entry['digest']]:
+                total -= sizes[entry['digest']]
+
+        referenced = set(x['digest'] for x in index.itervalues())
+
+        for fn in os.listdir(self.path):
+            if fn == self.INDEX or fn.startswith("."):
+                continue
+
+            if fn not in referenced:
+                with utils.ignored(OSError):
+                    os.unlink(self._object_fn(fn))
+
+        self._changed = True
+
+
+class CachingBackend(SyncBackend):
+    """Wraps a :class:`SyncBackend` so that reads go through a
+    :class:`VaultCache`. Objects written through it are cached as well.
+
+    """
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+        self.uri = backend.uri
+
+    def stat(self, name):
+        return self.backend.stat(name)
+
+    def get(self, name):
+        return self.cache.get(self.backend, name)
+
+    def put(self, name, data):
+        revision = self.backend.put(name, data)
+        self.cache.store(self.backend, name, data, revision)
+        return revision
+
+    def delete(self, name):
+        self.backend.delete(name)
+        self.cache.forget(self.backend, name)
+
+    def list(self):
+        return self.backend.list()
+
+    def flush(self):
+        self.backend.flush()
+        self.cache.flush()
+
+
+class SyncResult(object):
+    """The outcome of :meth:`Syncer.sync`. Each attribute is a list of hex
+    record UUIDs.
+
+    Attributes:
+        pulled: Records copied from the remote into the local database.
+        pushed: Records copied from the local database to the remote.
+        deleted_local: Records deleted from the local database.
+        deleted_remote: Records deleted from the remote.
+
+    """
+    def __init__(self):
+        self.pulled = []
+        self.pushed = []
+        self.deleted_local = []
+        self.deleted_remote = []
+
+    @property
+    def local_changed(self):
+        """True if the local database was modified and needs saving."""
+        return bool(self.pulled or self.deleted_local)
+
+    @property
+    def remote_changed(self):
+        return bool(self.pushed or self.deleted_remote)
+
+    def __str__(self):
+        return "pulled {0}, pushed {1}, deleted {2} local, {3} remote".format(
+            len(self.pulled),
+            len(self.pushed),
+            len(self.deleted_local),
+            len(self.deleted_remote)
+        )
+
+
+class Syncer(object):
+    """Synchronizes an unlocked ``PWSafeDB`` with a :class:`SyncBackend`.
+
+    Args:
+        pwsafe: The unlocked ``PWSafeDB``.
+        backend: The :class:`SyncBackend` holding the remote copy.
+        base: The record digests left by the previous sync, as a dictionary
+            of hex UUID to hex digest. See :func:`load_state`.
+
+    Attributes:
+        base: The record digests after the last call to :meth:`sync`. Persist
+            it with :func:`save_state` after saving the database.
+
+    """
+    def __init__(self, pwsafe, backend, base=None):
+        if pwsafe.k is None:
+            raise ValueError("The database must be unlocked to sync")
+
+        self.pwsafe = pwsafe
+        self.backend = backend
+        self.base = dict(base or {})
+        self.header = None
+        self.preheader = None
+
+    def _fetch_manifest(self):
+        try:
+            blob, revision = self.backend.get(MANIFEST)
+        except KeyError:
+            return {}, None
+
+        manifest = json.loads(unseal(self.pwsafe, blob))
+
+        if manifest.get('version') != MANIFEST_VERSION:
+            error = "Unsupported sync manifest version: {0}"
+            raise errors.SyncError(error.format(manifest.get('version')))
+
+        self.header = manifest.get('header')
+        self.preheader = manifest.get('preheader')
+        return manifest['records'], revision
+
+    def _local_records(self):
+        """Returns a dictionary of hex UUID to ``(digest, mtime, record)``.
+        Records without a UUID cannot be matched up and are not synced.
+
+        """
+        local = {}
+
+        for record in self.pwsafe.records:
+            uuid = record_uuid(record)
+
+            if uuid is None or uuid in local:
+                continue
+
+            digest = record_digest(self.pwsafe, record)
+            local[uuid] = (digest, record_mtime(record), record)
+
+        return local
+
+    def _resolve(self, local, remote, base):
+        """Returns ``'push'`` or ``'pull'`` for a record whose local digest,
+        remote digest and base digest are `local`, `remote` and `base`, or
+        None if both sides agree.
+
+        """
+        ldigest = local[0] if local else None
+        rdigest = remote[0] if remote else None
+
+        if ldigest == rdigest:
+            return None
+        elif rdigest == base:
+            return 'push'
+        elif ldigest == base:
+            return 'pull'
+        elif ldigest is None:
+            return 'pull'
+        elif rdigest is None:
+            return 'push'
+        elif remote[1] > local[1]:
+            return 'pull'
+        else:
+            return 'push'
+
+    def _load(self, uuid, digest):
+        """Fetches and returns the remote record `uuid` with the content
+        digest `digest`.
+
+        """
+        blob, _ = self.backend.get(digest)
+        reader = PwSafeV3FieldReader(unseal(self.pwsafe, blob))
+        record = PWSafeV3Record.parse(reader)
+
+        if not reader.eof or record_digest(self.pwsafe, record) != digest:
+            error = "Remote record {0} does not match its digest"
+            raise errors.SyncError(error.format(uuid))
+
+        return record
+
+    def _pull(self, uuid, digest, local):
+        record = self._load(uuid, digest)
+
+        if local is None:
+            self.pwsafe.add_record(record)
+        else:
+            self.pwsafe.replace_record(local[2], record)
+
+    def _push(self, record):
+        data, _ = self.pwsafe._serialize([record], header=False)
+        return seal(self.pwsafe, bytes(data))
+
+    def sync(self):
+        """Merges the local database and the remote copy.
+
+        Changes to the local database are made in memory only; save the
+        database afterwards if ``result.local_changed``.
+
+        Returns:
+            A :class:`SyncResult`.
+
+        Raises:
+            .SyncConflictError: If the remote copy changed during the sync.
+                Nothing has been written remotely; sync again.
+            .SyncError: If the remote copy is corrupt or belongs to another
+                database.
+
+        """
+        result = SyncResult()
+        remote, revision = self._fetch_manifest()
+        local = self._local_records()
+        manifest = dict(remote)
+        uploads = {}
+
+        for uuid in set(local) | set(remote) | set(self.base):
+            lentry, rentry = local.get(uuid), remote.get(uuid)
+            action = self._resolve(lentry, rentry, self.base.get(uuid))
+
+            if action == 'pull' and rentry is None:
+                self.pwsafe.remove_record(lentry[2])
+                result.deleted_local.append(uuid)
+            elif action == 'pull':
+                self._pull(uuid, rentry[0], lentry)
+                result.pulled.append(uuid)
+            elif action == 'push' and lentry is None:
+                del manifest[uuid]
+                result.deleted_remote.append(uuid)
+            elif action == 'push':
+                uploads[lentry[0]] = lentry[2]
+                manifest[uuid] = [lentry[0], lentry[1]]
+                result.pushed.append(uuid)
+
+        # Remotes synced before the header and preheader were published get
+        # them on their next sync.
+        preheader = self.pwsafe.preheader.serialize()
+        republish = self.header is None or \
+            self.preheader != hashlib.sha256(preheader).hexdigest()
+
+        if result.remote_changed or republish:
+            self._publish(manifest, revision, uploads, remote, preheader)
+
+        self.backend.flush()
+
+        self.base = dict((k, v[0]) for k, v in manifest.iteritems())
+        return result
+
+    def _publish(self, manifest, revision, uploads, previous, preheader):
+        """Uploads the new record blobs and the serialized `preheader` if it
+        changed, then the manifest which references them, then deletes the
+        blobs no longer referenced. A failure at any point leaves the
+        previous manifest and every blob it references intact.
+
+        """
+        for digest, record in uploads.iteritems():
+            self.backend.put(digest, self._push(record))
+
+        # K and L never change, so an older manifest still matches it.
+        preheader_digest = hashlib.sha256(preheader).hexdigest()
+        if self.preheader != preheader_digest:
+            self.backend.put(PREHEADER, preheader)
+
+        if self.backend.stat(MANIFEST) != revision:
+            error = "The remote database changed during the sync"
+            raise errors.SyncConflictError(error)
+
+        header = [
+            [ftype, binascii.hexlify(value)]
+            for ftype, value in self.pwsafe.header._raw_fields()
+        ]
+
+        data = json.dumps({
+            'version': MANIFEST_VERSION,
+            'records': manifest,
+            'header': header,
+            'preheader': preheader_digest,
+        })
+        self.backend.put(MANIFEST, seal(self.pwsafe, data))
+
+        referenced = set(x[0] for x in manifest.itervalues())
+        for digest, _ in previous.itervalues():
+            if digest not in referenced:
+                self.backend.delete(digest)
+
+
+def state_path(dbfn, dirname=None):
+    """Returns the path of the sync state file for the database `dbfn`."""
+    key = hashlib.sha256(utils.abspath(dbfn)).hexdigest()[:16]
+    return os.path.join(utils.abspath(dirname or DEFAULT_STATE_DIR), key)
+
+
+def load_state(fn):
+    """Returns the base digests saved in `fn` by :func:`save_state`, or an
+    empty dictionary if `fn` does not exist.
+
+    """
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def save_state(fn, base):
+    """Saves the base digests of a :class:`Syncer` to `fn`."""
+    dirname = os.path.dirname(fn)
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+
+    utils.atomic_write(fn, [json.dumps(base)])
+
+
+def sync(pwsafe, backend, dbfn, state_fn=None):
+    """Syncs `pwsafe`, which was parsed from `dbfn`, with `backend`. The
+    database is saved if the sync changed it, and then the sync state is
+    updated.
+
+    The state must never be saved ahead of the database: a record pulled but
+    not saved would otherwise look like a local change on the next sync, and
+    revert the remote copy.
+
+    Returns:
+        A :class:`SyncResult`.
+
+    """
+    state_fn = state_fn or state_path(dbfn)
+    syncer = Syncer(pwsafe, backend, load_state(state_fn))
+    result = syncer.sync()
+
+    if result.local_changed:
+        pwsafe.save(dbfn)
+
+    save_state(state_fn, syncer.base)
+    return result
+
+
+def _rebuild(backend, dbpw):
+    """Returns a ``PWSafeDB`` holding the header and records stored in
+    `backend`, unlocked with `dbpw`.
+
+    """
+    blob, _ = backend.get(PREHEADER)
+
+    pwsafe = PWSafeDB()
+    pwsafe.preheader = pwsafe._read_preheader(StringIO.StringIO(blob))
+    pwsafe.pp, pwsafe.k, pwsafe.l = pwsafe._unlock(pwsafe.preheader, dbpw)
+
+    syncer = Syncer(pwsafe, backend)
+    manifest, _ = syncer._fetch_manifest()
+
+    if syncer.header is None:
+        error = "The remote database was synced by an older pwsr. Sync it " \
+                "again to read it remotely."
+        raise errors.SyncError(error)
+
+    preheader = syncer.preheader
+    if preheader and preheader != hashlib.sha256(blob).hexdigest():
+        error = "The remote preheader does not match the manifest"
+        raise errors.SyncError(error)
+
+    pwsafe.header = PWSafeV3Header()
+    for ftype, value in syncer.header:
+        pwsafe.header.add(PwSafeV3Field(ftype, binascii.unhexlify(value)))
+
+    # The manifest does not keep the record order of any one database.
+    for uuid, (digest, _) in sorted(manifest.iteritems()):
+        pwsafe.add_record(syncer._load(uuid, digest))
+
+    return pwsafe
+
+
+def fetch_vault(backend, dbpw, cache=None):
+    """Returns the path of a local database file holding the records synced
+    to `backend`, protected by the password `dbpw`.
+
+    The file is rebuilt from the manifest and the record blobs, which are
+    read through `cache` (default: a :class:`VaultCache` in the default
+    location), and is itself kept in the cache. As long as neither the
+    manifest nor the preheader changed remotely, the cached file is returned
+    after two metadata requests.
+
+    Raises:
+        KeyError: If nothing has been synced to `backend`.
+        .InvalidPasswordError: If `dbpw` is not the database password.
+        .SyncError: If the remote objects are corrupt.
+
+    """
+    cache = cache or VaultCache()
+    revisions = [backend.stat(PREHEADER), backend.stat(MANIFEST)]
+
+    if revisions[1] is None:
+        raise KeyError(MANIFEST)
+    elif revisions[0] is None:
+        error = "The remote database was synced by an older pwsr. Sync it " \
+                "again to read it remotely."
+        raise errors.SyncError(error)
+
+    revision = " ".join(revisions)
+    fn = cache.cached(backend, VAULT, revision)
+
+    if fn is None:
+        pwsafe = _rebuild(CachingBackend(backend, cache), dbpw)
+        fn = cache.store(backend, VAULT, "".join(pwsafe._dump()), revision)
+
+    cache.flush()
+    return fn
@@ -0,0 +1,270 @@
+"""A pure-Python implementation of the Twofish block cipher.
+
+This is a fallback for environments where libmcrypt is not available. It is
+considerably slower than a native implementation, but produces identical
+output.
+
+"""
+# builtin
+import struct
+
+BLOCK_SIZE = 16
+
+_MASK = 0xffffffff
+_RHO = 0x01010101
+
+_Q0_T = (
+    (0x8, 0x1, 0x7, 0xd, 0x6, 0xf, 0x3, 0x2,
+     0x0, 0xb, 0x5, 0x9, 0xe, 0xc, 0xa, 0x4),
+    (0xe, 0xc, 0xb, 0x8, 0x1, 0x2, 0x3, 0x5,
+     0xf, 0x4, 0xa, 0x6, 0x7, 0x0, 0x9, 0xd),
+    (0xb, 0xa, 0x5, 0xe, 0x6, 0xd, 0x9, 0x0,
+     0xc, 0x8, 0xf, 0x3, 0x2, 0x4, 0x7, 0x1),
+    (0xd, 0x7, 0xf, 0x4, 0x1, 0x2, 0x6, 0xe,
+     0x9, 0xb, 0x3, 0x0, 0x8, 0x5, 0xc, 0xa),
+)
+
+_Q1_T = (
+    (0x2, 0x8, 0xb, 0xd, 0xf, 0x7, 0x6, 0xe,
+     0x3, 0x1, 0x9, 0x4, 0x0, 0xa, 0xc, 0x5),
+    (0x1, 0xe, 0x2, 0xb, 0x4, 0xc, 0x3, 0x7,
+     0x6, 0xd, 0xa, 0x5, 0xf, 0x9, 0x0, 0x8),
+    (0x4, 0xc, 0x7, 0x5, 0x1, 0x6, 0x9, 0xa,
+     0x0, 0xe, 0xd, 0x8, 0x2, 0xb, 0x3, 0xf),
+    (0xb, 0x9, 0x5, 0x1, 0xc, 0x3, 0xd, 0xe,
+     0x6, 0x4, 0x7, 0xf, 0x2, 0x0, 0x8, 0xa),
+)
+
+_MDS = (
+    (0x01, 0xef, 0x5b, 0x5b),
+    (0x5b, 0xef, 0xef, 0x01),
+    (0xef, 0x5b, 0x01, 0xef),
+    (0xef, 0x01, 0xef, 0x5b),
+)
+
+_RS = (
+    (0x01, 0xa4, 0x55, 0x87, 0x5a, 0x58, 0xdb, 0x9e),
+    (0xa4, 0x56, 0x82, 0xf3, 0x1e, 0xc6, 0x68, 0xe5),
+    (0x02, 0xa1, 0xfc, 0xc1, 0x47, 0xae, 0x3d, 0x19),
+    (0xa4, 0x55, 0x87, 0x5a, 0x58, 0xdb, 0x9e, 0x03),
+)
+
+
+def _ror4(x, n):
+    return ((x >> n) | (x << (4 - n))) & 0xf
+
+
+def _rol(x, n):
+    return ((x << n) | (x >> (32 - n))) & _MASK
+
+
+def _ror(x, n):
+    return ((x >> n) | (x << (32 - n))) & _MASK
+
+
+def _make_q(t):
+    q = []
+    for x in xrange(256):
+        a0, b0 = x >> 4, x & 0xf
+        a1 = a0 ^ b0
+        b1 = a0 ^ _ror4(b0, 1) ^ ((8 * a0) & 0xf)
+        a2, b2 = t[0][a1], t[1][b1]
+        a3 = a2 ^ b2
+        b3 = a2 ^ _ror4(b2, 1) ^ ((8 * a2) & 0xf)
+        a4, b4 = t[2][a3], t[3][b3]
+        q.append((b4 << 4) | a4)
+    return tuple(q)
+
+
+_Q0 = _make_q(_Q0_T)
+_Q1 = _make_q(_Q1_T)
+
+
+def _gf_mult(a, b, poly):
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        a <<= 1
+        if a & 0x100:
+            a ^= poly
+        b >>= 1
+    return result
+
+
+def _mds_column(i, x):
+    """Returns the contribution of byte `x` in position `i` to the MDS
+    product, as a little-endian 32-bit word.
+
+    """
+    word = 0
+    for row in xrange(4):
+        word |= _gf_mult(_MDS[row][i], x, 0x169) << (8 * row)
+    return word
+
+
+def _bytes(word):
+    return (word & 0xff, (word >> 8) & 0xff,
+            (word >> 16) & 0xff, (word >> 24) & 0xff)
+
+
+def _sbox_bytes(y, words):
+    """Applies the keyed q-permutation chain of the Twofish ``h`` function to
+    the four bytes in `y` using the key words `words`.
+
+    """
+    y0, y1, y2, y3 = y
+    k = len(words)
+
+    if k == 4:
+        l = _bytes(words[3])
+        y0, y1, y2, y3 = (_Q1[y0] ^ l[0], _Q0[y1] ^ l[1],
+                          _Q0[y2] ^ l[2], _Q1[y3] ^ l[3])
+    if k >= 3:
+        l = _bytes(words[2])
+        y0, y1, y2, y3 = (_Q1[y0] ^ l[0], _Q1[y1] ^ l[1],
+                          _Q0[y2] ^ l[2], _Q0[y3] ^ l[3])
+
+    l1 = _bytes(words[1])
+    l0 = _bytes(words[0])
+
+    return (
+        _Q1[_Q0[_Q0[y0] ^ l1[0]] ^ l0[0]],
+        _Q0[_Q0[_Q1[y1] ^ l1[1]] ^ l0[1]],
+        _Q1[_Q1[_Q0[y2] ^ l1[2]] ^ l0[2]],
+        _Q0[_Q1[_Q1[y3] ^ l1[3]] ^ l0[3]],
+    )
+
+
+def _h(x, words):
+    y = _sbox_bytes(_bytes(x), words)
+    return (_mds_column(0, y[0]) ^ _mds_column(1, y[1]) ^
+            _mds_column(2, y[2]) ^ _mds_column(3, y[3]))
+
+
+class Twofish(object):
+    """A Twofish cipher context with a precomputed key schedule.
+
+    Args:
+        key: A 16, 24 or 32 byte key.
+
+    """
+    def __init__(self, key):
+        keylen = len(key)
+        if keylen not in (16, 24, 32):
+            raise ValueError("Invalid Twofish key length: %d" % keylen)
+
+        k = keylen // 8
+        m = struct.unpack("<%dL" % (2 * k), key)
+        me, mo = m[0::2], m[1::2]
+
+        subkeys = []
+        for i in xrange(20):
+            a = _h(2 * i * _RHO, me)
+            b = _rol(_h((2 * i + 1) * _RHO, mo), 8)
+            subkeys.append((a + b) & _MASK)
+            subkeys.append(_rol((a + 2 * b) & _MASK, 9))
+
+        s = []
+        for i in xrange(k):
+            chunk = bytearray(key[8 * i:8 * i + 8])
+            word = 0
+            for row in xrange(4):
+                v = 0
+                for col in xrange(8):
+                    v ^= _gf_mult(_RS[row][col], chunk[col], 0x14d)
+                word |= v << (8 * row)
+            s.append(word)
+        s.reverse()
+
+        # Fold the key-dependent S-boxes and the MDS matrix into four
+        # 256-entry lookup tables so that g() is four lookups and three xors.
+        tables = ([], [], [], [])
+        for x in xrange(256):
+            y = _sbox_bytes((x, x, x, x), s)
+            for i in xrange(4):
+                tables[i].append(_mds_column(i, y[i]))
+
+        self._k = tuple(subkeys)
+        self._s = tuple(tuple(t) for t in tables)
+
+    def encrypt_block(self, a, b, c, d):
+        s0, s1, s2, s3 = self._s
+        k = self._k
+
+        a ^= k[0]
+        b ^= k[1]
+        c ^= k[2]
+        d ^= k[3]
+
+        for r in xrange(0, 16, 2):
+            t0 = (s0[a & 0xff] ^ s1[(a >> 8) & 0xff] ^
+                  s2[(a >> 16) & 0xff] ^ s3[a >> 24])
+            t1 = (s0[b >> 24] ^ s1[b & 0xff] ^
+                  s2[(b >> 8) & 0xff] ^ s3[(b >> 16) & 0xff])
+            c ^= (t0 + t1 + k[2 * r + 8]) & _MASK
+            c = ((c >> 1) | (c << 31)) & _MASK
+            d = ((d << 1) | (d >> 31)) & _MASK
+            d ^= (t0 + 2 * t1 + k[2 * r + 9]) & _MASK
+
+            t0 = (s0[c & 0xff] ^ s1[(c >> 8) & 0xff] ^
+                  s2[(c >> 16) & 0xff] ^ s3[c >> 24])
+            t1 = (s0[d >> 24] ^ s1[d & 0xff] ^
+                  s2[(d >> 8) & 0xff] ^ s3[(d >> 16) & 0xff])
+            a ^= (t0 + t1 + k[2 * r + 10]) & _MASK
+            a = ((a >> 1) | (a << 31)) & _MASK
+            b = ((b << 1) | (b >> 31)) & _MASK
+            b ^= (t0 + 2 * t1 + k[2 * r + 11]) & _MASK
+
+        return c ^ k[4], d ^ k[5], a ^ k[6], b ^ k[7]
+
+    def decrypt_block(self, c, d, a, b):
+        s0, s1, s2, s3 = self._s
+        k = self._k
+
+        c ^= k[4]
+        d ^= k[5]
+        a ^= k[6]
+        b ^= k[7]
+
+        for r in xrange(14, -1, -2):
+            t0 = (s0[c & 0xff] ^ s1[(c >> 8) & 0xff] ^
+                  s2[(c >> 16) & 0xff] ^ s3[c >> 24])
+            t1 = (s0[d >> 24] ^ s1[d & 0xff] ^
+                  s2[(d >> 8) & 0xff] ^ s3[(d >> 16) & 0xff])
+            a = ((a << 1) | (a >> 31)) & _MASK
+            a ^= (t0 + t1 + k[2 * r + 10]) & _MASK
+            b ^= (t0 + 2 * t1 + k[2 * r + 11]) & _MASK
+            b = ((b >> 1) | (b << 31)) & _MASK
+
+            t0 = (s0[a & 0xff] ^ s1[(a >> 8) & 0xff] ^
+                  s2[(a >> 16) & 0xff] ^ s3[a >> 24])
+            t1 = (s0[b >> 24] ^ s1[b & 0xff] ^
+                  s2[(b >> 8) & 0xff] ^ s3[(b >> 16) & 0xff])
+            c = ((c << 1) | (c >> 31)) & _MASK
+            c ^= (t0 + t1 + k[2 * r + 8]) & _MASK
+            d ^= (t0 + 2 * t1 + k[2 * r + 9]) & _MASK
+            d = ((d >> 1) | (d << 31)) & _MASK
+
+        return a ^ k[0], b ^ k[1], c ^ k[2], d ^ k[3]
+
+    def encrypt(self, data):
+        """ECB encrypts `data`, which must be a multiple of 16 bytes long."""
+        return self._ecb(data, self.encrypt_block)
+
+    def decrypt(self, data):
+        """ECB decrypts `data`, which must be a multiple of 16 bytes long."""
+        return self._ecb(data, self.decrypt_block)
+
+    def _ecb(self, data, func):
+        if len(data) % BLOCK_SIZE:
+            raise ValueError("Data must be a multiple of %d bytes" % BLOCK_SIZE)
+
+        out = bytearray(len(data))
+        unpack_from, pack_into = struct.unpack_from, struct.pack_into
+
+        for offset in xrange(0, len(data), BLOCK_SIZE):
+            words = func(*unpack_from("<4L", data, offset))
+            pack_into("<4L", out, offset, *words)
+
+        return str(out)
@@ -1,5 +1,8 @@
 # builtin
 import os
+import mmap
+import shutil
+import tempfile
 import collections
 import contextlib
 import StringIO
@@ -54,10 +57,117 @@ def bindata(data):
         return data
 
 
-def find_record(pwsafe, key, multiple=False):
+def _fileno(data):
+    try:
+        return data.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+
+
+def file_signature(data):
+    """Returns a ``(device, inode, size, mtime)`` tuple identifying the
+    current state of the file `data`, which is a path or a file object.
+    Returns ``None`` if `data` is not backed by a file on disk.
+
+    """
+    fileno = _fileno(data)
+
+    try:
+        if fileno is not None:
+            st = os.fstat(fileno)
+        elif isinstance(data, basestring):
+            st = os.stat(data)
+        else:
+            return None
+    except EnvironmentError:
+        return None
+
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+@contextlib.contextmanager
+def mapped(data):
+    """Yields a read-only, index-accessible view of `data` for the duration of
+    the ``with`` block.
+
+    If `data` is a file backed by a file descriptor, it is memory-mapped and
+    unmapped again on exit. Other file-like objects (or files which cannot be
+    mapped, such as pipes or empty files) are read into a string. Anything
+    else is returned unchanged.
+
+    """
+    fileno = _fileno(data)
+    view = None
+
+    if fileno is not None:
+        with ignored(mmap.error, EnvironmentError, ValueError):
+            view = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    if view is None:
+        yield bindata(ioslice(data, offset=0))
+        return
+
+    try:
+        yield view
+    finally:
+        view.close()
+
+
+def fsync_dir(dirname):
+    """Flushes the directory entry changes of `dirname` to disk."""
+    with ignored(OSError):
+        fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def atomic_write(fn, chunks, fsync=True):
+    """Atomically replaces the file `fn` with the concatenation of the strings
+    in `chunks`.
+
+    The data is written to a temporary file in the same directory, synced to
+    disk (unless `fsync` is False) and renamed over `fn`. The permissions of
+    an existing `fn` are kept; new files are only readable by the owner.
+
+    """
+    fn = abspath(fn)
+    dirname, basename = os.path.split(fn)
+    fd, tmpfn = tempfile.mkstemp(prefix="." + basename + ".", dir=dirname)
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+
+        if os.path.exists(fn):
+            shutil.copymode(fn, tmpfn)
+
+        os.rename(tmpfn, fn)
+    except:
+        with ignored(OSError):
+            os.unlink(tmpfn)
+        raise
+
+    if fsync:
+        fsync_dir(dirname)
+
+
+def find_record(pwsafe, key, multiple=False, fields=None):
     """Attempts to find the record in `pwsafe` which matches `key`. If the
     lookup of `key` fails, the pwsafe will be searched for a similar entry.
 
+    Args:
+        pwsafe: A :class:`.PWSafeDB` instance.
+        key: The title to look up.
+        multiple: If True, return every matching record.
+        fields: The field types searched when there is no exact title match.
+            See :meth:`.PWSafeDB.search`.
+
     Returns:
         A :class:`.PWSafeV3Record` with a title which matches (or comes close
         to matching) `key`.
@@ -70,7 +180,7 @@ def find_record(pwsafe, key, multiple=False):
         record = pwsafe[key]
         records = [record]
     except KeyError:
-        records = pwsafe.search(key)
+        records = pwsafe.search(key, fields)
 
     if records:
         return records if multiple else records[0]
@@ -78,3 +188,65 @@ def find_record(pwsafe, key, multiple=False):
     error = "The PWSafe did not contain an entry for '{0}'".format(key)
     raise errors.KeyLookupError(message=error, key=key)
 
+
+def query_records(pwsafe, where, key=None, fields=None):
+    """Returns the records in `pwsafe` which satisfy every predicate in
+    `where` (see :meth:`.PWSafeDB.query`) and, if `key` is given, also match
+    `key` as in :func:`find_record`.
+
+    Raises:
+        .KeyLookupError: If no record matches.
+        .QueryError: If a predicate is invalid.
+
+    """
+    records = pwsafe.query(*where)
+
+    if key is not None:
+        matches = set(id(x) for x in find_record(pwsafe, key, True, fields))
+        records = [x for x in records if id(x) in matches]
+
+    if records:
+        return records
+
+    error = "The PWSafe did not contain an entry matching the query"
+    raise errors.KeyLookupError(message=error, key=key)
+
+
+def _title(record):
+    try:
+        return record.title.value
+    except KeyError:
+        return None
+
+
+def stream_find_record(records, key):
+    """Like :func:`find_record`, but looks `key` up in an iterable of
+    records, such as the generator returned by :func:`.iter_records`.
+
+    Iteration stops at the first record whose title is exactly `key`. If there
+    is no exact match, the first record whose title contains `key`
+    (case-insensitive) is returned, just as :func:`find_record` would; as an
+    exact match could still follow, every record is read first.
+
+    Raises:
+        .KeyLookupError: If no record matches `key`.
+
+    """
+    similar = None
+    lkey = key.lower()
+
+    for record in records:
+        title = _title(record)
+
+        if title is None:
+            continue
+        elif title == key:
+            return record
+        elif similar is None and lkey in title.lower():
+            similar = record
+
+    if similar is not None:
+        return similar
+
+    error = "The PWSafe did not contain an entry for '{0}'".format(key)
+    raise errors.KeyLookupError(message=error, key=key)
@@ -2,7 +2,10 @@
 
 import sys
 from os.path import (abspath, dirname, join)
-from setuptools import (setup, find_packages)
+from setuptools import (setup, find_packages, Extension)
+from setuptools.command.build_ext import build_ext
+from distutils.errors import (CCompilerError, DistutilsExecError,
+                              DistutilsPlatformError)
 
 BASE_DIR = dirname(abspath(__file__))
 VERSION_FILE = join(BASE_DIR, 'pwsr', 'version.py')
@@ -31,13 +34,42 @@ with open(fn_readme) as f:
 install_requires = [
     'google-api-python-client>=1.2',
     'pyperclip>=1.3',
-    'python-mcrypt>=1.1'
 ]
 
 for i in install_requires:
     print i
 
+# Native key stretching. Needs a C compiler and the OpenSSL headers; pwsr
+# falls back to the Python stretch loop without it.
+ext_modules = [
+    Extension('pwsr._stretch', ['pwsr/_stretch.c'], libraries=['crypto']),
+]
+
+
+class optional_build_ext(build_ext):
+    """Builds the C extensions, but installs pwsr without them if they fail
+    to compile.
+
+    """
+    errors = (CCompilerError, DistutilsExecError, DistutilsPlatformError)
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except self.errors as ex:
+            print "warning: not building the C extensions: %s" % ex
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except self.errors as ex:
+            print "warning: not building %s: %s" % (ext.name, ex)
+
 extras_require = {
+    # Native Twofish. pwsr falls back to pure Python Twofish without it.
+    'mcrypt': [
+        'python-mcrypt>=1.1',
+    ],
     'docs': [
         'Sphinx==1.2.1',
         'sphinxcontrib-napoleon==0.2.4',
@@ -55,8 +87,17 @@ setup(
     author_email='',
     url='https://github.com/bworrell',
     version=get_version(),
-    packages=find_packages(),
-    scripts=['pwsr/scripts/pwsr-get.py', 'pwsr/scripts/pwsr-search.py'],
+    packages=find_packages(exclude=['tests', 'tests.*']),
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': optional_build_ext},
+    scripts=[
+        'pwsr/scripts/pwsr-get.py',
+        'pwsr/scripts/pwsr-search.py',
+        'pwsr/scripts/pwsr-agent.py',
+        'pwsr/scripts/pwsr-sync.py',
+        'pwsr/scripts/pwsr-audit.py',
+        'pwsr/scripts/pwsr-export.py',
+    ],
     include_package_data=True,
     install_requires=install_requires,
     extras_require=extras_require,
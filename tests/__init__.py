@@ -0,0 +1,134 @@
+# builtin
+import os
+import time
+import shutil
+import struct
+import hashlib
+import hmac
+import tempfile
+import unittest
+
+# internal
+from pwsr.db import (PWSafeDB, PWSafeV3Header, PWSafeV3Record,
+                     PwSafeV3Field, PwSafeV3FieldReader, TYPE_END)
+from pwsr.cipher import MODE_CBC
+
+
+PASSWORD = "correct horse battery staple"
+
+# Field types pwsr has no name for, which must survive a round trip as is.
+UNKNOWN_HEADER_TYPE = 0x30
+UNKNOWN_RECORD_TYPES = (0x40, 0xdf)
+
+
+def make_record(title, password="secret", group="", mtime=None, **extra):
+    """Returns a new record with a random UUID and the given fields. Extra
+    fields are given as ``f<type>=value``, such as ``f64="..."``.
+
+    """
+    record = PWSafeV3Record()
+    record[PWSafeV3Record.TYPE_UUID] = PwSafeV3Field(
+        PWSafeV3Record.TYPE_UUID, os.urandom(16)
+    )
+
+    values = [
+        (PWSafeV3Record.TYPE_GROUP, group),
+        (PWSafeV3Record.TYPE_TITLE, title),
+        (PWSafeV3Record.TYPE_PASSWORD, password),
+        (PWSafeV3Record.TYPE_MTIME,
+         struct.pack("<L", int(mtime or time.time()))),
+    ]
+    values.extend((int(k[1:]), v) for k, v in sorted(extra.iteritems()))
+
+    for ftype, value in values:
+        record[ftype] = PwSafeV3Field(ftype, value)
+
+    return record
+
+
+def make_db(count=10):
+    """Returns a new database holding `count` records, with fields of
+    unknown types in the header and in some of the records.
+
+    """
+    pwsafe = PWSafeDB()
+    pwsafe.create(PASSWORD, iterations=PWSafeDB.MIN_ITER)
+    pwsafe.header.add(PwSafeV3Field(PWSafeV3Header.TYPE_DATABASE_NAME, "test"))
+    pwsafe.header.add(PwSafeV3Field(UNKNOWN_HEADER_TYPE, "\x00\x01\x02"))
+
+    for i in xrange(count):
+        extra = {}
+        if i % 3 == 0:
+            extra = dict(("f%d" % x, "unknown %d" % i)
+                         for x in UNKNOWN_RECORD_TYPES)
+
+        record = make_record("entry %d" % i, "password %d" % i,
+                             group="group %d" % (i % 4), **extra)
+        pwsafe.add_record(record)
+
+    return pwsafe
+
+
+def record_uuid(record):
+    return record[PWSafeV3Record.TYPE_UUID].value
+
+
+def raw_records(pwsafe):
+    """Returns the raw fields of every record of `pwsafe`, keyed by UUID."""
+    return dict((record_uuid(x), x._raw_fields()) for x in pwsafe.records)
+
+
+def read_entries(dbfn, dbpw):
+    """Decrypts the database file `dbfn` independently of
+    ``PWSafeDB.parse``.
+
+    Returns:
+        A ``(entries, valid)`` tuple, where `entries` lists the ``(type,
+        value)`` pairs of the header and of every record in file order, and
+        `valid` is True if the HMAC stored in the file matches the field
+        values.
+
+    """
+    with open(dbfn, 'rb') as f:
+        data = f.read()
+
+    pwsafe = PWSafeDB()
+    ph = pwsafe._read_preheader(data)
+    _, k, l = pwsafe._unlock(ph, dbpw)
+
+    marker = len(data) - len(PWSafeDB.EOF_MARKER) - 32
+    assert data[marker:marker + len(PWSafeDB.EOF_MARKER)] == \
+        PWSafeDB.EOF_MARKER
+
+    plaintext = pwsafe._decrypt(data[PWSafeDB.HDR_OFFSET:marker], k, ph.iv,
+                                mode=MODE_CBC)
+    reader = PwSafeV3FieldReader(plaintext)
+    mac = hmac.new(l, digestmod=hashlib.sha256)
+    entries, entry = [], []
+
+    while not reader.eof:
+        ftype, start, length = reader.read_raw()
+        value = plaintext[start:start + length]
+        mac.update(value)
+        entry.append((ftype, value))
+
+        if ftype == TYPE_END:
+            entries.append(entry)
+            entry = []
+
+    assert not entry, "Data section ends inside an entry"
+
+    return entries, mac.digest() == data[-32:]
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Creates a temporary directory, ``self.path``, for every test."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="pwsr-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def fn(self, name):
+        return os.path.join(self.path, name)
@@ -0,0 +1,184 @@
+# builtin
+import os
+import threading
+
+# internal
+import pwsr.db as db
+import pwsr.agent as agent
+import pwsr.errors as errors
+from pwsr.db import PWSafeV3Record, PwSafeV3Field
+
+from . import TempDirTestCase, PASSWORD, make_db
+
+
+class AgentTestCase(TempDirTestCase):
+    """Serves a new database from an agent on another thread."""
+    IDLE_TIMEOUT = 60
+
+    def setUp(self):
+        super(AgentTestCase, self).setUp()
+        self.dbfn = self.fn("vault.psafe3")
+        make_db(count=20).save(self.dbfn, incremental=False)
+
+        self.socket = self.fn("agent.sock")
+        self.server = agent.AgentServer(
+            self.socket, db.parse(self.dbfn, PASSWORD), self.dbfn, PASSWORD,
+            self.IDLE_TIMEOUT
+        )
+        self.thread = threading.Thread(target=self.server.serve_until_locked)
+        self.thread.daemon = True
+        self.thread.start()
+        self.clients = []
+
+    def tearDown(self):
+        if not self.server.locked:
+            self.client().lock()
+        self.thread.join(5)
+
+        for client in self.clients:
+            client.close()
+
+        super(AgentTestCase, self).tearDown()
+
+    def client(self, dbpw=PASSWORD):
+        client = agent.AgentClient(self.socket, self.dbfn, dbpw)
+        self.clients.append(client)
+        return client
+
+
+class AgentTest(AgentTestCase):
+    """The agent answers several clients at once, only with the password,
+    and locks on request.
+
+    """
+    def test_get(self):
+        record = self.client().get("entry 7")
+
+        self.assertEqual(record.title, "entry 7")
+        self.assertEqual(record.password, "password 7")
+
+    def test_missing_key(self):
+        self.assertRaises(errors.KeyLookupError, self.client().get, "nothing")
+
+    def test_concurrent_clients(self):
+        # Both connections stay open between requests.
+        first, second = self.client(), self.client()
+
+        for i in xrange(3):
+            self.assertEqual(first.get("entry %d" % i).title, "entry %d" % i)
+            self.assertEqual(second.get("entry 1%d" % i).title,
+                             "entry 1%d" % i)
+
+    def test_parallel_requests(self):
+        failures = []
+
+        def lookups(n):
+            client = self.client()
+            try:
+                for i in xrange(20):
+                    key = "entry %d" % ((n + i) % 20)
+                    if client.get(key).title != key:
+                        failures.append(key)
+            except errors.AgentError as ex:
+                failures.append(ex)
+
+        threads = [threading.Thread(target=lookups, args=(n,))
+                   for n in xrange(4)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+
+        self.assertEqual(failures, [])
+
+    def test_wrong_password(self):
+        self.assertRaises(errors.AgentError, self.client(None).get, "entry 1")
+        self.assertRaises(errors.AgentError, self.client("wrong").get,
+                          "entry 1")
+
+    def test_other_database(self):
+        client = agent.AgentClient(self.socket, self.fn("other.psafe3"),
+                                   PASSWORD)
+        self.clients.append(client)
+
+        self.assertFalse(client.ping())
+        self.assertRaises(errors.AgentError, client.get, "entry 1")
+
+    def test_lock(self):
+        idle = self.client()
+        idle.ping()
+
+        self.client().lock()
+        self.thread.join(5)
+
+        self.assertFalse(self.thread.is_alive())
+        self.assertTrue(self.server.locked)
+        self.assertFalse(os.path.exists(self.socket))
+        self.assertRaises(errors.AgentError, idle.get, "entry 1")
+
+    def test_reload_changed_database(self):
+        client = self.client()
+        client.get("entry 7")
+
+        pwsafe = db.parse(self.dbfn, PASSWORD)
+        title = PWSafeV3Record.TYPE_TITLE
+        pwsafe["entry 7"][title] = PwSafeV3Field(title, "renamed")
+        pwsafe.save(self.dbfn)
+
+        self.assertEqual(client.get("renamed").title, "renamed")
+        self.assertRaises(errors.KeyLookupError, client.get, "entry 7")
+
+
+class AgentIdleTest(AgentTestCase):
+    """The agent locks once no client has made a request for a while."""
+    IDLE_TIMEOUT = 1
+
+    def test_idle_timeout(self):
+        client = self.client()
+        client.get("entry 1")
+
+        self.thread.join(5)
+
+        self.assertFalse(self.thread.is_alive())
+        self.assertTrue(self.server.locked)
+        self.assertRaises(errors.AgentError, client.get, "entry 1")
+
+    def test_open_connection_in_use(self):
+        client = self.client()
+
+        # Requests over one open connection keep the agent unlocked.
+        for i in xrange(6):
+            self.thread.join(0.3)
+            self.assertEqual(client.get("entry 1").title, "entry 1")
+
+
+class KeyCacheAgentTest(TempDirTestCase):
+    def setUp(self):
+        super(KeyCacheAgentTest, self).setUp()
+        self.socket = self.fn("keys.sock")
+        self.server = agent.KeyCacheServer(self.socket, ttl=60)
+        self.thread = threading.Thread(target=self.server.serve_until_locked)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.join(5)
+        super(KeyCacheAgentTest, self).tearDown()
+
+    def test_keys(self):
+        cache = agent.connect_key_cache(self.socket)
+        other = agent.connect_key_cache(self.socket)
+        salt, pp = "\x00" * 32, "\x01" * 32
+
+        self.assertIsNone(cache.get(salt, 2048, "pw"))
+        cache.put(salt, 2048, "pw", pp)
+
+        self.assertEqual(other.get(salt, 2048, "pw"), pp)
+        self.assertIsNone(other.get(salt, 2048, "other"))
+
+        other.forget(salt, 2048, "pw")
+        self.assertIsNone(cache.get(salt, 2048, "pw"))
+
+        cache.lock()
+        other.close()
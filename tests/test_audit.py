@@ -0,0 +1,148 @@
+# builtin
+import struct
+import unittest
+
+# internal
+import pwsr.audit as audit
+from pwsr.db import PWSafeV3Record, PwSafeV3Field
+
+from . import TempDirTestCase, PASSWORD, make_db, make_record
+
+
+NOW = 1400000000
+DAY = 24 * 60 * 60
+
+# 12 characters, at least one of each class.
+POLICY = "%04x%03x%03x%03x%03x%03x" % (
+    audit.USE_LOWERCASE | audit.USE_UPPERCASE | audit.USE_DIGITS |
+    audit.USE_SYMBOLS, 12, 1, 1, 1, 1
+)
+
+
+def history(*passwords):
+    entries = "".join("%08x%04x%s" % (NOW, len(x), x) for x in passwords)
+    return "1%02x%02x%s" % (len(passwords), len(passwords), entries)
+
+
+def set_field(record, ftype, value):
+    record[ftype] = PwSafeV3Field(ftype, value)
+    return record
+
+
+def by_type(findings):
+    result = {}
+
+    for finding in findings:
+        result.setdefault(finding['type'], []).append(finding)
+
+    return result
+
+
+class PolicyTest(unittest.TestCase):
+    def test_violations(self):
+        policy = audit.Policy.parse(POLICY, allowed_symbols="!")
+
+        self.assertEqual(policy.violations(u"Abcdefgh123!"), [])
+        self.assertEqual(policy.violations(u"abc"), [
+            "shorter than 12 characters", "fewer than 1 uppercase",
+            "fewer than 1 digits", "fewer than 1 symbols"
+        ])
+        self.assertEqual(policy.violations(u"Abcdefgh123#"),
+                         ["contains symbols outside the allowed set"])
+
+        hex_only = audit.Policy(audit.USE_HEX_DIGITS, 4)
+        self.assertEqual(hex_only.violations(u"00ff"), [])
+        self.assertEqual(hex_only.violations(u"00fg"),
+                         ["contains non-hexadecimal characters"])
+
+        self.assertRaises(ValueError, audit.Policy.parse, POLICY[:-1])
+
+    def test_named_policies(self):
+        text = "02" + "06strict" + POLICY + "01!" + "03hex" + \
+               "0800004000000000000" + "00"
+        policies = audit.parse_named_policies(text)
+
+        self.assertEqual(sorted(policies), ["hex", "strict"])
+        self.assertEqual(policies["strict"].length, 12)
+        self.assertEqual(policies["strict"].allowed_symbols, "!")
+        self.assertEqual(policies["hex"].flags, audit.USE_HEX_DIGITS)
+        self.assertIsNone(policies["hex"].allowed_symbols)
+
+        # A truncated field keeps the policies before it.
+        self.assertEqual(list(audit.parse_named_policies(text[:-10])),
+                         ["strict"])
+
+    def test_history(self):
+        self.assertEqual(audit.parse_history(history("one", "two")),
+                         ["one", "two"])
+        self.assertEqual(audit.parse_history(history("one")[:-1]), [])
+        self.assertEqual(audit.parse_history("garbage"), [])
+
+
+class AuditTest(TempDirTestCase):
+    """Reuse, age and policy findings from a single pass over the records.
+    """
+    def setUp(self):
+        super(AuditTest, self).setUp()
+        pwsafe = make_db(count=6)
+        records = pwsafe.records
+
+        # Reused across records, and within one record through its history.
+        set_field(records[0], PWSafeV3Record.TYPE_PASSWORD, "shared")
+        set_field(records[1], PWSafeV3Record.TYPE_PASSWORD, "shared")
+        set_field(records[2], PWSafeV3Record.TYPE_PASSWORD_HISTORY,
+                  history("old", "password 2"))
+
+        set_field(records[3], PWSafeV3Record.TYPE_PMTIME,
+                  struct.pack("<L", NOW - 400 * DAY))
+        set_field(records[4], PWSafeV3Record.TYPE_PASSWORD_POLICY, POLICY)
+        set_field(records[5], PWSafeV3Record.TYPE_POLICY_NAME, "missing")
+
+        for record in records:
+            set_field(record, PWSafeV3Record.TYPE_CTIME,
+                      struct.pack("<L", NOW - DAY))
+
+        self.pwsafe = pwsafe
+        self.dbfn = self.fn("vault.psafe3")
+        pwsafe.save(self.dbfn, incremental=False)
+
+    def titles(self, finding):
+        return sorted((x['title'], x['field']) for x in finding['records'])
+
+    def test_findings(self):
+        findings = by_type(audit.audit(self.pwsafe, now=NOW, batch_size=2))
+
+        self.assertEqual(sorted(self.titles(x) for x in findings['reuse']), [
+            [("entry 0", "password"), ("entry 1", "password")],
+            [("entry 2", "history"), ("entry 2", "password")],
+        ])
+
+        stale, = findings['stale']
+        self.assertEqual(stale['record']['title'], "entry 3")
+        self.assertEqual(stale['age_days'], 400)
+
+        policy = sorted(findings['policy'], key=lambda x: x['record']['title'])
+        self.assertEqual([x['record']['title'] for x in policy],
+                         ["entry 4", "entry 5"])
+        self.assertIn("fewer than 1 uppercase", policy[0]['violations'])
+        self.assertEqual(policy[1]['violations'], ["unknown policy"])
+
+        summary, = findings['summary']
+        self.assertEqual(summary, {'type': 'summary', 'records': 6,
+                                   'stale': 1, 'policy': 2, 'reuse': 2})
+
+    def test_options(self):
+        findings = by_type(audit.audit(self.pwsafe, now=NOW, max_age=None,
+                                       history=False))
+
+        self.assertNotIn('stale', findings)
+        self.assertEqual(len(findings['reuse']), 1)
+
+    def test_audit_file(self):
+        def normalized(findings):
+            return sorted(findings, key=repr)
+
+        self.assertEqual(
+            normalized(audit.audit_file(self.dbfn, PASSWORD, now=NOW)),
+            normalized(audit.audit(self.pwsafe, now=NOW))
+        )
@@ -0,0 +1,82 @@
+# builtin
+import json
+import StringIO
+
+# internal
+import pwsr.scripts as scripts
+import pwsr.instrument as instrument
+
+from . import TempDirTestCase, PASSWORD, make_db
+from .test_agent import AgentTestCase
+
+
+def run(lookup, keys, hide=False):
+    infile = StringIO.StringIO("".join(x + "\n" for x in keys))
+    outfile = StringIO.StringIO()
+    scripts.run_batch(lookup, hide, infile, outfile)
+
+    return [json.loads(x) for x in outfile.getvalue().splitlines()]
+
+
+class BatchTest(TempDirTestCase):
+    """Keys read one per line are answered with one JSON line each, from a
+    database unlocked once.
+
+    """
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.dbfn = self.fn("vault.psafe3")
+        make_db(count=12).save(self.dbfn, incremental=False)
+
+        self.profiler = instrument.install(instrument.Profiler())
+        self.lookup = scripts.BatchLookup(None, self.dbfn, PASSWORD)
+
+    def tearDown(self):
+        instrument.install(None)
+        super(BatchTest, self).tearDown()
+
+    def test_get(self):
+        results = run(self.lookup.get, ["entry 1", "", "nothing", "ENTRY 11"])
+
+        self.assertEqual([x['key'] for x in results],
+                         ["entry 1", "nothing", "ENTRY 11"])
+        self.assertEqual(results[0]['records'], [{
+            'title': "entry 1", 'group': "group 1", 'username': None,
+            'password': "password 1"
+        }])
+        self.assertIn("nothing", results[1]['error'])
+        self.assertNotIn('records', results[1])
+        self.assertEqual(results[2]['records'][0]['title'], "entry 11")
+
+        self.assertEqual(self.profiler.calls['parse'], 1)
+
+    def test_search(self):
+        results = run(lambda x: self.lookup.search(x), ["ntry 1"], hide=True)
+        records = results[0]['records']
+
+        self.assertEqual([x['title'] for x in records],
+                         ["entry 1", "entry 10", "entry 11"])
+        self.assertEqual(set(x['password'] for x in records),
+                         set([scripts.HIDDEN_PASSWORD]))
+
+
+class AgentBatchTest(AgentTestCase):
+    """Batches are answered by a running agent, and by the database once the
+    agent goes away.
+
+    """
+    def test_agent(self):
+        lookup = scripts.BatchLookup(self.client(), self.dbfn, PASSWORD)
+        results = run(lookup.get, ["entry 3"])
+
+        self.assertEqual(results[0]['records'][0]['password'], "password 3")
+        self.assertIsNone(lookup._pwsafe)
+
+        self.client().lock()
+        self.thread.join(5)
+
+        results = run(lookup.get, ["entry 4"])
+
+        self.assertEqual(results[0]['records'][0]['password'], "password 4")
+        self.assertIsNone(lookup.client)
+        self.assertIsNotNone(lookup._pwsafe)
@@ -0,0 +1,156 @@
+# builtin
+import os
+import unittest
+
+# internal
+import pwsr.db as db
+import pwsr.cipher as cipher
+import pwsr.errors as errors
+from pwsr.db import PWSafeDB
+from pwsr.cipher import BLOCK_SIZE, MODE_CBC
+
+from . import TempDirTestCase, PASSWORD, make_db
+
+
+KEY = "\x00\x01" * 16
+IV = "\x02" * BLOCK_SIZE
+
+
+class TwoCPUs(object):
+    """Makes the cipher module see two CPUs, so that the worker pool is used
+    on machines with a single one.
+
+    """
+    def __enter__(self):
+        self.cpu_count = cipher.cpu_count
+        cipher.cpu_count = lambda: 2
+
+    def __exit__(self, *exc_info):
+        cipher.cpu_count = self.cpu_count
+        cipher.close_pool()
+
+
+class BrokenBackend(cipher.PythonBackend):
+    """Initializes, but fails on first use like a broken libmcrypt."""
+    name = 'test-broken'
+
+    def _new_context(self, key, mode):
+        raise RuntimeError("mcrypt_module_open failed")
+
+
+class WrongCBCBackend(cipher.PythonBackend):
+    """Gets ECB right, but leaves CBC ciphertexts as they are."""
+    name = 'test-wrong-cbc'
+
+    def cbc_decrypt(self, key, iv, data):
+        return data
+
+
+class BackendTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = os.urandom(BLOCK_SIZE * 33)
+
+        for name in cipher.backends():
+            backend = cipher.get_backend(name)
+            ciphertext = backend.encrypt(data, KEY, IV, MODE_CBC)
+
+            self.assertNotEqual(ciphertext, data)
+            self.assertEqual(backend.decrypt(ciphertext, KEY, IV, MODE_CBC),
+                             data)
+            self.assertEqual(backend.decrypt(backend.encrypt(data, KEY), KEY),
+                             data)
+
+    def test_broken_backend_rejected(self):
+        default = cipher.get_backend()
+
+        for backend in (BrokenBackend(), WrongCBCBackend()):
+            self.assertRaises(errors.CipherBackendError,
+                              cipher.register_backend, backend)
+            self.assertNotIn(backend.name, cipher.backends())
+
+        self.assertIs(cipher.get_backend(), default)
+
+    def test_invalid_length(self):
+        backend = cipher.get_backend('python')
+        self.assertRaises(ValueError, backend.cbc_decrypt, KEY, IV, "x" * 17)
+
+
+class ParallelDecryptTest(TempDirTestCase):
+    """Parallel CBC decryption gives the same plaintext as serial."""
+
+    def tearDown(self):
+        cipher.close_pool()
+        super(ParallelDecryptTest, self).tearDown()
+
+    def test_matches_serial(self):
+        backend = cipher.get_backend()
+
+        for blocks in (1, 2, 3, 1001):
+            data = os.urandom(blocks * BLOCK_SIZE)
+            expected = backend.cbc_decrypt(KEY, IV, data)
+
+            for processes in (2, 3):
+                self.assertEqual(
+                    backend.cbc_decrypt_parallel(KEY, IV, data, processes),
+                    expected, "%d blocks, %d processes" % (blocks, processes)
+                )
+
+            self.assertEqual(
+                backend.cbc_decrypt_parallel(KEY, IV, buffer(data), 2),
+                expected
+            )
+
+    def test_parse(self):
+        dbfn = self.fn("vault.psafe3")
+        make_db(count=200).save(dbfn, incremental=False)
+        serial = db.parse(dbfn, PASSWORD)
+
+        with TwoCPUs():
+            pwsafe = PWSafeDB()
+            pwsafe.parallel_decrypt = True
+
+            with open(dbfn, 'rb') as f:
+                pwsafe.parse(f, PASSWORD)
+
+        self.assertEqual([x._raw_fields() for x in pwsafe.records],
+                         [x._raw_fields() for x in serial.records])
+
+
+class CalibrationTest(unittest.TestCase):
+    """Backends measure once when parallel decryption starts to pay off."""
+
+    def setUp(self):
+        self.backend = cipher.PythonBackend()
+        self.backend.calibration_size = 64 * BLOCK_SIZE
+
+    def tearDown(self):
+        cipher.close_pool()
+
+    def test_calibrate(self):
+        with TwoCPUs():
+            threshold = self.backend.calibrate()
+
+        self.assertEqual(self.backend.parallel_threshold, threshold)
+        self.assertGreaterEqual(threshold, self.backend.calibration_size)
+        self.assertEqual(threshold % BLOCK_SIZE, 0)
+
+    def test_use_parallel(self):
+        size = self.backend.calibration_size
+
+        # Without a second CPU nothing is measured.
+        self.assertFalse(self.backend.use_parallel(size * 100))
+        self.assertIsNone(self.backend.parallel_threshold)
+
+        with TwoCPUs():
+            self.assertFalse(self.backend.use_parallel(size - BLOCK_SIZE))
+            self.assertIsNone(self.backend.parallel_threshold)
+
+            self.backend.use_parallel(size)
+            threshold = self.backend.parallel_threshold
+
+            self.assertIsNotNone(threshold)
+            self.assertTrue(self.backend.use_parallel(threshold))
+            self.assertFalse(self.backend.use_parallel(size - BLOCK_SIZE))
+
+        self.backend.parallel_threshold = size
+        self.assertFalse(self.backend.use_parallel(size))
@@ -0,0 +1,223 @@
+# builtin
+import shutil
+
+# internal
+import pwsr.db as db
+import pwsr.errors as errors
+from pwsr.db import PWSafeDB, PWSafeV3Record, PwSafeV3Field, TYPE_END
+
+from . import (TempDirTestCase, PASSWORD, UNKNOWN_HEADER_TYPE,
+               UNKNOWN_RECORD_TYPES, make_db, make_record, raw_records,
+               record_uuid, read_entries)
+
+
+class RoundTripTest(TempDirTestCase):
+    """Databases read by ``parse`` are written back field for field."""
+
+    def setUp(self):
+        super(RoundTripTest, self).setUp()
+        self.source = make_db(count=20)
+        self.source.save(self.fn("source.psafe3"), incremental=False)
+        self.parsed = db.parse(self.fn("source.psafe3"), PASSWORD)
+
+    def assertSameDatabase(self, expected, actual):
+        self.assertEqual(expected.preheader.serialize(),
+                         actual.preheader.serialize())
+        self.assertEqual(expected.header._raw_fields(),
+                         actual.header._raw_fields())
+        self.assertEqual([x._raw_fields() for x in expected.records],
+                         [x._raw_fields() for x in actual.records])
+
+    def assertWellFormed(self, dbfn, pwsafe):
+        entries, valid = read_entries(dbfn, PASSWORD)
+
+        self.assertTrue(valid, "HMAC mismatch")
+        self.assertEqual(len(entries), len(pwsafe.records) + 1)
+
+        for entry in entries:
+            types = [ftype for ftype, _ in entry]
+            self.assertEqual(types.count(TYPE_END), 1)
+            self.assertEqual(types[-1], TYPE_END)
+
+        self.assertEqual(entries[0], pwsafe.header._raw_fields())
+        self.assertEqual(entries[1:],
+                         [x._raw_fields() for x in pwsafe.records])
+
+    def test_parse_matches_source(self):
+        self.assertSameDatabase(self.source, self.parsed)
+        self.assertWellFormed(self.fn("source.psafe3"), self.source)
+
+    def test_unknown_fields_kept(self):
+        header = self.parsed.header._raw_fields()
+        self.assertIn((UNKNOWN_HEADER_TYPE, "\x00\x01\x02"), header)
+
+        record = self.parsed.records[0]
+        for ftype in UNKNOWN_RECORD_TYPES:
+            self.assertEqual(record[ftype].value, "unknown 0")
+
+    def test_save_parse(self):
+        for incremental in (True, False):
+            dbfn = self.fn("copy-%s.psafe3" % incremental)
+            self.parsed.save(dbfn, incremental=incremental)
+
+            self.assertWellFormed(dbfn, self.parsed)
+            self.assertSameDatabase(self.parsed, db.parse(dbfn, PASSWORD))
+
+    def test_save_in_place(self):
+        self.parsed.save(self.fn("source.psafe3"))
+        reparsed = db.parse(self.fn("source.psafe3"), PASSWORD)
+
+        self.assertSameDatabase(self.source, reparsed)
+        self.assertWellFormed(self.fn("source.psafe3"), self.source)
+
+    def test_edit_save_parse(self):
+        record = self.parsed.records[3]
+        record[PWSafeV3Record.TYPE_TITLE] = PwSafeV3Field(
+            PWSafeV3Record.TYPE_TITLE, u"edited \xe9"
+        )
+        record[UNKNOWN_RECORD_TYPES[0]] = PwSafeV3Field(
+            UNKNOWN_RECORD_TYPES[0], "added"
+        )
+
+        self.parsed.save(self.fn("source.psafe3"))
+        reparsed = db.parse(self.fn("source.psafe3"), PASSWORD)
+
+        self.assertSameDatabase(self.parsed, reparsed)
+        self.assertEqual(reparsed.records[3].title.value, "edited \xc3\xa9")
+        self.assertWellFormed(self.fn("source.psafe3"), reparsed)
+
+    def tamper(self, offset):
+        with open(self.fn("source.psafe3"), 'r+b') as f:
+            f.seek(offset, 0 if offset >= 0 else 2)
+            block = f.read(1)
+            f.seek(-1, 1)
+            f.write(chr(ord(block) ^ 1))
+
+    def test_tampered_hmac(self):
+        self.tamper(-1)
+
+        self.assertFalse(read_entries(self.fn("source.psafe3"), PASSWORD)[1])
+        self.assertRaises(errors.IntegrityError, db.parse,
+                          self.fn("source.psafe3"), PASSWORD)
+
+    def test_tampered_data(self):
+        self.tamper(PWSafeDB.HDR_OFFSET + 5 * 16)
+
+        self.assertRaises(errors.IntegrityError, db.parse,
+                          self.fn("source.psafe3"), PASSWORD)
+
+    def test_wrong_password(self):
+        self.assertRaises(errors.InvalidPasswordError, db.parse,
+                          self.fn("source.psafe3"), PASSWORD + "x")
+
+
+class IncrementalSaveTest(TempDirTestCase):
+    """Incremental saves write the same database as full saves."""
+
+    def setUp(self):
+        super(IncrementalSaveTest, self).setUp()
+        make_db(count=600).save(self.fn("source.psafe3"), incremental=False)
+
+        for name in ("incremental.psafe3", "full.psafe3"):
+            shutil.copy(self.fn("source.psafe3"), self.fn(name))
+
+    def edit(self, pwsafe):
+        """Applies the same edits to `pwsafe` every time."""
+        title = PWSafeV3Record.TYPE_TITLE
+
+        record = pwsafe.records[450]
+        record[title] = PwSafeV3Field(title, "edited")
+
+        pwsafe.remove_record(pwsafe.records[500])
+
+        new = make_record("added", "added password", mtime=1400000000)
+        new[PWSafeV3Record.TYPE_UUID] = PwSafeV3Field(
+            PWSafeV3Record.TYPE_UUID, "\x01" * 16
+        )
+        pwsafe.add_record(new)
+
+    def save(self, name, incremental):
+        pwsafe = db.parse(self.fn(name), PASSWORD)
+        self.edit(pwsafe)
+        pwsafe.save(self.fn(name), incremental=incremental)
+
+        return db.parse(self.fn(name), PASSWORD)
+
+    def test_incremental_equals_full(self):
+        incremental = self.save("incremental.psafe3", True)
+        full = self.save("full.psafe3", False)
+
+        self.assertEqual(incremental.header._raw_fields(),
+                         full.header._raw_fields())
+        self.assertEqual([x._raw_fields() for x in incremental.records],
+                         [x._raw_fields() for x in full.records])
+
+        for name in ("incremental.psafe3", "full.psafe3"):
+            self.assertTrue(read_entries(self.fn(name), PASSWORD)[1])
+
+    def test_unchanged_prefix_kept(self):
+        layout = db.parse(self.fn("source.psafe3"), PASSWORD)._layout
+        self.save("incremental.psafe3", True)
+
+        with open(self.fn("source.psafe3"), 'rb') as f:
+            source = f.read()
+        with open(self.fn("incremental.psafe3"), 'rb') as f:
+            saved = f.read()
+
+        # The records before the edited one are not re-encrypted.
+        prefix = PWSafeDB.HDR_OFFSET + layout.offset(450)
+        self.assertEqual(source[:prefix], saved[:prefix])
+
+    def test_stale_file_saved_in_full(self):
+        pwsafe = db.parse(self.fn("incremental.psafe3"), PASSWORD)
+        self.edit(pwsafe)
+
+        # Another writer replaces the file after it was parsed.
+        other = db.parse(self.fn("incremental.psafe3"), PASSWORD)
+        other.remove_record(other.records[0])
+        other.save(self.fn("incremental.psafe3"), incremental=False)
+
+        pwsafe.save(self.fn("incremental.psafe3"))
+        reparsed = db.parse(self.fn("incremental.psafe3"), PASSWORD)
+
+        self.assertEqual(raw_records(pwsafe), raw_records(reparsed))
+        self.assertEqual(len(reparsed.records), 600)
+
+    def test_record_index_current(self):
+        pwsafe = db.parse(self.fn("incremental.psafe3"), PASSWORD)
+        self.edit(pwsafe)
+
+        self.assertEqual(record_uuid(pwsafe["edited"]),
+                         record_uuid(pwsafe.records[450]))
+        self.assertRaises(KeyError, lambda: pwsafe["entry 450"])
+
+
+class StreamLookupTest(TempDirTestCase):
+    """``find_record`` looks a key up while the file is decrypted."""
+
+    def setUp(self):
+        super(StreamLookupTest, self).setUp()
+        self.dbfn = self.fn("source.psafe3")
+        make_db(count=20).save(self.dbfn, incremental=False)
+
+    def test_find(self):
+        self.assertEqual(db.find_record(self.dbfn, PASSWORD, "entry 7")
+                         .title.value, "entry 7")
+        self.assertEqual(db.find_record(self.dbfn, PASSWORD, "ENTRY 1")
+                         .title.value, "entry 1")
+        self.assertRaises(errors.KeyLookupError, db.find_record, self.dbfn,
+                          PASSWORD, "nothing")
+
+    def test_tampered(self):
+        with open(self.dbfn, 'r+b') as f:
+            f.seek(-1, 2)
+            block = f.read(1)
+            f.seek(-1, 2)
+            f.write(chr(ord(block) ^ 1))
+
+        self.assertRaises(errors.IntegrityError, db.find_record, self.dbfn,
+                          PASSWORD, "entry 7")
+
+        # Without verification the match is returned as soon as it is read.
+        record = db.find_record(self.dbfn, PASSWORD, "entry 7", verify=False)
+        self.assertEqual(record.title.value, "entry 7")
@@ -0,0 +1,94 @@
+# builtin
+import csv
+import json
+import uuid
+import StringIO
+
+# internal
+import pwsr.db as db
+import pwsr.errors as errors
+
+from . import TempDirTestCase, PASSWORD, make_db, make_record, record_uuid
+
+
+MTIME = 1400000000
+
+
+class ExportTest(TempDirTestCase):
+    """Records are written as JSON Lines or CSV while the file is read."""
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.pwsafe = make_db(count=20)
+        self.pwsafe.add_record(make_record(u"caf\xe9".encode('utf-8'),
+                                           group="a,b", mtime=MTIME))
+        self.dbfn = self.fn("vault.psafe3")
+        self.pwsafe.save(self.dbfn, incremental=False)
+
+    def export(self, **kwargs):
+        out = StringIO.StringIO()
+        count = db.export(self.dbfn, PASSWORD, out, **kwargs)
+        return count, out.getvalue()
+
+    def test_jsonl(self):
+        count, output = self.export()
+        lines = [json.loads(x) for x in output.splitlines()]
+
+        self.assertEqual(count, 21)
+        self.assertEqual(len(lines), 21)
+        self.assertEqual(lines[3], {
+            'group': "group 3", 'title': "entry 3", 'username': None,
+            'password': "password 3", 'url': None, 'notes': None
+        })
+        self.assertEqual(lines[-1]['title'], u"caf\xe9")
+
+    def test_csv(self):
+        count, output = self.export(fmt=db.FORMAT_CSV,
+                                    fields=['title', 'group', 'url'])
+        rows = list(csv.reader(StringIO.StringIO(output)))
+
+        self.assertEqual(count, 21)
+        self.assertEqual(rows[0], ['title', 'group', 'url'])
+        self.assertEqual(rows[1], ['entry 0', 'group 0', ''])
+        self.assertEqual(rows[-1], [u"caf\xe9".encode('utf-8'), 'a,b', ''])
+
+    def test_redact(self):
+        _, output = self.export(redact=True)
+        passwords = set(json.loads(x)['password'] for x in output.splitlines())
+
+        self.assertEqual(passwords, set([db.REDACTED]))
+        self.assertNotIn("password 1", output)
+
+    def test_typed_fields(self):
+        _, output = self.export(fields=['uuid', 'mtime'])
+        last = json.loads(output.splitlines()[-1])
+        record = self.pwsafe.records[-1]
+
+        self.assertEqual(last, {
+            'uuid': str(uuid.UUID(bytes=record_uuid(record))),
+            'mtime': MTIME
+        })
+
+    def test_buffered_output(self):
+        out = StringIO.StringIO()
+        db.export_records(self.pwsafe.records, out, buffer_size=100)
+
+        self.assertEqual(out.getvalue(), self.export()[1])
+
+    def test_invalid(self):
+        out = StringIO.StringIO()
+
+        self.assertRaises(ValueError, db.export_records, [], out, fmt='xml')
+        self.assertRaises(ValueError, db.export_records, [], out,
+                          fields=['title', 'nosuchfield'])
+
+    def test_tampered(self):
+        with open(self.dbfn, 'r+b') as f:
+            f.seek(-1, 2)
+            block = f.read(1)
+            f.seek(-1, 2)
+            f.write(chr(ord(block) ^ 1))
+
+        out = StringIO.StringIO()
+        self.assertRaises(errors.IntegrityError, db.export, self.dbfn,
+                          PASSWORD, out)
@@ -0,0 +1,246 @@
+# builtin
+import unittest
+
+# internal
+import pwsr.index as index
+from pwsr.db import PWSafeDB, PWSafeV3Record, PwSafeV3Field
+
+from . import PASSWORD, make_record, record_uuid
+
+
+TITLE = PWSafeV3Record.TYPE_TITLE
+
+
+def make_pwsafe(count=50):
+    pwsafe = PWSafeDB()
+    pwsafe.create(PASSWORD, iterations=PWSafeDB.MIN_ITER)
+
+    for i in xrange(count):
+        pwsafe.add_record(make_record("entry %d" % i,
+                                      group="group %d.sub" % (i % 3)))
+
+    return pwsafe
+
+
+class TitleIndexTest(unittest.TestCase):
+    """Titles and UUIDs are looked up from indexes kept current through
+    every change to the records.
+
+    """
+    def setUp(self):
+        self.pwsafe = make_pwsafe()
+
+    def test_lookup(self):
+        record = self.pwsafe.records[10]
+
+        self.assertIs(self.pwsafe["entry 10"], record)
+        self.assertIs(self.pwsafe.get_uuid(record_uuid(record)), record)
+        self.assertRaises(KeyError, lambda: self.pwsafe["entry"])
+        self.assertRaises(KeyError, self.pwsafe.get_uuid, "\x00" * 16)
+
+    def test_records_read_only(self):
+        records = self.pwsafe.records
+
+        self.assertEqual(len(records), 50)
+        self.assertRaises(AttributeError, getattr, records, 'append')
+
+        def assign():
+            records[0] = None
+
+        def delete():
+            del records[0]
+
+        self.assertRaises(TypeError, assign)
+        self.assertRaises(TypeError, delete)
+        self.assertRaises(AttributeError, setattr, self.pwsafe, 'records',
+                          [])
+
+    def test_add_remove_replace(self):
+        added = make_record("added")
+        self.pwsafe.add_record(added)
+        self.assertIs(self.pwsafe["added"], added)
+
+        old = self.pwsafe["entry 3"]
+        self.pwsafe.remove_record(old)
+        self.assertRaises(KeyError, lambda: self.pwsafe["entry 3"])
+        self.assertRaises(KeyError, self.pwsafe.get_uuid, record_uuid(old))
+        self.assertRaises(ValueError, self.pwsafe.remove_record, old)
+
+        # A removed record no longer updates the indexes when edited.
+        old[TITLE] = PwSafeV3Field(TITLE, "removed")
+        self.assertRaises(KeyError, lambda: self.pwsafe["removed"])
+
+        new = make_record("replacement")
+        self.pwsafe.replace_record(self.pwsafe["entry 4"], new)
+        self.assertIs(self.pwsafe.records[3], new)
+        self.assertIs(self.pwsafe["replacement"], new)
+        self.assertRaises(KeyError, lambda: self.pwsafe["entry 4"])
+
+    def test_edit(self):
+        record = self.pwsafe["entry 5"]
+        record[TITLE] = PwSafeV3Field(TITLE, "renamed")
+
+        self.assertIs(self.pwsafe["renamed"], record)
+        self.assertRaises(KeyError, lambda: self.pwsafe["entry 5"])
+
+        del record[TITLE]
+        self.assertRaises(KeyError, lambda: self.pwsafe["renamed"])
+
+    def test_editing_batch(self):
+        record = self.pwsafe["entry 6"]
+
+        with self.pwsafe.editing(record):
+            record[TITLE] = PwSafeV3Field(TITLE, "first")
+            record[TITLE] = PwSafeV3Field(TITLE, "second")
+
+        self.assertIs(self.pwsafe["second"], record)
+        self.assertRaises(KeyError, lambda: self.pwsafe["first"])
+
+        other = make_pwsafe(1)
+        self.assertRaises(ValueError, other.editing(record).__enter__)
+
+    def test_duplicate_titles(self):
+        first = self.pwsafe["entry 7"]
+        second = make_record("entry 7")
+        self.pwsafe.add_record(second)
+
+        self.assertIs(self.pwsafe["entry 7"], first)
+        self.pwsafe.remove_record(first)
+        self.assertIs(self.pwsafe["entry 7"], second)
+
+
+class SearchTest(unittest.TestCase):
+    """Trigram searches give the results of a case-insensitive substring
+    scan, in database order.
+
+    """
+    KEYS = ["entry 1", "ENTRY 4", "y 2", "1", "", "ry", "group 2.SUB",
+            "nothing", u"\xe9t\xe9"]
+
+    def setUp(self):
+        self.pwsafe = make_pwsafe(100)
+        self.pwsafe.add_record(make_record(u"\xc9t\xe9 entry".encode('utf-8')))
+
+    def scan(self, key, fields):
+        key = index.normalize(key)
+        return [
+            record for record in self.pwsafe.records
+            if any(key in index.normalize(record[x].value)
+                   for x in fields if record[x] is not None)
+        ]
+
+    def assertScan(self, key, fields=(TITLE,)):
+        self.assertEqual(map(id, self.pwsafe.search(key, fields)),
+                         map(id, self.scan(key, fields)), repr(key))
+
+    def test_matches_scan(self):
+        fields = (TITLE, PWSafeV3Record.TYPE_GROUP)
+
+        for key in self.KEYS:
+            self.assertScan(key)
+            self.assertScan(key, fields)
+
+    def test_follows_changes(self):
+        self.assertScan("entry 1")
+
+        self.pwsafe.remove_record(self.pwsafe["entry 10"])
+        self.pwsafe["entry 11"][TITLE] = PwSafeV3Field(TITLE, "renamed")
+        self.pwsafe.add_record(make_record("entry 1000"))
+
+        for key in ("entry 1", "renamed", "entry 10"):
+            self.assertScan(key)
+
+    def test_index(self):
+        records = self.pwsafe.records[:10]
+        trigrams = index.TrigramIndex((TITLE,), records)
+
+        self.assertEqual(len(trigrams), 10)
+        self.assertEqual(trigrams.search("Y 3"), [records[3]])
+
+        trigrams.remove(records[3])
+        trigrams.remove(records[3])
+
+        self.assertEqual(len(trigrams), 9)
+        self.assertEqual(trigrams.search("y 3"), [])
+        self.assertEqual(index.ngrams("abcd"), set(["abc", "bcd"]))
+
+
+class GroupTreeTest(unittest.TestCase):
+    """Records are kept in a tree of dot-separated groups."""
+    GROUP = PWSafeV3Record.TYPE_GROUP
+
+    def setUp(self):
+        self.pwsafe = make_pwsafe(30)
+        self.pwsafe.add_record(make_record("top"))
+        self.pwsafe.add_record(make_record("dotted", group="a\\.b.c"))
+
+    def test_split_join(self):
+        for group, components in [("", ()), ("a", ("a",)),
+                                  ("a.b.c", ("a", "b", "c")),
+                                  ("a\\.b.c", ("a.b", "c"))]:
+            self.assertEqual(index.split_group(group), components)
+            self.assertEqual(index.join_group(components), group)
+
+    def test_counts(self):
+        groups = self.pwsafe.groups
+
+        self.assertEqual(len(groups), 32)
+        self.assertEqual(groups.count("group 1"), 10)
+        self.assertEqual(groups.count("group 1.sub"), 10)
+        self.assertEqual(groups.count("a\\.b"), 1)
+        self.assertRaises(KeyError, groups.count, "group 1.other")
+
+        self.assertEqual(groups.counts(), [
+            ("", 32), ("a\\.b", 1), ("a\\.b.c", 1),
+            ("group 0", 10), ("group 0.sub", 10),
+            ("group 1", 10), ("group 1.sub", 10),
+            ("group 2", 10), ("group 2.sub", 10),
+        ])
+
+    def test_grouped(self):
+        titles = [x.title.value for x in self.pwsafe.grouped("group 2")]
+        self.assertEqual(titles, ["entry %d" % i for i in xrange(2, 30, 3)])
+
+        records = list(self.pwsafe.grouped())
+        self.assertEqual(records[0].title.value, "top")
+        self.assertEqual(records[1].title.value, "dotted")
+        self.assertEqual(len(records), 32)
+
+        groupby = self.pwsafe.groupby()
+        self.assertEqual(sorted(groupby), ["", "a\\.b.c", "group 0.sub",
+                                           "group 1.sub", "group 2.sub"])
+        self.assertEqual(groupby["group 0.sub"],
+                         [x for x in self.pwsafe.records
+                          if x.group.value == "group 0.sub"])
+
+    def test_follows_changes(self):
+        groups = self.pwsafe.groups
+        record = self.pwsafe["dotted"]
+
+        record[self.GROUP] = PwSafeV3Field(self.GROUP, "group 0.sub")
+        self.assertEqual(groups.count("group 0"), 11)
+        self.assertRaises(KeyError, groups.node, "a\\.b")
+
+        self.pwsafe.remove_record(record)
+        self.assertEqual(groups.count("group 0"), 10)
+
+        self.pwsafe.replace_record(self.pwsafe["entry 0"],
+                                   make_record("moved", group="other"))
+        self.assertEqual(groups.count("group 0.sub"), 9)
+        self.assertEqual(groups.count("other"), 1)
+
+    def test_empty_groups(self):
+        records = [make_record("entry", group="full"),
+                   make_record("other", group="empty.sub")]
+        groups = index.GroupTree(self.GROUP, records, ["empty", "declared.x"])
+
+        self.assertEqual(groups.empty_groups(), ["declared.x"])
+
+        # Declared groups outlive their last record, others do not.
+        groups.remove(records[1])
+        groups.remove(records[0])
+
+        self.assertEqual(groups.empty_groups(), ["declared.x", "empty"])
+        self.assertRaises(KeyError, groups.node, "full")
+        self.assertRaises(KeyError, groups.node, "empty.sub")
+        self.assertEqual(len(groups), 0)
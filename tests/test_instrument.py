@@ -0,0 +1,102 @@
+# builtin
+import unittest
+
+# internal
+import pwsr.db as db
+import pwsr.instrument as instrument
+
+from . import TempDirTestCase, PASSWORD, make_db
+
+
+class Clock(object):
+    """Advances by one second every time it is read."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_phases_and_counters(self):
+        ended = []
+        profiler = instrument.Profiler(Clock(), lambda *x: ended.append(x))
+
+        with profiler.phase('outer'):
+            for _ in xrange(2):
+                with profiler.phase('inner'):
+                    profiler.count('items', 3)
+
+        profiler.count('other')
+
+        self.assertEqual(profiler.durations.items(),
+                         [('outer', 5.0), ('inner', 2.0)])
+        self.assertEqual(profiler.calls['inner'], 2)
+        self.assertEqual(profiler.counters.items(),
+                         [('items', 6), ('other', 1)])
+        self.assertEqual(ended, [('inner', 1), ('inner', 1), ('outer', 5)])
+
+        self.assertEqual(profiler.report().splitlines(), [
+            "outer    5.000000s",
+            "inner    2.000000s  (2 calls)",
+            "items           6",
+            "other           1",
+        ])
+
+    def test_phase_exception(self):
+        profiler = instrument.Profiler(Clock())
+
+        def fail():
+            with profiler.phase('failing'):
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(profiler.calls['failing'], 1)
+
+    def test_install(self):
+        profiler = instrument.install(instrument.Profiler())
+
+        try:
+            self.assertIs(instrument.get(), profiler)
+        finally:
+            instrument.install(None)
+
+        null = instrument.get()
+        self.assertFalse(null.enabled)
+        self.assertIs(null.phase('a'), null.phase('b'))
+
+
+class ParseProfileTest(TempDirTestCase):
+    """Parsing reports each of its phases once, and what it processed."""
+
+    def setUp(self):
+        super(ParseProfileTest, self).setUp()
+        self.dbfn = self.fn("vault.psafe3")
+        make_db(count=30).save(self.dbfn, incremental=False)
+        self.profiler = instrument.install(instrument.Profiler())
+
+    def tearDown(self):
+        instrument.install(None)
+        super(ParseProfileTest, self).tearDown()
+
+    def test_parse(self):
+        pwsafe = db.parse(self.dbfn, PASSWORD)
+        profiler = self.profiler
+
+        for name in ('parse', 'stretch', 'keys_decrypt', 'data_decrypt',
+                     'header_parse', 'record_parse', 'index', 'verify'):
+            self.assertEqual(profiler.calls[name], 1, name)
+
+        self.assertEqual(profiler.counters['records'], 30)
+        self.assertEqual(profiler.counters['bytes_decrypted'] % 16, 0)
+        self.assertGreater(profiler.counters['fields'], 30)
+
+        # The whole parse includes its phases.
+        phases = sum(v for k, v in profiler.durations.items() if k != 'parse')
+        self.assertGreaterEqual(profiler.durations['parse'], phases * 0.99)
+
+        pwsafe.search("entry 1")
+        self.assertEqual(profiler.calls['search_index'], 1)
+        self.assertEqual(profiler.counters['search_candidates'], 11)
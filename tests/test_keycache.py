@@ -0,0 +1,119 @@
+# builtin
+import unittest
+
+# internal
+import pwsr.db as db
+import pwsr.errors as errors
+import pwsr.keycache as keycache
+import pwsr.instrument as instrument
+
+from . import TempDirTestCase, PASSWORD, make_db
+
+
+SALT = "\x00" * 32
+PP = "\x01" * 32
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryKeyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = keycache.MemoryKeyCache(ttl=60, clock=self.clock)
+
+    def test_cache_id(self):
+        ident = keycache.cache_id(SALT, 2048, "pw")
+
+        self.assertEqual(keycache.cache_id(SALT, 2048, u"pw"), ident)
+        self.assertNotEqual(keycache.cache_id(SALT, 2049, "pw"), ident)
+        self.assertNotEqual(keycache.cache_id("\x02" * 32, 2048, "pw"), ident)
+        self.assertNotEqual(keycache.cache_id(SALT, 2048, "pw2"), ident)
+
+    def test_get_put_forget(self):
+        self.assertIsNone(self.cache.get(SALT, 2048, "pw"))
+
+        self.cache.put(SALT, 2048, "pw", PP)
+        self.assertEqual(self.cache.get(SALT, 2048, "pw"), PP)
+        self.assertIsNone(self.cache.get(SALT, 2048, "other"))
+
+        self.cache.forget(SALT, 2048, "pw")
+        self.assertIsNone(self.cache.get(SALT, 2048, "pw"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_ttl(self):
+        self.cache.put(SALT, 2048, "pw", PP)
+        self.clock.now += 59
+        self.cache.put(SALT, 2048, "other", PP)
+
+        self.assertEqual(self.cache.get(SALT, 2048, "pw"), PP)
+
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get(SALT, 2048, "pw"))
+        self.assertEqual(self.cache.get(SALT, 2048, "other"), PP)
+
+        self.clock.now += 60
+        self.cache.expire()
+        self.assertEqual(len(self.cache), 0)
+
+
+class ParseKeyCacheTest(TempDirTestCase):
+    """``PWSafeDB`` only stretches a password the cache does not hold."""
+
+    def setUp(self):
+        super(ParseKeyCacheTest, self).setUp()
+        self.dbfn = self.fn("vault.psafe3")
+        make_db(count=5).save(self.dbfn, incremental=False)
+
+        self.cache = keycache.install(keycache.MemoryKeyCache())
+        self.profiler = instrument.install(instrument.Profiler())
+
+    def tearDown(self):
+        keycache.install(None)
+        instrument.install(None)
+        super(ParseKeyCacheTest, self).tearDown()
+
+    def stretches(self):
+        return self.profiler.calls['stretch']
+
+    def test_reused(self):
+        db.parse(self.dbfn, PASSWORD)
+        db.parse(self.dbfn, PASSWORD)
+
+        self.assertEqual(self.stretches(), 1)
+        self.assertEqual(self.profiler.counters['key_cache_hits'], 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_wrong_password_not_cached(self):
+        self.assertRaises(errors.InvalidPasswordError, db.parse, self.dbfn,
+                          "wrong")
+        self.assertEqual(len(self.cache), 0)
+
+    def test_stale_entry_replaced(self):
+        pwsafe = db.parse(self.dbfn, PASSWORD)
+        ph = pwsafe.preheader
+        self.cache.put(ph.salt, ph.iter, PASSWORD, PP)
+
+        # A cached P' which does not match H(P') is stretched again.
+        db.parse(self.dbfn, PASSWORD)
+
+        self.assertEqual(self.stretches(), 2)
+        self.assertNotEqual(self.cache.get(ph.salt, ph.iter, PASSWORD), PP)
+
+    def test_per_database_cache(self):
+        cache = keycache.MemoryKeyCache()
+
+        for _ in xrange(2):
+            pwsafe = db.PWSafeDB()
+            pwsafe.key_cache = cache
+
+            with open(self.dbfn, 'rb') as f:
+                pwsafe.parse(f, PASSWORD)
+
+        self.assertEqual(self.stretches(), 1)
+        self.assertEqual((len(cache), len(self.cache)), (1, 0))
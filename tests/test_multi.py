@@ -0,0 +1,82 @@
+# internal
+import pwsr.multi as multi
+import pwsr.errors as errors
+
+from . import TempDirTestCase, PASSWORD, make_db, make_record
+
+
+class MultiTest(TempDirTestCase):
+    """Several databases are opened at once, and one failing database does
+    not fail the others.
+
+    """
+    def setUp(self):
+        super(MultiTest, self).setUp()
+
+        for name, count in (("a", 5), ("b", 12)):
+            make_db(count=count).save(self.fn(name + ".psafe3"),
+                                      incremental=False)
+
+        other = make_db(count=1)
+        other.add_record(make_record("other"))
+        other.save(self.fn("c.psafe3"), incremental=False)
+
+        self.dbfns = [self.fn(x + ".psafe3") for x in "abc"]
+
+    def titles(self, result):
+        return sorted(x.title.value for x in result.records)
+
+    def test_expand(self):
+        dbfns = multi.expand([self.fn("*.psafe3"), self.fn("b.psafe3"),
+                              self.fn("missing.psafe3")])
+
+        self.assertEqual(dbfns, self.dbfns + [self.fn("missing.psafe3")])
+
+    def test_open_many(self):
+        for processes in (1, 2):
+            results = multi.open_many(self.dbfns, PASSWORD, key="ntry 1",
+                                      processes=processes)
+
+            self.assertEqual([x.dbfn for x in results], self.dbfns)
+            self.assertTrue(all(x.ok for x in results))
+            self.assertEqual(self.titles(results[0]), ["entry 1"])
+            self.assertEqual(self.titles(results[1]),
+                             ["entry 1", "entry 10", "entry 11"])
+            self.assertEqual(results[2].records, [])
+
+    def test_all_records(self):
+        results = multi.open_many(self.dbfns, PASSWORD, processes=2)
+        merged = list(multi.merged(results))
+
+        self.assertEqual(len(merged), 5 + 12 + 2)
+        self.assertEqual(merged[-1][0], self.fn("c.psafe3"))
+        self.assertEqual(merged[-1][1].title.value, "other")
+        self.assertEqual(merged[-1][1].password.value, "secret")
+
+    def test_where(self):
+        results = multi.open_many(self.dbfns, PASSWORD, key="entry",
+                                  where=["group=group 1"], processes=1)
+
+        self.assertEqual(self.titles(results[1]),
+                         ["entry 1", "entry 5", "entry 9"])
+
+    def test_errors_per_vault(self):
+        with open(self.fn("bad.psafe3"), 'wb') as f:
+            f.write("not a database")
+
+        dbfns = [self.fn("missing.psafe3"), self.fn("bad.psafe3"),
+                 self.fn("a.psafe3")]
+
+        for processes in (1, 2):
+            results = multi.open_many(dbfns, PASSWORD, processes=processes)
+            missing, bad, ok = results
+
+            self.assertIsInstance(missing.error, IOError)
+            self.assertIsInstance(bad.error, errors.InvalidDatabaseError)
+            self.assertEqual(len(ok.records), 5)
+            self.assertEqual(list(multi.merged(results)),
+                             [(ok.dbfn, x) for x in ok.records])
+
+        wrong = multi.open_vault(self.fn("a.psafe3"), PASSWORD + "x")
+        self.assertIsInstance(wrong.error, errors.InvalidPasswordError)
+        self.assertFalse(wrong.ok)
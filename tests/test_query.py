@@ -0,0 +1,165 @@
+# builtin
+import uuid
+import random
+import struct
+import unittest
+
+# internal
+import pwsr.query as query
+import pwsr.errors as errors
+from pwsr.db import PWSafeDB, PWSafeV3Record, PwSafeV3Field
+from pwsr.index import RangeIndex
+
+from . import PASSWORD, make_record
+
+
+NOW = 1400000000
+DAY = 24 * 60 * 60
+
+
+def decode_time(value):
+    return query.decode(query.KIND_TIME, value)
+
+
+class PredicateTest(unittest.TestCase):
+    def test_parse(self):
+        predicate = query.parse("expiry<2014-05-13", now=NOW)
+
+        self.assertEqual(predicate.ftype, 0x0a)
+        self.assertEqual(predicate.op, '<')
+        self.assertEqual(predicate.value, NOW - NOW % DAY)
+        self.assertTrue(predicate.ranged)
+
+    def test_times(self):
+        parse = lambda x: query.parse_time(x, now=NOW)
+
+        self.assertEqual(parse("now"), NOW)
+        self.assertEqual(parse("-2d"), NOW - 2 * DAY)
+        self.assertEqual(parse("+1w"), NOW + 7 * DAY)
+        self.assertEqual(parse("12345"), 12345)
+        self.assertEqual(parse("1970-01-02T00:00:01"), DAY + 1)
+        self.assertRaises(errors.QueryError, parse, "yesterday")
+
+    def test_values(self):
+        self.assertEqual(query.parse("0x15=1").value, 1)
+        self.assertEqual(query.parse("title~GMail").value, "gmail")
+
+        value = "12345678-1234-5678-1234-567812345678"
+        self.assertEqual(query.parse("uuid=" + value).value, uuid.UUID(value))
+
+    def test_invalid(self):
+        for expr in ("title", "nosuchfield=1", "=x", "mtime~1",
+                     "uuid<1", "protected=yes"):
+            self.assertRaises(errors.QueryError, query.parse, expr)
+
+    def test_match(self):
+        predicate = query.parse("mtime>=100")
+
+        self.assertTrue(predicate.match(100))
+        self.assertFalse(predicate.match(99))
+        self.assertFalse(predicate.match(None))
+        self.assertEqual(predicate.bounds(), (100, None, True, True))
+
+    def test_decode(self):
+        self.assertEqual(decode_time(struct.pack("<L", NOW)), NOW)
+        self.assertEqual(decode_time(struct.pack("<Q", NOW)), NOW)
+        self.assertIsNone(decode_time(""))
+        self.assertIsNone(query.decode(query.KIND_UUID, "short"))
+
+
+class RangeIndexTest(unittest.TestCase):
+    FIELD = PWSafeV3Record.TYPE_MTIME
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.records = [
+            make_record("entry %d" % i, mtime=rand.randint(1, 1000))
+            for i in xrange(500)
+        ]
+
+        # Records without the field are not part of any range.
+        del self.records[0][self.FIELD]
+
+    def mtime(self, record):
+        field = record[self.FIELD]
+        return None if field is None else decode_time(field.value)
+
+    def assertRange(self, index, records, low, high):
+        expected = sorted(
+            (x for x in records if low <= (self.mtime(x) or -1) <= high),
+            key=self.mtime
+        )
+        actual = index.range(low, high)
+
+        self.assertEqual([self.mtime(x) for x in actual],
+                         [self.mtime(x) for x in expected])
+        self.assertEqual(set(map(id, actual)), set(map(id, expected)))
+
+    def test_build_matches_insertion(self):
+        built = RangeIndex(self.FIELD, decode_time, self.records)
+        inserted = RangeIndex(self.FIELD, decode_time)
+
+        for record in self.records:
+            inserted.add(record)
+
+        self.assertEqual(map(id, built.range()), map(id, inserted.range()))
+        self.assertEqual(len(built), 500)
+        self.assertRange(built, self.records, 100, 200)
+
+    def test_remove_and_compact(self):
+        index = RangeIndex(self.FIELD, decode_time, self.records)
+
+        for record in self.records[:400]:
+            index.remove(record)
+            index.remove(record)
+
+        live = self.records[400:]
+
+        # Tombstones are dropped once they pass a fraction of the index.
+        self.assertLess(len(index._records), 250)
+        self.assertEqual(len(index), 100)
+        self.assertRange(index, live, 1, 1000)
+
+        added = make_record("added", mtime=500)
+        index.add(added)
+
+        self.assertIn(added, index.range(500, 500))
+        self.assertEqual(index.value(added), 500)
+        self.assertEqual(index.value(live[0]), self.mtime(live[0]))
+
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.pwsafe = PWSafeDB()
+        self.pwsafe.create(PASSWORD, iterations=PWSafeDB.MIN_ITER)
+
+        for i in xrange(100):
+            self.pwsafe.add_record(make_record(
+                "entry %d" % i, group="group %d" % (i % 2),
+                mtime=NOW - i * DAY
+            ))
+
+    def titles(self, *predicates):
+        return set(x.title.value for x in self.pwsafe.query(*predicates))
+
+    def test_range(self):
+        titles = self.titles("mtime>%d" % (NOW - 3 * DAY))
+        self.assertEqual(titles, set(["entry 0", "entry 1", "entry 2"]))
+
+    def test_combined(self):
+        titles = self.titles("mtime>=%d" % (NOW - 3 * DAY), "group=group 1")
+        self.assertEqual(titles, set(["entry 1", "entry 3"]))
+
+        titles = self.titles("title~ENTRY 9", "mtime<%d" % (NOW - 95 * DAY))
+        self.assertEqual(titles, set(["entry 96", "entry 97", "entry 98",
+                                      "entry 99"]))
+
+    def test_index_follows_edits(self):
+        self.titles("mtime>%d" % NOW)
+        mtime = PWSafeV3Record.TYPE_MTIME
+
+        record = self.pwsafe["entry 50"]
+        record[mtime] = PwSafeV3Field(mtime, struct.pack("<L", NOW + DAY))
+        self.pwsafe.remove_record(self.pwsafe["entry 0"])
+
+        self.assertEqual(self.titles("mtime>=%d" % NOW), set(["entry 50"]))
@@ -0,0 +1,58 @@
+# builtin
+import os
+import sys
+import unittest
+import subprocess
+
+# internal
+import pwsr.scripts as scripts
+
+from . import TempDirTestCase, PASSWORD, make_db
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = os.path.join(ROOT, "pwsr", "scripts")
+
+try:
+    import pyperclip
+except ImportError:
+    pyperclip = None
+
+
+class BrokenPipeTest(TempDirTestCase):
+    """Scripts stop quietly when their output is piped to a reader which
+    exits early, such as ``head``.
+
+    """
+    def setUp(self):
+        super(BrokenPipeTest, self).setUp()
+        self.dbfn = self.fn("vault.psafe3")
+
+        # More output than a pipe buffers.
+        make_db(count=2000).save(self.dbfn, incremental=False)
+
+    def run_head(self, script, *args):
+        env = dict(os.environ, PYTHONPATH=ROOT, HOME=self.path)
+        command = [sys.executable, os.path.join(SCRIPTS, script),
+                   "--db", self.dbfn, "--dbpw", PASSWORD]
+
+        process = subprocess.Popen(
+            command + list(args), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=env
+        )
+
+        line = process.stdout.readline()
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.wait()
+
+        self.assertTrue(line)
+        self.assertEqual(stderr, "")
+        self.assertEqual(process.returncode, scripts.EXIT_BROKEN_PIPE)
+
+    def test_export(self):
+        self.run_head("pwsr-export.py")
+
+    @unittest.skipIf(pyperclip is None, "pyperclip is not installed")
+    def test_search(self):
+        self.run_head("pwsr-search.py", "--list")
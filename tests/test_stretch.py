@@ -0,0 +1,68 @@
+# builtin
+import os
+import hashlib
+import unittest
+
+# internal
+import pwsr.stretch as stretch
+import pwsr.errors as errors
+
+
+def reference(key, salt, iterations):
+    """The stretch loop exactly as section 2.3 of the format specification
+    describes it, independent of pwsr.stretch.
+
+    """
+    digest = hashlib.sha256(key + salt).digest()
+
+    for _ in xrange(iterations):
+        digest = hashlib.sha256(digest).digest()
+
+    return digest
+
+
+class StretchBackendTest(unittest.TestCase):
+    """Every registered backend computes the same P'."""
+
+    KEYS = ["", "pwsr", "\x00\xff" * 40, u"p\xe4ssw\xf6rd".encode('utf-8')]
+    ITERATIONS = [0, 1, 2, 2048, 10000]
+
+    def test_backends_registered(self):
+        self.assertIn('reference', stretch.backends())
+        self.assertIn('hashlib', stretch.backends())
+
+    def test_backends_agree(self):
+        salt = os.urandom(32)
+
+        for name in stretch.backends():
+            for key in self.KEYS:
+                for iterations in self.ITERATIONS:
+                    self.assertEqual(
+                        stretch.stretch_key(key, salt, iterations, name),
+                        reference(key, salt, iterations),
+                        "{0}: {1!r}, {2}".format(name, key, iterations)
+                    )
+
+    @unittest.skipUnless('native' in stretch.backends(),
+                         "pwsr._stretch is not built")
+    def test_native_backend(self):
+        salt = os.urandom(32)
+        self.assertEqual(stretch.stretch_key("pwsr", salt, 100000, 'native'),
+                         reference("pwsr", salt, 100000))
+
+    def test_default_backend(self):
+        salt = "\x01" * 32
+        self.assertEqual(stretch.stretch_key("pwsr", salt, 2048),
+                         reference("pwsr", salt, 2048))
+
+    def test_incorrect_backend_rejected(self):
+        def bad(key, salt, iterations):
+            return reference(key, salt, iterations + 1)
+
+        self.assertRaises(errors.StretchBackendError, stretch.register_backend,
+                          'test-bad', bad)
+        self.assertNotIn('test-bad', stretch.backends())
+
+    def test_unknown_backend(self):
+        self.assertRaises(errors.StretchBackendError, stretch.get_backend,
+                          'no-such-backend')
@@ -0,0 +1,298 @@
+# builtin
+import os
+import time
+import shutil
+import struct
+import threading
+
+# internal
+import pwsr.db as db
+import pwsr.sync as sync
+import pwsr.errors as errors
+from pwsr.db import PWSafeV3Record, PwSafeV3Field
+
+from . import (TempDirTestCase, PASSWORD, make_db, make_record, raw_records,
+               record_uuid)
+
+
+class CountingBackend(sync.LocalDirectoryBackend):
+    """Records the objects downloaded, as opposed to found unchanged, and
+    the objects uploaded.
+
+    """
+    def __init__(self, path):
+        super(CountingBackend, self).__init__(path)
+        self.downloads = []
+        self.uploads = []
+
+    def get(self, name):
+        self.downloads.append(name)
+        return super(CountingBackend, self).get(name)
+
+    def put(self, name, data):
+        self.uploads.append(name)
+        return super(CountingBackend, self).put(name, data)
+
+
+class SyncTest(TempDirTestCase):
+    """Two copies of a database edited apart converge by syncing."""
+
+    def setUp(self):
+        super(SyncTest, self).setUp()
+        make_db(count=10).save(self.fn("a.psafe3"), incremental=False)
+        shutil.copy(self.fn("a.psafe3"), self.fn("b.psafe3"))
+
+        self.backend = CountingBackend(self.fn("remote"))
+        self.sync("a")
+        self.sync("b")
+
+    def sync(self, name):
+        dbfn = self.fn(name + ".psafe3")
+        state_fn = sync.state_path(dbfn, self.fn("state"))
+        pwsafe = db.parse(dbfn, PASSWORD)
+
+        return sync.sync(pwsafe, self.backend, dbfn, state_fn)
+
+    def edit(self, name, func):
+        dbfn = self.fn(name + ".psafe3")
+        pwsafe = db.parse(dbfn, PASSWORD)
+        func(pwsafe)
+        pwsafe.save(dbfn)
+
+    def assertConverged(self):
+        a = db.parse(self.fn("a.psafe3"), PASSWORD)
+        b = db.parse(self.fn("b.psafe3"), PASSWORD)
+
+        self.assertEqual(raw_records(a), raw_records(b))
+        return a
+
+    def test_initial_sync(self):
+        result = self.sync("a")
+
+        self.assertFalse(result.local_changed or result.remote_changed)
+        self.assertConverged()
+
+    def test_uploads_changes_only(self):
+        self.assertEqual(self.backend.uploads.count(sync.PREHEADER), 1)
+        del self.backend.uploads[:]
+
+        title = PWSafeV3Record.TYPE_TITLE
+
+        def edit(pwsafe):
+            pwsafe["entry 4"][title] = PwSafeV3Field(title, "edited")
+
+        self.edit("a", edit)
+        self.sync("a")
+
+        # The changed record and the manifest, but not the preheader.
+        self.assertEqual(len(self.backend.uploads), 2)
+        self.assertEqual(self.backend.uploads[-1], sync.MANIFEST)
+
+    def test_preheader_uploaded_when_changed(self):
+        pwsafe = db.parse(self.fn("a.psafe3"), PASSWORD)
+        pwsafe.preheader.iter += 1
+        syncer = sync.Syncer(pwsafe, self.backend)
+
+        del self.backend.uploads[:]
+        syncer.sync()
+        self.assertEqual(self.backend.uploads,
+                         [sync.PREHEADER, sync.MANIFEST])
+
+    def test_divergent_edits(self):
+        title = PWSafeV3Record.TYPE_TITLE
+        added = make_record("added on b")
+
+        def edit_a(pwsafe):
+            pwsafe["entry 1"][title] = PwSafeV3Field(title, "edited on a")
+            pwsafe.remove_record(pwsafe["entry 2"])
+
+        def edit_b(pwsafe):
+            pwsafe["entry 5"][title] = PwSafeV3Field(title, "edited on b")
+            pwsafe.add_record(added)
+
+        self.edit("a", edit_a)
+        self.edit("b", edit_b)
+
+        result = self.sync("a")
+        self.assertEqual(len(result.pushed), 1)
+        self.assertEqual(len(result.deleted_remote), 1)
+
+        result = self.sync("b")
+        self.assertEqual(len(result.pulled), 1)
+        self.assertEqual(len(result.deleted_local), 1)
+        self.assertEqual(len(result.pushed), 2)
+
+        result = self.sync("a")
+        self.assertEqual(len(result.pulled), 2)
+
+        pwsafe = self.assertConverged()
+        titles = set(x.title.value for x in pwsafe.records)
+
+        self.assertEqual(len(pwsafe.records), 10)
+        self.assertTrue(set(["edited on a", "edited on b", "added on b"]) <=
+                        titles)
+        self.assertNotIn("entry 2", titles)
+        self.assertIn(record_uuid(added), raw_records(pwsafe))
+
+    def test_conflict_newest_wins(self):
+        title = PWSafeV3Record.TYPE_TITLE
+        mtime = PWSafeV3Record.TYPE_MTIME
+
+        def edit(value, when):
+            def func(pwsafe):
+                record = pwsafe["entry 3"]
+                record[title] = PwSafeV3Field(title, value)
+                record[mtime] = PwSafeV3Field(
+                    mtime, struct.pack("<L", int(when))
+                )
+            return func
+
+        self.edit("a", edit("newer", time.time() + 60))
+        self.edit("b", edit("older", time.time()))
+
+        self.sync("b")
+        self.sync("a")
+        self.sync("b")
+
+        pwsafe = self.assertConverged()
+        titles = [x.title.value for x in pwsafe.records]
+
+        self.assertIn("newer", titles)
+        self.assertNotIn("older", titles)
+
+    def test_other_database_rejected(self):
+        other = make_db(count=1)
+        syncer = sync.Syncer(other, self.backend)
+
+        self.assertRaises(errors.SyncError, syncer.sync)
+
+
+class VaultCacheTest(TempDirTestCase):
+    """The cache downloads objects only when they change, and evicts them by
+    age and by size.
+
+    """
+    def setUp(self):
+        super(VaultCacheTest, self).setUp()
+        self.backend = CountingBackend(self.fn("remote"))
+        self.cache = sync.VaultCache(self.fn("cache"))
+
+    def test_conditional_fetch(self):
+        self.backend.put("object", "first")
+
+        self.assertEqual(self.cache.get(self.backend, "object")[0], "first")
+        self.assertEqual(self.cache.get(self.backend, "object")[0], "first")
+        self.assertEqual(self.backend.downloads, ["object"])
+
+        # A new cache instance reads the index saved by flush().
+        self.cache.flush()
+        cache = sync.VaultCache(self.fn("cache"))
+        with open(cache.fetch(self.backend, "object"), 'rb') as f:
+            self.assertEqual(f.read(), "first")
+        self.assertEqual(self.backend.downloads, ["object"])
+
+        time.sleep(0.01)
+        self.backend.put("object", "second")
+        self.assertEqual(cache.get(self.backend, "object")[0], "second")
+        self.assertEqual(self.backend.downloads, ["object", "object"])
+
+    def test_missing_object(self):
+        self.assertRaises(KeyError, self.cache.get, self.backend, "missing")
+
+    def test_evict_by_age(self):
+        self.cache.max_age = 60
+
+        for name in ("old", "new"):
+            self.backend.put(name, name)
+            self.cache.get(self.backend, name)
+
+        old = self.cache.fetch(self.backend, "old")
+        self.cache.index[self.cache._key(self.backend, "old")]['used'] -= 120
+        self.cache.evict()
+
+        self.assertEqual(self.cache.index.keys(),
+                         [self.cache._key(self.backend, "new")])
+        self.assertFalse(os.path.exists(old))
+
+    def test_evict_by_size(self):
+        self.cache.max_size = 250
+
+        for i in xrange(5):
+            self.backend.put(str(i), str(i) * 100)
+            self.cache.fetch(self.backend, str(i))
+            time.sleep(0.01)
+
+        self.cache.flush()
+        names = sorted(x.rsplit("/", 1)[1] for x in self.cache.index)
+
+        # The least recently used entries go first.
+        self.assertEqual(names, ["3", "4"])
+        self.assertEqual(len(os.listdir(self.cache.path)), 3)
+
+
+class RemoteVaultTest(TempDirTestCase):
+    """Databases synced to a local HTTP server are rebuilt offline."""
+
+    def setUp(self):
+        super(RemoteVaultTest, self).setUp()
+        self.server = sync.DirectoryHTTPServer(("127.0.0.1", 0),
+                                               self.fn("remote"))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.backend = sync.HTTPBackend(self.server.url)
+        self.cache = sync.VaultCache(self.fn("cache"))
+
+        make_db(count=10).save(self.fn("local.psafe3"), incremental=False)
+        self.sync()
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super(RemoteVaultTest, self).tearDown()
+
+    def sync(self):
+        dbfn = self.fn("local.psafe3")
+        state_fn = sync.state_path(dbfn, self.fn("state"))
+
+        return sync.sync(db.parse(dbfn, PASSWORD), self.backend, dbfn,
+                         state_fn)
+
+    def assertSameRecords(self, dbfn):
+        local = db.parse(self.fn("local.psafe3"), PASSWORD)
+        remote = db.parse(dbfn, PASSWORD)
+
+        self.assertEqual(local.header._raw_fields(),
+                         remote.header._raw_fields())
+        self.assertEqual(raw_records(local), raw_records(remote))
+
+    def test_fetch_vault(self):
+        dbfn = sync.fetch_vault(self.backend, PASSWORD, self.cache)
+        self.assertSameRecords(dbfn)
+
+        # Unchanged remote objects are served from the cache.
+        self.assertEqual(sync.fetch_vault(self.backend, PASSWORD, self.cache),
+                         dbfn)
+
+    def test_fetch_vault_after_change(self):
+        first = sync.fetch_vault(self.backend, PASSWORD, self.cache)
+
+        pwsafe = db.parse(self.fn("local.psafe3"), PASSWORD)
+        pwsafe.remove_record(pwsafe.records[0])
+        pwsafe.save(self.fn("local.psafe3"))
+        self.sync()
+
+        dbfn = sync.fetch_vault(self.backend, PASSWORD, self.cache)
+        self.assertNotEqual(dbfn, first)
+        self.assertSameRecords(dbfn)
+
+    def test_wrong_password(self):
+        self.assertRaises(errors.InvalidPasswordError, sync.fetch_vault,
+                          self.backend, PASSWORD + "x", self.cache)
+
+    def test_nothing_synced(self):
+        backend = sync.LocalDirectoryBackend(self.fn("empty"))
+        self.assertRaises(KeyError, sync.fetch_vault, backend, PASSWORD,
+                          self.cache)